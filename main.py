@@ -1,18 +1,39 @@
-import pygame
 import sys
+
+# pygame при импорте загружает pygame.pkgdata, а тот — pkg_resources из setuptools: около 100 мс,
+# половина импорта pygame. Без pkg_resources pkgdata читает файлы pygame прямо из его каталога
+sys.modules.setdefault("pkg_resources", None)
+import pygame
+if sys.modules["pkg_resources"] is None:
+    del sys.modules["pkg_resources"]
 import random
 import math
 import os
+import time
+import argparse
+import csv
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
+import multiprocessing
+import socket
+import struct
+import threading
+import zlib
+import queue
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
 from enum import Enum
 
-# Инициализация Pygame
-pygame.init()
-pygame.mixer.init()  # Инициализация звукового движка
+import numpy as np
 
 # Константы
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
-FPS = 60
+FPS = 60  # Частота шагов симуляции: все таймеры игры считаются в шагах
+MAX_CATCH_UP_STEPS = 5  # Сколько шагов симуляции можно догнать за один кадр отрисовки
 
 # Цвета
 WHITE = (255, 255, 255)
@@ -25,18 +46,199 @@ GRAY = (100, 100, 100)
 DARK_GRAY = (50, 50, 50)
 BROWN = (139, 69, 19)
 
-# Настройка экрана
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("The Binding of Bin Laden")
-clock = pygame.time.Clock()
-
 # Пути к ресурсам
 IMG_DIR = "images"
 SOUND_DIR = "sounds"
 
-# Создаем папки для ресурсов, если их нет
-os.makedirs(IMG_DIR, exist_ok=True)
-os.makedirs(SOUND_DIR, exist_ok=True)
+# Пакет заранее уменьшенных изображений (см. bake_assets)
+PACK_FILE = os.path.join(IMG_DIR, "assets.pack")
+PACK_MAGIC = b"BOBPACK1"
+PACK_VERSION = 1
+
+# Записи забегов для воспроизведения (см. ReplayRecorder)
+REPLAY_MAGIC = b"BOBRPLY1"
+REPLAY_VERSION = 3
+CHECKPOINT_INTERVAL = 60  # Контрольная сумма состояния раз в столько шагов симуляции
+
+# Снимки состояния игры (см. snapshot_game)
+SNAPSHOT_MAGIC = b"BOBRSNP1"
+SNAPSHOT_VERSION = 3
+# Буфер общей памяти под снимок при --pipeline: снимку с полным пулом пуль (~330 КБ) хватает с запасом
+PIPELINE_SLOT_SIZE = 512 * 1024
+
+# Совместная игра по сети (rollback): ввод напарника предсказывается, при расхождении
+# состояние откатывается к снимку и шаги пересчитываются с настоящим вводом
+NET_INPUT_DELAY = 2  # Задержка локального ввода в шагах: чем больше, тем реже откаты
+NET_MAX_ROLLBACK = 8  # Насколько шагов можно обогнать подтвержденный ввод напарника
+NET_PACKET_INPUTS = 32  # Сколько неподтвержденных масок ввода повторять в одном пакете
+NET_CHECK_INTERVAL = 30  # Как часто (в шагах) сверять с напарником контрольную сумму снимка
+NET_HELLO_INTERVAL = 0.25  # Как часто (с) подключающийся повторяет приветствие
+NET_LEAVE_REPEATS = 3  # Сколько раз отправить уведомление о выходе (пакеты могут теряться)
+
+# Телеметрия (--telemetry): события забега и формат их записи в кольцевом буфере
+TELEMETRY_EVENTS = ("run_start", "run_end", "room_clear", "enemy_hit", "enemy_death",
+                    "boss_hit", "boss_phase", "boss_death", "player_hurt", "player_death")
+TELEMETRY_KINDS = {name: i for i, name in enumerate(TELEMETRY_EVENTS)}
+# Время с начала сессии (с), зерно забега, событие, комната, кто (персонаж, тип врага, фаза босса),
+# источник урона, значение (урон, оставшееся здоровье), координаты
+TELEMETRY_RECORD = np.dtype([("time", "<f8"), ("run", "<u4"), ("kind", "u1"), ("room", "u1"),
+                             ("subject", "<i2"), ("source", "<u2"), ("value", "<i4"), ("x", "<i2"), ("y", "<i2")])
+TELEMETRY_CAPACITY = 8192  # Строк в кольцевом буфере
+TELEMETRY_FLUSH_INTERVAL = 1.0  # Как часто (с) поток записи сбрасывает события в файл
+
+# Балансные прогоны (см. run_balance)
+BALANCE_MAX_STEPS = FPS * 600  # Забег длиннее 10 минут игрового времени считается зависшим
+
+# Изображения: ключ -> (файл, размер, цвет заглушки)
+IMAGE_SPECS = {
+    # Персонажи
+    "player_1": ("player_1.png", (60, 60), RED),  # Osama Bin Laden
+    "player_2": ("player_2.png", (60, 60), GREEN),  # Saddam Hussein
+    "player_3": ("player_3.png", (60, 60), BLUE),  # Aiman AL-Zawahiri
+    # Враги
+    "enemy_1": ("enemy_1.png", (60, 60), YELLOW),  # Враг-преследователь
+    "enemy_2": ("enemy_2.png", (60, 60), BROWN),   # Враг-стрелок
+    "enemy_3": ("enemy_3.png", (60, 60), GRAY),    # Враг-охранник
+    # Босс
+    "boss": ("boss.png", (100, 100), RED),
+    # Снаряды
+    "bullet_player": ("bullet_player.png", (30, 30), WHITE),
+    "bullet_enemy": ("bullet_enemy.png", (40, 40), RED),
+    # Сердце
+    "heart": ("heart.png", (80, 50), RED),
+}
+
+# Звуковые эффекты: имя -> (файл, максимум одновременных голосов, приоритет).
+# Более важный звук (с большим приоритетом) может прервать менее важный, если каналы заняты
+SOUND_SPECS = {
+    "shoot": ("shoot.wav", 3, 0),
+    "hit": ("hit.wav", 4, 1),
+    "enemy_death": ("enemy_death.wav", 3, 2),
+    "player_hurt": ("player_hurt.wav", 1, 3),
+    "victory": ("victory.wav", 1, 4),
+}
+SFX_CHANNELS = 16  # Каналы микшера, зарезервированные под звуковые эффекты
+SFX_COALESCE = 0.03  # Повторный запуск того же звука в пределах этого окна (с) игнорируется
+MUSIC_CHANNELS = 2  # Каналы под музыку: на двух каналах одна дорожка затихает, другая нарастает
+MUSIC_FADE_MS = 800  # Длительность перехода между дорожками
+MUSIC_CACHE_TRACKS = 2  # Сколько раскодированных дорожек держать в памяти
+MIXER_FREQUENCY = 44100
+MIXER_BUFFER = 512  # Размер буфера микшера в сэмплах (~12 мс): меньше буфер — меньше задержка звука
+
+# Шрифты: имя -> (семейство, размер). Создаются при первом использовании
+FONT_SPECS = {
+    "title": ("arial", 48),
+    "medium": ("arial", 36),
+    "small": ("arial", 24),
+}
+# Найденные пути к системным шрифтам, чтобы не сканировать шрифты системы при каждом запуске
+FONT_CACHE_FILE = os.path.join(IMG_DIR, "fonts.json")
+
+# Изображения, которые загружаются при первом обращении и живут в кэше поверхностей, как и фоны
+LAZY_IMAGES = ("boss",)
+ATLAS_WIDTH = 512  # Ширина атласа, в который собираются остальные изображения
+
+# Изображения, коллизии которых уточняются попиксельно по маске после проверки прямоугольников.
+# Остальные сталкиваются всем прямоугольником
+PIXEL_COLLISION = {
+    "player_1", "player_2", "player_3",
+    "enemy_1", "enemy_2", "enemy_3",
+    "boss",
+    "bullet_player", "bullet_enemy",
+}
+SURFACE_CACHE_BUDGET = 16 * 1024 * 1024  # Бюджет кэша фонов и больших изображений, байт
+
+# Фоны уровней: номер комнаты -> (файл, цвет заглушки)
+BACKGROUND_SPECS = {
+    1: ("background_3.png", DARK_GRAY),
+    2: ("background_2.png", (70, 70, 100)),
+    3: ("background_1.png", (100, 70, 70)),
+    4: ("background_4.png", (70, 100, 70)),
+    5: ("background_5.png", (100, 100, 50)),
+}
+
+# Режимы вывода кадра (--scale). Игра всегда рисуется в поверхность SCREEN_WIDTH × SCREEN_HEIGHT:
+#   "off" — это и есть окно; "scaled" — окно pygame.SCALED, масштабирует и добавляет поля SDL;
+#   "integer" — программное масштабирование в окно с целым коэффициентом и полями;
+#   "fit" — программное масштабирование с сохранением пропорций на все окно, с полями
+SCALE_MODES = ("off", "scaled", "integer", "fit")
+
+# Экран (поверхность, в которую рисуется кадр), вывод кадра, часы и ассеты создаются в init(),
+# а не при импорте модуля
+screen = None
+presenter = None
+clock = None
+assets = None
+
+def init(headless=False, cache_budget=SURFACE_CACHE_BUDGET, report=None,
+         scale="off", window_size=None, fullscreen=False, smooth=False):
+    """Инициализирует Pygame, окно и ассеты. В headless-режиме используются dummy-драйверы SDL.
+    Изображения и звуки догружаются в фоне (см. Assets.load_deferred); report — StartupReport.
+    scale, window_size, fullscreen и smooth задают вывод кадра в окно (см. Presenter)"""
+    global screen, presenter, clock, assets
+    report = report or StartupReport(enabled=False)
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+    
+    # Инициализация Pygame; параметры микшера задаются до pygame.init(), иначе он создастся с буфером по умолчанию
+    pygame.mixer.pre_init(MIXER_FREQUENCY, -16, 2, MIXER_BUFFER)
+    pygame.init()
+    pygame.mixer.init()  # Инициализация звукового движка
+    report.mark("pygame.init")
+    
+    # Настройка экрана
+    presenter = Presenter(scale, window_size, fullscreen, smooth)
+    screen = presenter.surface
+    pygame.display.set_caption("The Binding of Bin Laden")
+    clock = pygame.time.Clock()
+    report.mark("display")
+    
+    # Создаем папки для ресурсов, если их нет
+    os.makedirs(IMG_DIR, exist_ok=True)
+    os.makedirs(SOUND_DIR, exist_ok=True)
+    
+    assets = Assets(cache_budget, report)  # Загрузка ассетов
+    report.mark("assets")
+
+# Замеры времени запуска по фазам (--startup-report)
+class StartupReport:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # Время процессора до вызова main(): запуск интерпретатора и импорт модулей
+        self.phases = [("python + import (CPU)", time.process_time() * 1000)]
+        self.start = self.last = time.perf_counter()
+        self.background = []  # Фазы фоновой загрузки: (фаза, мс)
+    
+    def mark(self, phase):
+        """Добавляет фазу основного потока: время с прошлой отметки"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000))
+        self.last = now
+    
+    def add_background(self, phase, started):
+        """Добавляет фазу фонового потока, начавшуюся в started (time.perf_counter())"""
+        if self.enabled:
+            self.background.append((phase, (time.perf_counter() - started) * 1000))
+    
+    def finish(self, phase=None):
+        """Один раз печатает отчет, дождавшись окончания фоновой загрузки; phase — последняя
+        отметка основного потока (например, "first frame" после первого показанного кадра)"""
+        if not self.enabled:
+            return
+        if phase:
+            self.mark(phase)
+        assets.loaded.wait()
+        print("\n".join(self.lines()))
+        self.enabled = False
+    
+    def lines(self):
+        lines = [f"{phase:<24}{ms:8.1f} мс" for phase, ms in self.phases]
+        lines.append(f"{'итого с начала main()':<24}{(self.last - self.start) * 1000:8.1f} мс")
+        lines += [f"{'[фон] ' + phase:<24}{ms:8.1f} мс" for phase, ms in self.background]
+        return lines
 
 # Класс для игровых состояний
 class GameState(Enum):
@@ -46,60 +248,414 @@ class GameState(Enum):
     GAME_OVER = 4
     VICTORY = 5
 
+# Клавиши управления игроком
+MOVE_KEYS = (pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d)
+FIRE_KEYS = (pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT)
+
+# Набор зажатых клавиш с тем же интерфейсом, что и pygame.key.get_pressed()
+class KeyState:
+    def __init__(self, held=()):
+        self.held = frozenset(held)
+    
+    def __getitem__(self, key):
+        return key in self.held
+
+# Источник ввода: реальная клавиатура
+class KeyboardInput:
+    def get_pressed(self):
+        return pygame.key.get_pressed()
+
+# Источник ввода: фиксированный набор зажатых клавиш
+class ScriptedInput:
+    def __init__(self, held=()):
+        self.keys = KeyState(held)
+    
+    def get_pressed(self):
+        return self.keys
+
+# Источник ввода: случайное "нажатие" клавиш для нагрузочных прогонов
+class RandomInput:
+    def __init__(self, seed=None, hold_frames=15):
+        self.rng = random.Random(seed)
+        self.hold_frames = hold_frames  # Сколько кадров держать выбранные клавиши
+        self.frame = 0
+        self.keys = KeyState()
+    
+    def get_pressed(self):
+        if self.frame % self.hold_frames == 0:
+            held = [key for key in MOVE_KEYS if self.rng.random() < 0.3]
+            held.append(self.rng.choice(FIRE_KEYS))
+            self.keys = KeyState(held)
+        self.frame += 1
+        return self.keys
+
+# Клавиши, которые попадают в запись: бит i маски соответствует REPLAY_KEYS[i]
+REPLAY_KEYS = MOVE_KEYS + FIRE_KEYS
+# Готовые наборы клавиш для каждой маски, чтобы не собирать их на каждом шаге
+MASK_KEYS = [KeyState(key for bit, key in enumerate(REPLAY_KEYS) if mask >> bit & 1)
+             for mask in range(1 << len(REPLAY_KEYS))]
+
+def keys_to_mask(keys):
+    """Упаковывает зажатые клавиши в один байт"""
+    mask = 0
+    for bit, key in enumerate(REPLAY_KEYS):
+        if keys[key]:
+            mask |= 1 << bit
+    return mask
+
+# Источник ввода: записанный забег, по одной маске клавиш на шаг симуляции
+class ReplayInput:
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.frame = 0
+    
+    def get_pressed(self):
+        if self.frame >= len(self.inputs):
+            return MASK_KEYS[0]
+        keys = MASK_KEYS[self.inputs[self.frame]]
+        self.frame += 1
+        return keys
+
+# Источник ввода: простой бот для балансных прогонов. Держит дистанцию до ближайшего
+# противника, кружит вокруг него и стреляет в его сторону. Поле game задается после создания игры
+class BotInput:
+    def __init__(self, seed=None, distance=250, player=0):
+        self.rng = random.Random(seed)
+        self.distance = distance  # Желаемое расстояние до противника
+        self.player = player  # Номер игрока в game.players, за которого играет бот
+        self.strafe = 1  # Направление кружения: 1 или -1
+        self.frame = 0
+        self.game = None
+    
+    def get_pressed(self):
+        game = self.game
+        targets = (game.boss,) if game.boss else game.enemies.sprites()
+        player = game.players[self.player]
+        if not targets or player.health <= 0:
+            return MASK_KEYS[0]
+        
+        # Ближайший противник
+        px, py = player.rect.center
+        target = min(targets, key=lambda t: (t.rect.centerx - px)**2 + (t.rect.centery - py)**2)
+        dx = target.rect.centerx - px
+        dy = target.rect.centery - py
+        dist = math.sqrt(dx**2 + dy**2) or 1
+        
+        # Стрельба: по преобладающей оси, по диагонали — если оси сравнимы
+        held = []
+        if abs(dy) * 2 >= abs(dx):
+            held.append(pygame.K_DOWN if dy > 0 else pygame.K_UP)
+        if abs(dx) * 2 >= abs(dy):
+            held.append(pygame.K_RIGHT if dx > 0 else pygame.K_LEFT)
+        
+        # Движение: по касательной к противнику, плюс к нему или от него
+        if self.frame % 90 == 0:
+            self.strafe = self.rng.choice((-1, 1))
+        self.frame += 1
+        mx = -dy / dist * self.strafe
+        my = dx / dist * self.strafe
+        if dist < self.distance:
+            mx -= dx / dist
+            my -= dy / dist
+        elif dist > self.distance + 100:
+            mx += dx / dist
+            my += dy / dist
+        if my < -0.3:
+            held.append(pygame.K_w)
+        elif my > 0.3:
+            held.append(pygame.K_s)
+        if mx < -0.3:
+            held.append(pygame.K_a)
+        elif mx > 0.3:
+            held.append(pygame.K_d)
+        return KeyState(held)
+
+# Кэш отрисованного текста с вытеснением давно не использованных строк (LRU)
+class TextCache:
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.surfaces = OrderedDict()  # (шрифт, текст, сглаживание, цвет) -> Surface
+    
+    def render(self, get_font, font_name, text, antialias, color):
+        key = (font_name, text, antialias, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        
+        surface = get_font(font_name).render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.capacity:
+            self.surfaces.popitem(last=False)
+        return surface
+
+# Кэш больших поверхностей (фонов и т.п.) с вытеснением давно не использованных в пределах бюджета байт.
+# Пополняется и из потока предзагрузки, поэтому все операции идут под блокировкой
+class SurfaceCache:
+    def __init__(self, budget=SURFACE_CACHE_BUDGET):
+        self.budget = budget
+        self.surfaces = OrderedDict()
+        self.size = 0  # Сколько байт пикселей сейчас в кэше
+        self.last_used = None  # Ключ последней выданной поверхности: ее не вытесняем
+        self.lock = threading.Lock()
+    
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.surfaces
+    
+    def get(self, key):
+        """Возвращает поверхность или None, если ее нет в кэше"""
+        with self.lock:
+            surface = self.surfaces.get(key)
+            if surface is not None:
+                self.surfaces.move_to_end(key)
+                self.last_used = key
+            return surface
+    
+    def put(self, key, surface, used=False):
+        """Кладет поверхность в кэш и вытесняет старые, пока не уложимся в бюджет; used — поверхность
+        сразу выдается вызывающему. Только что добавленная и последняя выданная не вытесняются,
+        поэтому бюджет может быть превышен не больше чем на одну поверхность"""
+        with self.lock:
+            if used:
+                self.last_used = key
+            if key in self.surfaces:
+                self.surfaces.move_to_end(key)
+                return self.surfaces[key]
+            self.surfaces[key] = surface
+            self.size += surface.get_pitch() * surface.get_height()
+            for old in list(self.surfaces):
+                if self.size <= self.budget:
+                    break
+                if old not in (key, self.last_used):
+                    evicted = self.surfaces.pop(old)
+                    self.size -= evicted.get_pitch() * evicted.get_height()
+            return surface
+
+# Распределение звуковых эффектов по зарезервированным каналам микшера: не больше max_voices
+# голосов на звук, повторы в пределах SFX_COALESCE сливаются в один, а если свободных каналов нет,
+# новый звук вытесняет наименее важный (из равных — самый старый), но не важнее себя
+class VoiceManager:
+    def __init__(self, channels):
+        self.channels = channels  # Зарезервированные каналы pygame.mixer.Channel
+        self.voices = [None] * len(channels)  # Что звучит на канале: (звук, приоритет, время запуска)
+        self.last_played = {}  # Звук -> время последнего запуска
+    
+    def play(self, name, sound):
+        now = time.perf_counter()
+        if now - self.last_played.get(name, -SFX_COALESCE) < SFX_COALESCE:
+            return
+        _, max_voices, priority = SOUND_SPECS.get(name, (None, 1, 0))
+        
+        # Отмечаем каналы, на которых звук уже закончился
+        voices = self.voices
+        for i, voice in enumerate(voices):
+            if voice and not self.channels[i].get_busy():
+                voices[i] = None
+        
+        same = [i for i, voice in enumerate(voices) if voice and voice[0] == name]
+        if len(same) >= max_voices:
+            # Лимит голосов этого звука: перезапускаем самый старый из них
+            index = min(same, key=lambda i: voices[i][2])
+        elif None in voices:
+            index = voices.index(None)
+        else:
+            # Все каналы заняты: вытесняем самый старый голос с приоритетом не выше нашего
+            weaker = [i for i, voice in enumerate(voices) if voice[1] <= priority]
+            if not weaker:
+                return
+            index = min(weaker, key=lambda i: (voices[i][1], voices[i][2]))
+        
+        self.channels[index].play(sound)
+        voices[index] = (name, priority, now)
+        self.last_played[name] = now
+
+# Музыка: дорожки целиком раскодируются в фоновых потоках и переключаются плавным переходом
+# между двумя каналами. Ни один вызов не ждет загрузки: пока новая дорожка не готова, играет старая
+class MusicPlayer:
+    def __init__(self, tracks, channels):
+        self.tracks = tracks  # Имя дорожки -> путь к файлу (None, если файла нет)
+        self.channels = channels  # Два зарезервированных канала
+        self.active = 0  # Канал, на котором играет текущая дорожка
+        self.current = None  # Что играет сейчас
+        self.target = None  # Что должно играть (может еще раскодироваться)
+        self.decoded = OrderedDict()  # Имя -> pygame.mixer.Sound, от давно игравших к недавним
+        self.loading = set()
+        self.lock = threading.Lock()  # Потоки раскодирования сами запускают дождавшуюся дорожку
+    
+    def queue_track(self, name):
+        """Заранее раскодирует дорожку в фоновом потоке, чтобы переход на нее был мгновенным"""
+        path = self.tracks.get(name)
+        if not path:
+            return
+        with self.lock:
+            if name in self.decoded or name in self.loading:
+                return
+            self.loading.add(name)
+        threading.Thread(target=self.decode, args=(name, path), name=f"music:{name}", daemon=True).start()
+    
+    def decode(self, name, path):
+        try:
+            sound = pygame.mixer.Sound(path)
+        except Exception as e:
+            print(f"Ошибка при загрузке музыки {path}: {e}")
+            sound = None
+        with self.lock:
+            self.loading.discard(name)
+            if sound is None:
+                return
+            self.decoded[name] = sound
+            # Лишние дорожки выгружаем, кроме играющей и ожидаемой
+            for old in list(self.decoded):
+                if len(self.decoded) <= MUSIC_CACHE_TRACKS:
+                    break
+                if old not in (self.current, self.target, name):
+                    del self.decoded[old]
+            if self.target == name and self.current != name:
+                self.start(name)
+    
+    def transition(self, name, fade_ms=MUSIC_FADE_MS):
+        """Переходит на дорожку name (None — тишина). Если она еще не раскодирована,
+        переход начнется, как только она будет готова"""
+        with self.lock:
+            # Дорожка уже играет: не перезапускаем ее, а переход на другую дорожку, ждущую
+            # раскодирования, отменяется (decode() запустит ее, только если она все еще target)
+            if name == self.current:
+                self.target = name
+                return
+            # Повторный вызов ничего не меняет, пока дорожка раскодируется:
+            # дорожку, которая не загрузилась, пробуем раскодировать снова
+            if name == self.target and name in self.loading:
+                return
+            self.target = name
+            if name is None or not self.tracks.get(name):
+                self.fade_out(fade_ms)
+                return
+            if name in self.decoded:
+                self.start(name, fade_ms)
+                return
+        self.queue_track(name)
+    
+    def stop(self, fade_ms=MUSIC_FADE_MS):
+        """Плавно выключает музыку"""
+        self.transition(None, fade_ms)
+    
+    def start(self, name, fade_ms=MUSIC_FADE_MS):
+        # Вызывается под self.lock
+        self.fade_out(fade_ms)
+        self.active ^= 1
+        self.channels[self.active].play(self.decoded[name], loops=-1, fade_ms=fade_ms)
+        self.decoded.move_to_end(name)
+        self.current = name
+    
+    def fade_out(self, fade_ms):
+        # Вызывается под self.lock
+        if self.current is not None:
+            self.channels[self.active].fadeout(fade_ms)
+            self.current = None
+
 # Класс для хранения ассетов
 class Assets:
-    def __init__(self):
+    def __init__(self, cache_budget=SURFACE_CACHE_BUDGET, report=None):
+        self.report = report or StartupReport(enabled=False)
         self.images = {}
+        self.masks = {}  # Маски коллизий изображений (см. get_mask)
+        self.mask_tables = {}  # Таблицы префиксных сумм масок (см. get_mask_table)
+        self.collision_hash = None  # Хэш масок PIXEL_COLLISION (см. get_collision_hash)
         self.sounds = {}
         self.music = {}
-        self.fonts = {}
-        self.backgrounds = {}
+        self.fonts = {}  # Создаются при первом использовании (см. get_font)
+        self.muted = False  # Эффекты не звучат, пока шаги пересчитываются после отката
+        # В процессе симуляции (--pipeline): вызовы звука и предзагрузки для процесса отрисовки
+        self.remote_calls = None
+        # Каналы микшера: первые SFX_CHANNELS — эффекты, за ними MUSIC_CHANNELS — музыка.
+        # Все они зарезервированы, поэтому Sound.play() без канала их не займет
+        pygame.mixer.set_num_channels(SFX_CHANNELS + MUSIC_CHANNELS)
+        pygame.mixer.set_reserved(SFX_CHANNELS + MUSIC_CHANNELS)
+        channels = [pygame.mixer.Channel(i) for i in range(SFX_CHANNELS + MUSIC_CHANNELS)]
+        self.voices = VoiceManager(channels[:SFX_CHANNELS])  # Звуковые эффекты
+        self.music_player = MusicPlayer(self.music, channels[SFX_CHANNELS:])
+        self.font_paths = None  # Семейство шрифта -> путь к файлу (None — шрифт pygame по умолчанию)
+        self.text_cache = TextCache()
+        self.surface_cache = SurfaceCache(cache_budget)  # Фоны и LAZY_IMAGES, загружаются при первом обращении
+        self.pack_entries = None  # Изображения в пакете: ключ -> запись заголовка
+        self.atlas = None  # Все небольшие изображения на одной поверхности
+        self.atlas_rects = {}  # Имя изображения -> его область в атласе
+        self.pending = {}  # Ключи, поставленные в очередь предзагрузки: ключ -> threading.Event
+        self.pending_lock = threading.Lock()
+        self.prefetch_queue = None  # Очередь потока предзагрузки (поток запускается при первой просьбе)
+        self.loaded = threading.Event()  # Установлен, когда фоновая загрузка изображений и звуков закончена
         self.load_assets()
     
     def load_assets(self):
-        # Загрузка шрифтов
-        self.fonts["title"] = pygame.font.SysFont("Arial", 48)
-        self.fonts["medium"] = pygame.font.SysFont("Arial", 36)
-        self.fonts["small"] = pygame.font.SysFont("Arial", 24)
-        
-        # Загружаем изображения персонажей
-        self.images["player_1"] = self.create_image("player_1.png", (60, 60), RED)  # Osama Bin Laden
-        self.images["player_2"] = self.create_image("player_2.png", (60, 60), GREEN)  # Saddam Hussein
-        self.images["player_3"] = self.create_image("player_3.png", (60, 60), BLUE)  # Aiman AL-Zawahiri
-        
-        # Загружаем изображения врагов
-        self.images["enemy_1"] = self.create_image("enemy_1.png", (60, 60), YELLOW)  # Враг-преследователь
-        self.images["enemy_2"] = self.create_image("enemy_2.png", (60, 60), BROWN)   # Враг-стрелок
-        self.images["enemy_3"] = self.create_image("enemy_3.png", (60, 60), GRAY)    # Враг-охранник
-        
-        # Загружаем изображение босса
-        self.images["boss"] = self.create_image("boss.png", (100, 100), RED)
-        
-        # Загружаем изображения снарядов
-        self.images["bullet_player"] = self.create_image("bullet_player.png", (30, 30), WHITE)
-        self.images["bullet_enemy"] = self.create_image("bullet_enemy.png", (40, 40), RED)
-        
-        # Загружаем фоны уровней
-        self.backgrounds[1] = self.create_image("background_3.png", (SCREEN_WIDTH, SCREEN_HEIGHT), DARK_GRAY)
-        self.backgrounds[2] = self.create_image("background_2.png", (SCREEN_WIDTH, SCREEN_HEIGHT), (70, 70, 100))
-        self.backgrounds[3] = self.create_image("background_1.png", (SCREEN_WIDTH, SCREEN_HEIGHT), (100, 70, 70))
-        self.backgrounds[4] = self.create_image("background_4.png", (SCREEN_WIDTH, SCREEN_HEIGHT), (70, 100, 70))
-        self.backgrounds[5] = self.create_image("background_5.png", (SCREEN_WIDTH, SCREEN_HEIGHT), (100, 100, 50))
-        
-        # Загружаем изображение сердца
-        self.images["heart"] = self.create_image("heart.png", (80, 50), RED)
-        
-        # Загружаем музыку
+        # Пакет изображений открывается сразу: это только чтение заголовка
+        self.pack_entries = self.load_pack()
+        
+        # Музыка — это только пути к файлам, она нужна уже в меню
         self.music["menu"] = self.create_sound("menu_music.mp3", is_music=True)
         self.music["game"] = self.create_sound("game_music.mp3", is_music=True)
         self.music["boss"] = self.create_sound("boss_music.mp3", is_music=True)
         
-        # Загружаем звуковые эффекты
-        self.sounds["hit"] = self.create_sound("hit.wav")
-        self.sounds["enemy_death"] = self.create_sound("enemy_death.wav")
-        self.sounds["player_hurt"] = self.create_sound("player_hurt.wav")
-        self.sounds["victory"] = self.create_sound("victory.wav")
+        # Титульному экрану нужны только шрифты, остальное догружается в фоне
+        threading.Thread(target=self.load_deferred, name="assets", daemon=True).start()
+    
+    def load_deferred(self):
+        """Загружает изображения и звуковые эффекты в фоновом потоке"""
+        try:
+            # Небольшие изображения: из пакета, если он актуален, иначе из PNG.
+            # Фоны и LAZY_IMAGES загружаются при первом обращении (см. load_surface)
+            started = time.perf_counter()
+            images = {name: self.load_surface(name) for name in IMAGE_SPECS if name not in LAZY_IMAGES}
+            self.report.add_background("images", started)
+            started = time.perf_counter()
+            self.build_atlas(images)
+            self.report.add_background("atlas", started)
+            started = time.perf_counter()
+            for name, image in images.items():
+                self.masks[name] = self.create_mask(name, image)
+            self.report.add_background("masks", started)
+            
+            # Загружаем звуковые эффекты
+            started = time.perf_counter()
+            for name, (filename, max_voices, priority) in SOUND_SPECS.items():
+                self.sounds[name] = self.create_sound(filename)
+            self.report.add_background("sounds", started)
+        finally:
+            self.loaded.set()
+    
+    def build_atlas(self, images):
+        """Раскладывает изображения по полкам одного атласа (от высоких к низким) и публикует
+        их в self.images как подповерхности атласа"""
+        rects = {}
+        x = y = shelf_height = 0
+        for name in sorted(images, key=lambda name: -images[name].get_height()):
+            width, height = images[name].get_size()
+            if x + width > ATLAS_WIDTH:
+                x, y, shelf_height = 0, y + shelf_height, 0
+            rects[name] = pygame.Rect(x, y, width, height)
+            x += width
+            shelf_height = max(shelf_height, height)
         
+        atlas = pygame.Surface((ATLAS_WIDTH, y + shelf_height), pygame.SRCALPHA).convert_alpha()
+        # Атлас прозрачен, поэтому BLEND_RGBA_MAX копирует пиксели как есть, без смешивания альфы
+        atlas.blits([(images[name], rect, None, pygame.BLEND_RGBA_MAX) for name, rect in rects.items()], False)
+        self.atlas = atlas
+        self.atlas_rects = rects
+        self.images.update((name, atlas.subsurface(rect)) for name, rect in rects.items())
+    
+    def get_font(self, name):
+        """Возвращает шрифт по имени из FONT_SPECS, создавая его при первом обращении"""
+        font = self.fonts.get(name)
+        if font is None:
+            family, size = FONT_SPECS[name]
+            if self.font_paths is None:
+                self.font_paths = load_font_paths()
+            if family not in self.font_paths:
+                self.font_paths[family] = pygame.font.match_font(family)  # Сканирует шрифты системы
+                save_font_paths(self.font_paths)
+            font = self.fonts[name] = pygame.font.Font(self.font_paths[family], size)
+        return font
+    
     def create_image(self, name, size, default_color):
         """Создает изображение, если файл существует, или заглушку с указанным цветом"""
         try:
@@ -122,6 +678,109 @@ class Assets:
             surf.fill(default_color)
             return surf
     
+    def load_pack(self):
+        """Открывает пакет изображений через mmap. Сами изображения создаются в pack_surface без
+        декодирования PNG. Возвращает словарь ключ -> запись заголовка или None, если пакета нет или он устарел"""
+        try:
+            with open(PACK_FILE, "rb") as f:
+                pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        
+        entries = None
+        try:
+            if pack[:len(PACK_MAGIC)] != PACK_MAGIC:
+                raise ValueError("неверная сигнатура")
+            header_len = int.from_bytes(pack[len(PACK_MAGIC):len(PACK_MAGIC) + 4], "little")
+            header_start = len(PACK_MAGIC) + 4
+            data_start = header_start + header_len
+            header = json.loads(pack[header_start:data_start])
+            
+            # Пакет годен, только если совпадают формат пикселей экрана и хэш исходников
+            known = {entry["key"]: entry["source"] for entry in header["entries"]}
+            if (header["version"] != PACK_VERSION or header["format"] != display_pixel_format() or
+                    header["hash"] != pack_hash(header["format"], known)[0]):
+                return None
+            
+            entries = {entry["key"]: entry for entry in header["entries"]}
+            self.pack = pack
+            self.pack_format = header["format"]
+            self.pack_data = memoryview(pack)[data_start:]
+            return entries
+        except Exception as e:
+            print(f"Ошибка при загрузке пакета {PACK_FILE}: {e}")
+            return None
+        finally:
+            # Устаревший или битый пакет не держим открытым
+            if entries is None:
+                pack.close()
+    
+    def pack_surface(self, entry):
+        """Создает изображение поверх пикселей пакета"""
+        size = (entry["w"], entry["h"])
+        offset = entry["offset"]
+        surf = pygame.image.frombuffer(self.pack_data[offset:offset + entry["w"] * entry["h"] * 4],
+                                       size, self.pack_format)
+        # Непрозрачные фоны переводим в формат без альфа-канала: так их быстрее блитить
+        return surf.convert() if entry["opaque"] else surf
+    
+    def load_surface(self, key):
+        """Загружает изображение по ключу пакета ("boss", "background:3", ...): из пакета или из PNG"""
+        if self.pack_entries:
+            return self.pack_surface(self.pack_entries[key])
+        if key.startswith("background:"):
+            filename, color = BACKGROUND_SPECS[int(key.split(":")[1])]
+            # Фон блитится каждый кадр, поэтому сразу переводим его в формат экрана
+            return self.create_image(filename, (SCREEN_WIDTH, SCREEN_HEIGHT), color).convert_alpha()
+        filename, size, color = IMAGE_SPECS[key]
+        return self.create_image(filename, size, color)
+    
+    def get_cached(self, key):
+        """Возвращает изображение из кэша поверхностей; если его нет — дожидается предзагрузки или грузит сразу"""
+        surface = self.surface_cache.get(key)
+        if surface is None:
+            with self.pending_lock:
+                event = self.pending.get(key)
+            if event:
+                event.wait()
+                surface = self.surface_cache.get(key)
+            if surface is None:
+                surface = self.surface_cache.put(key, self.load_surface(key), used=True)
+        return surface
+    
+    def forward(self, method, *args):
+        """Откладывает вызов method для процесса отрисовки, если это процесс симуляции.
+        Возвращает True, если вызов отложен"""
+        if self.remote_calls is None:
+            return False
+        self.remote_calls.append((method, args))
+        return True
+    
+    def prefetch(self, key):
+        """Ставит изображение в очередь загрузки в фоновом потоке, если его еще нет в кэше"""
+        self.forward("prefetch", key)  # Изображение нужно и процессу отрисовки
+        if key in self.surface_cache:
+            return
+        with self.pending_lock:
+            if key in self.pending:
+                return
+            self.pending[key] = threading.Event()
+        if self.prefetch_queue is None:
+            self.prefetch_queue = queue.Queue()
+            threading.Thread(target=self.prefetch_worker, name="prefetch", daemon=True).start()
+        self.prefetch_queue.put(key)
+    
+    def prefetch_worker(self):
+        while True:
+            key = self.prefetch_queue.get()
+            try:
+                self.surface_cache.put(key, self.load_surface(key))
+            except Exception as e:
+                print(f"Ошибка при предзагрузке {key}: {e}")
+            finally:
+                with self.pending_lock:
+                    self.pending.pop(key).set()
+    
     def create_sound(self, name, is_music=False):
         """Создает объект звука или музыки, возвращает None, если файл не существует"""
         try:
@@ -137,45 +796,229 @@ class Assets:
             return None
     
     def get_image(self, name):
-        """Возвращает изображение по имени или заглушку, если не найдено"""
-        return self.images.get(name, pygame.Surface((30, 30)))
+        """Возвращает изображение по имени или заглушку, если не найдено.
+        Если изображение еще загружается в фоне, дожидается его"""
+        if name in LAZY_IMAGES:
+            return self.get_cached(name)
+        image = self.images.get(name)
+        if image is None and not self.loaded.is_set():
+            self.loaded.wait()
+            image = self.images.get(name)
+        return image if image is not None else pygame.Surface((30, 30))
+    
+    def create_mask(self, name, image):
+        """Маска коллизий изображения: по непрозрачным пикселям для PIXEL_COLLISION,
+        иначе заполненная целиком"""
+        if name in PIXEL_COLLISION:
+            return pygame.mask.from_surface(image)
+        return pygame.Mask(image.get_size(), fill=True)
+    
+    def get_mask(self, name):
+        """Возвращает маску коллизий изображения; считается один раз на изображение"""
+        mask = self.masks.get(name)
+        if mask is None:
+            mask = self.masks[name] = self.create_mask(name, self.get_image(name))
+        return mask
+    
+    def get_mask_table(self, name):
+        """Возвращает таблицу префиксных сумм маски изображения (см. mask_table)"""
+        table = self.mask_tables.get(name)
+        if table is None:
+            table = self.mask_tables[name] = mask_table(self.get_mask(name))
+        return table
+    
+    def get_collision_hash(self):
+        """CRC32 таблиц масок изображений из PIXEL_COLLISION. Исход столкновений зависит от картинок,
+        поэтому хэш пишется в записи и снимки и сверяется при их загрузке"""
+        if self.collision_hash is None:
+            checksum = 0
+            for name in sorted(PIXEL_COLLISION):
+                table = self.get_mask_table(name)
+                checksum = zlib.crc32(struct.pack("<ii", *table.shape), checksum)
+                checksum = zlib.crc32(table.astype("<i4").tobytes(), checksum)
+            self.collision_hash = checksum
+        return self.collision_hash
+    
+    def get_sprite(self, name):
+        """Возвращает (поверхность, область) для отрисовки изображения: атлас и прямоугольник в нем
+        или само изображение и None, если его нет в атласе"""
+        image = self.get_image(name)
+        rect = self.atlas_rects.get(name)
+        return (self.atlas, rect) if rect else (image, None)
+    
+    def render_text(self, font_name, text, color, antialias=True):
+        """Возвращает отрисованный текст из кэша"""
+        return self.text_cache.render(self.get_font, font_name, text, antialias, color)
     
     def get_background(self, level):
         """Возвращает фон для указанного уровня"""
-        return self.backgrounds.get(level, self.backgrounds.get(1))
+        return self.get_cached(f"background:{level if level in BACKGROUND_SPECS else 1}")
+    
+    def get_room_background(self, level, room):
+        """Фон уровня с камнями комнаты room. Собирается один раз на фон и раскладку и живет
+        в кэше поверхностей наравне с фонами, поэтому укладывается в его бюджет"""
+        level = level if level in BACKGROUND_SPECS else 1
+        key = f"room:{level}:{room.layout}"
+        surface = self.surface_cache.get(key)
+        if surface is None:
+            surface = self.get_background(level).copy()
+            room.draw(surface)
+            surface = self.surface_cache.put(key, surface, used=True)
+        return surface
+    
+    def prefetch_background(self, level):
+        """Заранее загружает фон уровня в фоновом потоке"""
+        self.prefetch(f"background:{level if level in BACKGROUND_SPECS else 1}")
     
     def play_sound(self, name):
-        """Воспроизводит звуковой эффект"""
-        if name in self.sounds and self.sounds[name]:
-            self.sounds[name].play()
+        """Воспроизводит звуковой эффект (пока звуки загружаются в фоне, эффекты не звучат)"""
+        if self.muted or self.forward("play_sound", name):
+            return
+        sound = self.sounds.get(name)
+        if sound:
+            self.voices.play(name, sound)
     
     def play_music(self, name):
-        """Воспроизводит музыку"""
-        if name in self.music and self.music[name]:
-            pygame.mixer.music.stop()
-            pygame.mixer.music.load(self.music[name])
-            pygame.mixer.music.play(-1)  # Зацикливаем музыку
+        """Переключает музыку на дорожку name; не блокирует, даже если она еще не загружена"""
+        if self.forward("play_music", name):
+            return
+        self.music_player.transition(name)
+    
+    def queue_music(self, name):
+        """Заранее загружает дорожку, на которую скоро понадобится переключиться"""
+        if self.forward("queue_music", name):
+            return
+        self.music_player.queue_track(name)
     
     def stop_music(self):
-        """Останавливает музыку"""
-        pygame.mixer.music.stop()
+        """Плавно останавливает музыку"""
+        if self.forward("stop_music"):
+            return
+        self.music_player.stop()
+
+def mask_table(mask):
+    """Таблица префиксных сумм маски размером (h + 1, w + 1): число непрозрачных пикселей
+    в области [x0, x1) × [y0, y1) равно t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]"""
+    width, height = mask.get_size()
+    table = np.zeros((height + 1, width + 1), dtype=np.int32)
+    if width and height:
+        # Биты маски получаем одним вызовом: непрозрачные пиксели — альфа 255, остальные — 0
+        surface = mask.to_surface(setcolor=(255, 255, 255, 255), unsetcolor=(0, 0, 0, 0))
+        bits = pygame.surfarray.array_alpha(surface).T > 0
+        table[1:, 1:] = bits.cumsum(0, dtype=np.int32).cumsum(1, dtype=np.int32)
+    return table
+
+def load_font_paths():
+    """Читает найденные ранее пути к шрифтам из FONT_CACHE_FILE; пропавшие файлы будут найдены заново"""
+    try:
+        with open(FONT_CACHE_FILE) as f:
+            paths = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {family: path for family, path in paths.items() if path is None or os.path.exists(path)}
+
+def save_font_paths(paths):
+    try:
+        with open(FONT_CACHE_FILE, "w") as f:
+            json.dump(paths, f)
+    except OSError as e:
+        print(f"Не удалось сохранить {FONT_CACHE_FILE}: {e}")
+
+# Формат пикселей для pygame.image.frombuffer, совпадающий с форматом экрана
+def display_pixel_format():
+    masks = pygame.Surface((1, 1), pygame.SRCALPHA).convert_alpha().get_masks()
+    formats = {
+        (0xFF0000, 0xFF00, 0xFF, 0xFF000000): "BGRA",
+        (0xFF, 0xFF00, 0xFF0000, 0xFF000000): "RGBA",
+    }
+    if sys.byteorder != "little":
+        return None
+    return formats.get(masks)
+
+# Все изображения, которые попадают в пакет: (ключ, файл, размер, цвет заглушки)
+def pack_specs():
+    specs = [(name, filename, size, color) for name, (filename, size, color) in IMAGE_SPECS.items()]
+    specs += [(f"background:{level}", filename, (SCREEN_WIDTH, SCREEN_HEIGHT), color)
+              for level, (filename, color) in BACKGROUND_SPECS.items()]
+    return specs
+
+def pack_hash(pixel_format, known=None):
+    """Хэш содержимого пакета: таблица изображений, формат пикселей и хэши исходных файлов.
+    known — сведения об исходниках из заголовка пакета: ключ -> [размер, mtime, хэш];
+    если размер и mtime файла не изменились, файл не перечитывается.
+    Возвращает (хэш, сведения об исходниках)"""
+    known = known or {}
+    sources = {}
+    for key, filename, size, color in pack_specs():
+        path = os.path.join(IMG_DIR, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            sources[key] = [0, 0, "missing"]
+            continue
+        previous = known.get(key)
+        if previous and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+            sources[key] = previous
+            continue
+        with open(path, "rb") as f:
+            sources[key] = [stat.st_size, stat.st_mtime_ns, hashlib.blake2b(f.read(), digest_size=16).hexdigest()]
+    
+    description = [PACK_VERSION, pixel_format,
+                   [(key, filename, size, color, sources[key][2]) for key, filename, size, color in pack_specs()]]
+    digest = hashlib.blake2b(json.dumps(description).encode(), digest_size=16).hexdigest()
+    return digest, sources
+
+def bake_assets(path=PACK_FILE):
+    """Собирает пакет: все изображения, уже уменьшенные до нужного размера, в формате экрана.
+    Возвращает число изображений и размер пакета в байтах"""
+    pixel_format = display_pixel_format()
+    if pixel_format is None:
+        raise RuntimeError("формат пикселей экрана не поддерживается пакетом")
+    digest, sources = pack_hash(pixel_format)
+    
+    entries = []
+    chunks = []
+    offset = 0
+    for key, filename, size, color in pack_specs():
+        surf = assets.create_image(filename, size, color).convert_alpha()
+        pixels = pygame.image.tobytes(surf, pixel_format)
+        # Если все пиксели непрозрачны, изображение будет загружено без альфа-канала
+        opaque = pixels[3::4].count(b"\xff") == size[0] * size[1]
+        entries.append({"key": key, "w": size[0], "h": size[1], "offset": offset,
+                        "opaque": opaque, "source": sources[key]})
+        chunks.append(pixels)
+        offset += len(pixels)
+    
+    # Файл: сигнатура, длина заголовка, JSON-заголовок, пиксели; смещения отсчитываются от конца заголовка
+    header = {"version": PACK_VERSION, "format": pixel_format, "hash": digest, "entries": entries}
+    header_bytes = json.dumps(header).encode()
+    with open(path, "wb") as f:
+        f.write(PACK_MAGIC)
+        f.write(len(header_bytes).to_bytes(4, "little"))
+        f.write(header_bytes)
+        for pixels in chunks:
+            f.write(pixels)
+    return len(entries), os.path.getsize(path)
 
 # Класс для игрока
 class Player(pygame.sprite.Sprite):
-    def __init__(self, player_type):
+    def __init__(self, player_type, bullets, slot=0):
         super().__init__()
         self.player_type = player_type
+        self.slot = slot  # Номер игрока: от него зависит строка сердец на экране
         self.image_name = f"player_{player_type}"
         self.image = assets.get_image(self.image_name)
+        self.sprite = assets.get_sprite(self.image_name)  # (атлас, область) для списка отрисовки
         self.rect = self.image.get_rect()
         self.rect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
+        self.prev_pos = self.rect.topleft  # Положение на прошлом шаге (для интерполяции)
         self.speed = 5
         self.health = 6
         self.max_health = 6
         self.damage = 1
         self.fire_rate = 10
         self.fire_delay = 0
-        self.bullets = pygame.sprite.Group()
+        self.bullets = bullets  # Общий пул пуль
         self.invincible = False
         self.invincible_timer = 0
         
@@ -194,34 +1037,27 @@ class Player(pygame.sprite.Sprite):
             self.damage = 2
             self.fire_rate = 15
     
-    def update(self):
-        # Обработка движения
-        keys = pygame.key.get_pressed()
+    def update(self, keys, room):
+        # Обработка движения в пределах экрана; камни комнаты не пускают игрока, но вдоль них можно скользить
+        dx = dy = 0
         if keys[pygame.K_w]:
-            self.rect.y -= self.speed
+            dy -= self.speed
         if keys[pygame.K_s]:
-            self.rect.y += self.speed
+            dy += self.speed
         if keys[pygame.K_a]:
-            self.rect.x -= self.speed
+            dx -= self.speed
         if keys[pygame.K_d]:
-            self.rect.x += self.speed
-        
-        # Ограничение движения по экрану
-        self.rect.x = max(0, min(self.rect.x, SCREEN_WIDTH - self.rect.width))
-        self.rect.y = max(0, min(self.rect.y, SCREEN_HEIGHT - self.rect.height))
+            dx += self.speed
+        room.slide(self.rect, dx, dy)
         
         # Обработка выстрелов
         if self.fire_delay > 0:
             self.fire_delay -= 1
         
-        keys = pygame.key.get_pressed()
         if (keys[pygame.K_UP] or keys[pygame.K_DOWN] or keys[pygame.K_LEFT] or keys[pygame.K_RIGHT]) and self.fire_delay == 0:
             self.shoot(keys)
             self.fire_delay = self.fire_rate
         
-        # Обновление пуль
-        self.bullets.update()
-        
         # Обработка неуязвимости после получения урона
         if self.invincible:
             self.invincible_timer -= 1
@@ -240,8 +1076,8 @@ class Player(pygame.sprite.Sprite):
             direction[0] = 1
         
         if direction != [0, 0]:
-            bullet = Bullet(self.rect.centerx, self.rect.centery, direction, True, self.damage)
-            self.bullets.add(bullet)
+            self.bullets.spawn(self.rect.centerx, self.rect.centery, direction, 10,
+                               BULLET_PLAYER, OWNER_PLAYER, self.damage)
             assets.play_sound("shoot")
     
     def take_damage(self, damage):
@@ -256,72 +1092,1140 @@ class Player(pygame.sprite.Sprite):
     def heal(self, amount):
         self.health = min(self.health + amount, self.max_health)
     
-    def draw_health(self, surface):
+    def health_rect(self):
+        """Область экрана, которую занимают сердца"""
+        heart_img = assets.get_image("heart")
+        hearts = self.max_health // 2
+        top = 10 + self.slot * (heart_img.get_height() + 5)
+        return pygame.Rect(10, top, (hearts - 1) * 25 + heart_img.get_width(), heart_img.get_height())
+    
+    def draw_health(self, surface, hearts):
+        """Рисует сердца на поверхность размером health_rect(); hearts — (полное, половина, пустое)"""
         heart_width = 20
         heart_spacing = 5
-        heart_img = assets.get_image("heart")
+        full_heart, half_heart, empty_heart = hearts
         
         for i in range(self.max_health // 2):
-            heart_x = 10 + i * (heart_width + heart_spacing)
-            heart_y = 10
+            heart_x = i * (heart_width + heart_spacing)
             
             # Полное сердце (2 хп)
             if self.health >= (i + 1) * 2:
-                surface.blit(heart_img, (heart_x, heart_y))
+                surface.blit(full_heart, (heart_x, 0))
             # Половина сердца (1 хп)
             elif self.health >= i * 2 + 1:
-                half_heart = pygame.Surface((heart_width // 2, heart_width))
-                half_heart.blit(heart_img, (0, 0))
-                surface.blit(half_heart, (heart_x, heart_y))
+                surface.blit(half_heart, (heart_x, 0))
             # Пустое сердце (0 хп)
             else:
-                empty_heart = pygame.Surface((heart_width, heart_width), pygame.SRCALPHA)
-                empty_heart.blit(heart_img, (0, 0))
-                empty_heart.fill((100, 100, 100, 150), None, pygame.BLEND_RGBA_MULT)
-                surface.blit(empty_heart, (heart_x, heart_y))
-
-# Класс для пуль
-class Bullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, direction, is_player_bullet, damage=1):
-        super().__init__()
-        self.is_player_bullet = is_player_bullet
-        self.image = assets.get_image("bullet_player" if is_player_bullet else "bullet_enemy")
-        self.rect = self.image.get_rect()
-        self.rect.center = (x, y)
-        self.speed = 10 if is_player_bullet else 5
+                surface.blit(empty_heart, (heart_x, 0))
+
+# Владельцы пуль: игрок, босс; враги комнаты получают номера 1, 2, ...
+OWNER_PLAYER = 0
+OWNER_BOSS = -1
+
+# Виды пуль (определяют изображение и размер)
+BULLET_PLAYER = 0
+BULLET_ENEMY = 1
+BULLET_IMAGES = ("bullet_player", "bullet_enemy")  # Изображение для каждого вида пули
+
+# Пул пуль: структура массивов NumPy вместо отдельного спрайта на каждую пулю
+class BulletPool:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        # Размеры берутся из таблицы изображений, чтобы не ждать их фоновой загрузки
+        self.sizes = np.array([IMAGE_SPECS[name][1] for name in BULLET_IMAGES], dtype=np.int32)
+        
+        # Позиция левого верхнего угла хранится в float, чтобы дробная скорость не терялась
+        self.x = np.zeros(capacity, dtype=np.float64)
+        self.y = np.zeros(capacity, dtype=np.float64)
+        self.vx = np.zeros(capacity, dtype=np.float64)
+        self.vy = np.zeros(capacity, dtype=np.float64)
+        # Положение на прошлом шаге (для интерполяции при отрисовке)
+        self.px = np.zeros(capacity, dtype=np.float64)
+        self.py = np.zeros(capacity, dtype=np.float64)
+        # Целочисленный прямоугольник для коллизий и отрисовки
+        self.left = np.zeros(capacity, dtype=np.int32)
+        self.top = np.zeros(capacity, dtype=np.int32)
+        self.w = np.zeros(capacity, dtype=np.int32)
+        self.h = np.zeros(capacity, dtype=np.int32)
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.damage = np.zeros(capacity, dtype=np.int32)
+        self.owner = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        
+        # Стек свободных слотов; занятые слоты лежат в диапазоне [0, high_water)
+        self.free_slots = np.arange(capacity - 1, -1, -1, dtype=np.int32)
+        self.free_count = capacity
+        self.high_water = 0
+    
+    def __len__(self):
+        return self.capacity - self.free_count
+    
+    def clear(self):
+        """Удаляет все пули"""
+        self.alive[:] = False
+        self.free_slots[:] = np.arange(self.capacity - 1, -1, -1, dtype=np.int32)
+        self.free_count = self.capacity
+        self.high_water = 0
+    
+    def spawn(self, x, y, direction, speed, kind, owner, damage=1):
+        """Выпускает пулю с центром в (x, y); возвращает номер слота или -1, если пул заполнен"""
+        if self.free_count == 0:
+            return -1
+        self.free_count -= 1
+        slot = int(self.free_slots[self.free_count])
+        self.high_water = max(self.high_water, slot + 1)
         
         # Нормализация вектора направления
         length = math.sqrt(direction[0]**2 + direction[1]**2)
         if length > 0:
-            self.direction = [direction[0]/length, direction[1]/length]
+            self.vx[slot] = direction[0] / length * speed
+            self.vy[slot] = direction[1] / length * speed
         else:
-            self.direction = [0, 0]
+            self.vx[slot] = 0
+            self.vy[slot] = 0
         
-        self.damage = damage
+        w, h = self.sizes[kind]
+        self.x[slot] = self.px[slot] = x - w // 2
+        self.y[slot] = self.py[slot] = y - h // 2
+        self.left[slot] = self.x[slot]
+        self.top[slot] = self.y[slot]
+        self.w[slot] = w
+        self.h[slot] = h
+        self.kind[slot] = kind
+        self.damage[slot] = damage
+        self.owner[slot] = owner
+        self.alive[slot] = True
+        return slot
     
-    def update(self):
-        # Движение пули
-        self.rect.x += self.direction[0] * self.speed
-        self.rect.y += self.direction[1] * self.speed
+    def spawn_many(self, x, y, dx, dy, speed, kind, owner, damage=1):
+        """Выпускает залп пуль из одной точки; dx, dy — массивы единичных направлений"""
+        count = min(len(dx), self.free_count)
+        if count == 0:
+            return
+        slots = self.free_slots[self.free_count - count:self.free_count]
+        self.free_count -= count
+        self.high_water = max(self.high_water, int(slots.max()) + 1)
+        
+        w, h = self.sizes[kind]
+        self.x[slots] = self.px[slots] = x - w // 2
+        self.y[slots] = self.py[slots] = y - h // 2
+        self.left[slots] = x - w // 2
+        self.top[slots] = y - h // 2
+        self.vx[slots] = np.asarray(dx[:count]) * speed
+        self.vy[slots] = np.asarray(dy[:count]) * speed
+        self.w[slots] = w
+        self.h[slots] = h
+        self.kind[slots] = kind
+        self.damage[slots] = damage
+        self.owner[slots] = owner
+        self.alive[slots] = True
+    
+    def release(self, slots):
+        """Возвращает слоты в пул"""
+        slots = slots[self.alive[slots]]
+        self.alive[slots] = False
+        self.free_slots[self.free_count:self.free_count + len(slots)] = slots
+        self.free_count += len(slots)
+        
+        # Сжимаем верхнюю границу, если хвост пула опустел
+        while self.high_water > 0 and not self.alive[self.high_water - 1]:
+            self.high_water -= 1
+    
+    def update(self, room=None):
+        """Двигает все пули одним шагом и удаляет вылетевшие за пределы экрана
+        и попавшие центром в камни комнаты room"""
+        n = self.high_water
+        if n == 0:
+            return
+        alive = self.alive[:n]
+        x, y = self.x[:n], self.y[:n]
+        self.px[:n] = x
+        self.py[:n] = y
+        x += self.vx[:n]
+        y += self.vy[:n]
+        self.left[:n] = np.floor(x + 0.5)
+        self.top[:n] = np.floor(y + 0.5)
         
         # Удаление пуль, вышедших за пределы экрана
-        if (self.rect.right < 0 or self.rect.left > SCREEN_WIDTH or
-            self.rect.bottom < 0 or self.rect.top > SCREEN_HEIGHT):
-            self.kill()
+        left, top = self.left[:n], self.top[:n]
+        out = alive & ((left + self.w[:n] < 0) | (left > SCREEN_WIDTH) |
+                       (top + self.h[:n] < 0) | (top > SCREEN_HEIGHT))
+        if room is not None and room.rects:
+            out |= alive & room.blocked_many(left + self.w[:n] // 2, top + self.h[:n] // 2, 1, 1)
+        if out.any():
+            self.release(np.flatnonzero(out).astype(np.int32))
+    
+    # Поля слотов, которые попадают в снимок состояния (только для живых пуль)
+    STATE_FIELDS = ("x", "y", "vx", "vy", "px", "py", "left", "top", "w", "h", "kind", "damage", "owner")
+    
+    def pack_state(self):
+        """Состояние пула в байтах: номера и поля живых слотов и стек свободных слотов.
+        Стек хранится без нетронутого начала (capacity - 1, capacity - 2, ...), которое остается от clear()"""
+        n, free_count = self.high_water, self.free_count
+        slots = np.flatnonzero(self.alive[:n]).astype(np.int32)
+        stack = self.free_slots[:free_count]
+        changed = np.flatnonzero(stack != np.arange(self.capacity - 1, self.capacity - 1 - free_count, -1))
+        untouched = int(changed[0]) if len(changed) else free_count
+        parts = [struct.pack("<iiii", n, free_count, untouched, len(slots)), slots.tobytes()]
+        parts += [getattr(self, name)[slots].tobytes() for name in self.STATE_FIELDS]
+        parts.append(stack[untouched:].tobytes())
+        return b"".join(parts)
+    
+    def unpack_state(self, data, offset):
+        """Восстанавливает пул из pack_state(); возвращает смещение за концом его данных"""
+        n, free_count, untouched, count = struct.unpack_from("<iiii", data, offset)
+        offset += 16
+        slots = np.frombuffer(data, np.int32, count, offset)
+        offset += count * 4
+        for name in self.STATE_FIELDS:
+            array = getattr(self, name)
+            array[slots] = np.frombuffer(data, array.dtype, count, offset)
+            offset += count * array.itemsize
+        self.alive[:] = False
+        self.alive[slots] = True
+        self.free_slots[:untouched] = np.arange(self.capacity - 1, self.capacity - 1 - untouched, -1)
+        self.free_slots[untouched:free_count] = np.frombuffer(data, np.int32, free_count - untouched, offset)
+        offset += (free_count - untouched) * 4
+        self.high_water, self.free_count = n, free_count
+        return offset
+    
+    def kill_owner(self, owner):
+        """Удаляет все пули владельца (например, убитого врага)"""
+        n = self.high_water
+        if n == 0:
+            return
+        slots = np.flatnonzero(self.alive[:n] & (self.owner[:n] == owner)).astype(np.int32)
+        self.release(slots)
+    
+    def blit_list(self, hostile, alpha=1.0):
+        """Список (атлас, позиция, область) для пуль игрока (hostile=False)
+        или пуль врагов и босса (hostile=True). alpha — доля пути от прошлого шага к текущему"""
+        n = self.high_water
+        if n == 0:
+            return []
+        mine = self.owner[:n] != OWNER_PLAYER if hostile else self.owner[:n] == OWNER_PLAYER
+        slots = np.flatnonzero(self.alive[:n] & mine)
+        if alpha >= 1.0:
+            left, top = self.left[slots], self.top[slots]
+        else:
+            px, py = self.px[slots], self.py[slots]
+            left = np.floor(px + (self.x[slots] - px) * alpha + 0.5).astype(np.int32)
+            top = np.floor(py + (self.y[slots] - py) * alpha + 0.5).astype(np.int32)
+        sprites = [assets.get_sprite(name) for name in BULLET_IMAGES]
+        return [(sprites[kind][0], (x, y), sprites[kind][1]) for kind, x, y in
+                zip(self.kind[slots].tolist(), left.tolist(), top.tolist())]
+
+# Вспышки частиц: событие забега (см. Game.event) -> параметры вспышки.
+#   count — частиц во вспышке, speed и life — диапазоны начальной скорости (пикселей за шаг)
+#   и времени жизни (шагов); drag — доля скорости, остающаяся после шага; gravity — ускорение вниз.
+#   К концу жизни частица тускнеет ступенями (PARTICLE_FADE_LEVELS заготовок на вспышку)
+PARTICLE_EMITTERS = {
+    "enemy_hit": {"color": YELLOW, "size": 3, "count": 8, "speed": (1.0, 3.0), "life": (8, 16)},
+    "enemy_death": {"color": (255, 120, 40), "size": 4, "count": 40, "speed": (1.0, 5.0), "life": (20, 40),
+                    "gravity": 0.05},
+    "boss_hit": {"color": (255, 230, 150), "size": 3, "count": 6, "speed": (1.0, 4.0), "life": (8, 16)},
+    "boss_phase": {"color": (190, 90, 255), "size": 5, "count": 400, "speed": (2.0, 9.0), "life": (40, 90),
+                   "drag": 0.95},
+    "boss_death": {"color": (255, 200, 80), "size": 5, "count": 1200, "speed": (1.0, 12.0), "life": (60, 120),
+                   "drag": 0.95, "gravity": 0.03},
+    "player_hurt": {"color": RED, "size": 3, "count": 24, "speed": (1.0, 4.0), "life": (15, 30)},
+}
+PARTICLE_FADE_LEVELS = 8
+PARTICLE_CAPACITY = 16384
+
+# Параметры вспышки частиц (см. PARTICLE_EMITTERS); row — номер строки заготовок вспышки
+class ParticleEmitter:
+    def __init__(self, row, color, size, count, speed, life, drag=0.9, gravity=0.0):
+        self.row = row
+        self.color = color
+        self.size = size
+        self.count = count
+        self.speed = speed
+        self.life = life
+        self.drag = drag
+        self.gravity = gravity
+
+PARTICLE_BURSTS = {name: ParticleEmitter(row, **spec) for row, (name, spec) in enumerate(PARTICLE_EMITTERS.items())}
+
+# Пул частиц: структура массивов NumPy, живые частицы — в начале массивов, [0, count).
+# Все массивы, включая временные, выделяются заранее: шаг и вспышка работают на месте.
+# Частицы — только эффект отрисовки: у них свой генератор случайных чисел, и в снимок состояния они не входят
+class ParticlePool:
+    FIELDS = ("x", "y", "vx", "vy", "life", "max_life", "drag", "gravity", "row")
+    
+    def __init__(self, capacity=PARTICLE_CAPACITY, seed=None):
+        self.capacity = capacity
+        self.count = 0
+        self.dropped = 0  # Частиц, которым не хватило места
+        # Свой генератор: частицы только рисуются и не должны сдвигать случайность забега.
+        # Отрицательное зерно, как в random.Random, берется по модулю
+        self.rng = np.random.default_rng(None if seed is None else abs(seed))
+        # Левый верхний угол заготовки, скорость, оставшееся и полное время жизни (шагов)
+        self.x = np.zeros(capacity, dtype=np.float32)
+        self.y = np.zeros(capacity, dtype=np.float32)
+        self.vx = np.zeros(capacity, dtype=np.float32)
+        self.vy = np.zeros(capacity, dtype=np.float32)
+        self.life = np.zeros(capacity, dtype=np.float32)
+        self.max_life = np.ones(capacity, dtype=np.float32)
+        self.drag = np.zeros(capacity, dtype=np.float32)
+        self.gravity = np.zeros(capacity, dtype=np.float32)
+        self.row = np.zeros(capacity, dtype=np.int32)  # Строка заготовок (ParticleEmitter.row)
+        # Временные массивы
+        self.scratch = np.zeros(capacity, dtype=np.float32)
+        # Куда сдвигается каждая частица при удалении погасших; погасшие уходят в лишний последний элемент
+        self.compacted = {name: np.zeros(capacity + 1, dtype=getattr(self, name).dtype) for name in self.FIELDS}
+        self.target = np.zeros(capacity, dtype=np.intp)
+        self.dead = np.zeros(capacity, dtype=bool)
+        self.stamp = np.zeros(capacity, dtype=np.int32)
+        self.left = np.zeros(capacity, dtype=np.int32)
+        self.top = np.zeros(capacity, dtype=np.int32)
+        self.stamps = None  # Заготовки: PARTICLE_FADE_LEVELS на вспышку, от самой тусклой к яркой
+    
+    def __len__(self):
+        return self.count
+    
+    def clear(self, seed=None):
+        """Удаляет все частицы; с seed генератор начинается заново, и кадры забега повторяются"""
+        self.count = 0
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+    
+    def emit(self, name, x, y):
+        """Вспышка name (из PARTICLE_EMITTERS) с центром в (x, y)"""
+        emitter = PARTICLE_BURSTS[name]
+        n = self.count
+        k = min(emitter.count, self.capacity - n)
+        self.dropped += emitter.count - k
+        if k <= 0:
+            return
+        part = slice(n, n + k)
+        scratch = self.scratch[:k]
+        
+        # Направление и скорость — равномерно
+        self.rng.random(dtype=np.float32, out=scratch)
+        scratch *= 2 * np.pi
+        np.cos(scratch, out=self.vx[part])
+        np.sin(scratch, out=self.vy[part])
+        low, high = emitter.speed
+        self.rng.random(dtype=np.float32, out=scratch)
+        scratch *= high - low
+        scratch += low
+        self.vx[part] *= scratch
+        self.vy[part] *= scratch
+        
+        low, high = emitter.life
+        life = self.life[part]
+        self.rng.random(dtype=np.float32, out=life)
+        life *= high - low
+        life += low
+        self.max_life[part] = life
+        
+        self.x[part] = x - emitter.size / 2
+        self.y[part] = y - emitter.size / 2
+        self.drag[part] = emitter.drag
+        self.gravity[part] = emitter.gravity
+        self.row[part] = emitter.row
+        self.count = n + k
+    
+    def update(self, steps=1):
+        """Сдвигает частицы на steps шагов симуляции и убирает погасшие"""
+        n = self.count
+        if not n:
+            return
+        x, y, vx, vy = self.x[:n], self.y[:n], self.vx[:n], self.vy[:n]
+        life, drag, scratch = self.life[:n], self.drag[:n], self.scratch[:n]
+        
+        np.multiply(vx, steps, out=scratch)
+        x += scratch
+        np.multiply(self.gravity[:n], steps, out=scratch)
+        vy += scratch
+        np.multiply(vy, steps, out=scratch)
+        y += scratch
+        np.power(drag, steps, out=scratch)
+        vx *= scratch
+        vy *= scratch
+        life -= steps
+        
+        # Живые частицы сдвигаются в начало массивов с сохранением порядка: номер места — число
+        # живых до частицы включительно минус один
+        dead, target = self.dead[:n], self.target[:n]
+        np.greater(life, 0, out=target, casting="unsafe")
+        np.cumsum(target, out=target)
+        alive = int(target[-1])
+        if alive < n:
+            target -= 1
+            np.less_equal(life, 0, out=dead)
+            np.copyto(target, self.capacity, where=dead)
+            for name in self.FIELDS:
+                array, compacted = getattr(self, name), self.compacted[name]
+                np.put(compacted, target, array[:n])
+                array[:alive] = compacted[:alive]
+            self.count = alive
+    
+    def create_stamps(self):
+        """Заготовки частиц: круг цвета вспышки с прозрачностью ступени"""
+        self.stamps = []
+        for emitter in PARTICLE_BURSTS.values():
+            radius = emitter.size / 2
+            for level in range(PARTICLE_FADE_LEVELS):
+                stamp = pygame.Surface((emitter.size, emitter.size), pygame.SRCALPHA)
+                alpha = 255 * (level + 1) // PARTICLE_FADE_LEVELS
+                pygame.draw.circle(stamp, (*emitter.color, alpha), (radius, radius), radius)
+                self.stamps.append(stamp.convert_alpha())
+    
+    def blit_list(self):
+        """Список (заготовка, позиция) для всех живых частиц"""
+        n = self.count
+        if not n:
+            return []
+        if self.stamps is None:
+            self.create_stamps()
+        # Заготовка: строка вспышки и ступень яркости по доле оставшейся жизни
+        scratch, stamp, left, top = self.scratch[:n], self.stamp[:n], self.left[:n], self.top[:n]
+        np.divide(self.life[:n], self.max_life[:n], out=scratch)
+        scratch *= PARTICLE_FADE_LEVELS
+        np.copyto(stamp, scratch, casting="unsafe")
+        np.minimum(stamp, PARTICLE_FADE_LEVELS - 1, out=stamp)
+        np.multiply(self.row[:n], PARTICLE_FADE_LEVELS, out=left)
+        stamp += left
+        np.copyto(left, self.x[:n], casting="unsafe")
+        np.copyto(top, self.y[:n], casting="unsafe")
+        return list(zip(map(self.stamps.__getitem__, stamp.tolist()), zip(left.tolist(), top.tolist())))
+
+# Равномерная сетка (spatial hash) для широкой фазы всех проверок коллизий
+class SpatialHash:
+    # При меньшем числе пар (пуля, сущность) сетка не строится: перебрать все пары дешевле,
+    # чем разложить их по ячейкам (обычная комната — несколько врагов и десятки пуль)
+    BRUTE_FORCE_PAIRS = 1024
+    
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.brute_force = True  # Сетка не построена, запросы перебирают все пули и сущности
+        # Крайние ячейки собирают все, что вылезло за пределы экрана
+        self.cols = SCREEN_WIDTH // cell_size + 3
+        self.rows = SCREEN_HEIGHT // cell_size + 3
+        self.bullets = None
+        self.max_w = 0
+        self.max_h = 0
+        
+        # Пули: живые слоты и их ячейки, а также те же слоты, отсортированные по ячейкам
+        self.slots = np.zeros(0, dtype=np.int32)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.sorted_slots = self.slots
+        self.cell_start = [0] * (self.cols * self.rows + 1)
+        
+        # Сущности (враги, босс): ячейка -> список, а также те же пары в виде массивов
+        self.entity_list = []
+        self.entities = {}
+        self.entity_boxes = []
+        self.entity_rects = np.zeros((0, 4), dtype=np.int64)
+        self.entity_keys = np.zeros(0, dtype=np.int64)
+        self.entity_index = np.zeros(0, dtype=np.int64)
+        
+        # Маски для попиксельной проверки и флаги, нужна ли она (по виду пули и по сущности).
+        # solid — маска сущности непрозрачна целиком, и для нее хватает таблицы маски пули
+        self.bullet_masks = []
+        self.bullet_tables = None  # Таблицы префиксных сумм масок пуль по видам, (вид, y, x)
+        self.bullet_pixel = np.zeros(len(BULLET_IMAGES), dtype=bool)
+        self.entity_masks = []
+        self.entity_pixel = np.zeros(0, dtype=bool)
+        self.entity_solid = np.zeros(0, dtype=bool)
+        self.mask_info = {}  # Имя изображения -> (pixel, solid)
+    
+    def cell_range(self, left, top, right, bottom):
+        """Диапазон ячеек (включительно), покрывающий прямоугольник"""
+        size = self.cell_size
+        c0 = min(max(left // size + 1, 0), self.cols - 1)
+        c1 = min(max(right // size + 1, 0), self.cols - 1)
+        r0 = min(max(top // size + 1, 0), self.rows - 1)
+        r1 = min(max(bottom // size + 1, 0), self.rows - 1)
+        return c0, c1, r0, r1
+    
+    def rebuild(self, bullets, entities):
+        """Запоминает живые пули и сущности кадра и, если пар много, раскладывает их по ячейкам;
+        вызывается раз в кадр"""
+        self.bullets = bullets
+        n = bullets.high_water
+        slots = np.flatnonzero(bullets.alive[:n]).astype(np.int32)
+        
+        self.slots = slots
+        self.entity_list = list(entities)
+        # Прямоугольники сущностей (left, top, right, bottom) списком и массивом
+        self.entity_boxes = [(entity.rect.left, entity.rect.top, entity.rect.right, entity.rect.bottom)
+                             for entity in self.entity_list]
+        self.entity_rects = np.array(self.entity_boxes, dtype=np.int64).reshape(-1, 4)
+        self.brute_force = len(slots) * len(self.entity_list) <= self.BRUTE_FORCE_PAIRS
+        if not self.brute_force:
+            self.build_grid(bullets, slots)
+        
+        if self.bullet_tables is None:
+            self.bullet_masks = [assets.get_mask(name) for name in BULLET_IMAGES]
+            self.bullet_pixel = np.array([name in PIXEL_COLLISION for name in BULLET_IMAGES])
+            tables = [assets.get_mask_table(name) for name in BULLET_IMAGES]
+            height = max(table.shape[0] for table in tables)
+            width = max(table.shape[1] for table in tables)
+            self.bullet_tables = np.zeros((len(tables), height, width), dtype=np.int32)
+            for kind, table in enumerate(tables):
+                self.bullet_tables[kind, :table.shape[0], :table.shape[1]] = table
+        self.entity_masks = [assets.get_mask(entity.image_name) for entity in self.entity_list]
+        self.entity_pixel, self.entity_solid = self.mask_flags(self.entity_list)
+    
+    def build_grid(self, bullets, slots):
+        """Раскладывает пули slots и сущности по ячейкам сетки"""
+        # Пуля попадает в ячейку своего левого верхнего угла, а запросы расширяются на размер пули
+        if len(slots):
+            size = self.cell_size
+            cx = np.minimum(np.maximum(bullets.left[slots] // size + 1, 0), self.cols - 1)
+            cy = np.minimum(np.maximum(bullets.top[slots] // size + 1, 0), self.rows - 1)
+            self.keys = cy.astype(np.int64) * self.cols + cx
+            self.sorted_slots = slots[np.argsort(self.keys, kind="stable")]
+            counts = np.bincount(self.keys, minlength=self.cols * self.rows)
+            self.cell_start = [0] + np.cumsum(counts).tolist()
+            self.max_w = int(bullets.w[slots].max())
+            self.max_h = int(bullets.h[slots].max())
+        else:
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.sorted_slots = slots
+            self.cell_start = [0] * (self.cols * self.rows + 1)
+        
+        # Сущность попадает во все ячейки, куда может попасть левый верхний угол задевающей ее пули
+        self.entities = {}
+        keys, index = [], []
+        cols = self.cols
+        for i, entity in enumerate(self.entity_list):
+            rect = entity.rect
+            c0, c1, r0, r1 = self.cell_range(rect.left - self.max_w, rect.top - self.max_h,
+                                             rect.right - 1, rect.bottom - 1)
+            for row in range(r0, r1 + 1):
+                for col in range(c0, c1 + 1):
+                    key = row * cols + col
+                    self.entities.setdefault(key, []).append(entity)
+                    keys.append(key)
+                    index.append(i)
+        keys = np.array(keys, dtype=np.int64)
+        order = np.argsort(keys, kind="stable")
+        self.entity_keys = keys[order]
+        self.entity_index = np.array(index, dtype=np.int64)[order]
+    
+    def mask_flags(self, entities):
+        """Флаги (pixel, solid) сущностей: нужна ли попиксельная проверка и сплошная ли маска"""
+        info = self.mask_info
+        flags = []
+        for entity in entities:
+            name = entity.image_name
+            if name not in info:
+                table = assets.get_mask_table(name)
+                height, width = table.shape
+                info[name] = (name in PIXEL_COLLISION, table[-1, -1] == (height - 1) * (width - 1))
+            flags.append(info[name])
+        flags = np.array(flags, dtype=bool).reshape(-1, 2)
+        return flags[:, 0], flags[:, 1]
+    
+    def refine(self, hits, slots, rects, which, masks, pixel, solid):
+        """Снимает попадания пуль slots, чьи прямоугольники пересеклись с rects (left, top,
+        right, bottom) сущностей с номерами which, но маски не пересеклись. masks, pixel,
+        solid — маски сущностей и их флаги (см. mask_flags). Пары, где обе стороны
+        сталкиваются прямоугольником, не проверяются"""
+        bullets = self.bullets
+        kinds = bullets.kind[slots]
+        pixel, solid = pixel[which], solid[which]
+        check = hits & (pixel | self.bullet_pixel[kinds])
+        if not check.any():
+            return hits
+        hits = hits.copy()
+        
+        # Сущность со сплошной маской: считаем пиксели маски пули внутри прямоугольника
+        # сущности по таблице префиксных сумм — сразу для всех таких пар
+        fast = check & (solid | ~pixel)
+        if fast.any():
+            index = np.flatnonzero(fast)
+            slot, kind, rect = slots[index], kinds[index], rects[index]
+            left, top = bullets.left[slot], bullets.top[slot]
+            width, height = bullets.w[slot], bullets.h[slot]
+            # Прямоугольники уже пересекаются, поэтому обрезать достаточно с одной стороны
+            x0 = np.maximum(rect[:, 0] - left, 0)
+            x1 = np.minimum(rect[:, 2] - left, width)
+            y0 = np.maximum(rect[:, 1] - top, 0)
+            y1 = np.minimum(rect[:, 3] - top, height)
+            table = self.bullet_tables
+            count = table[kind, y1, x1] - table[kind, y0, x1] - table[kind, y1, x0] + table[kind, y0, x0]
+            hits[index[count == 0]] = False
+        
+        # Остальные пары — через Mask.overlap по одной
+        bullet_masks = self.bullet_masks
+        for i in np.flatnonzero(check & ~fast).tolist():
+            slot = slots[i]
+            offset = (int(bullets.left[slot] - rects[i, 0]), int(bullets.top[slot] - rects[i, 1]))
+            if masks[which[i]].overlap(bullet_masks[kinds[i]], offset) is None:
+                hits[i] = False
+        return hits
+    
+    def collide_groups(self, owner):
+        """Удаляет пули владельца owner, задевшие сущности. Пуля, задевшая несколько сущностей,
+        достается первой из них по порядку, как при поочередных вызовах spritecollide.
+        Возвращает словарь сущность -> список урона"""
+        bullets = self.bullets
+        slots = self.slots
+        if not len(slots) or not self.entity_list:
+            return {}
+        mine = bullets.alive[slots] & (bullets.owner[slots] == owner)
+        if not mine.any():
+            return {}
+        slots = slots[mine]
+        
+        if self.brute_force:
+            # Перебор всех пар на простых числах: при нескольких десятках пар это дешевле вызовов NumPy
+            left, top = bullets.left[slots], bullets.top[slots]
+            pairs = [(slot, i) for slot, x0, y0, x1, y1 in zip(slots.tolist(), left.tolist(), top.tolist(),
+                                                               (left + bullets.w[slots]).tolist(),
+                                                               (top + bullets.h[slots]).tolist())
+                     for i, (e_x0, e_y0, e_x1, e_y1) in enumerate(self.entity_boxes)
+                     if x0 < e_x1 and x1 > e_x0 and y0 < e_y1 and y1 > e_y0]
+            if not pairs:
+                return {}
+            pair_slot, pair_entity = np.array(pairs, dtype=np.int32).T
+            rects = self.entity_rects[pair_entity]
+            hits = np.ones(len(pairs), dtype=bool)
+        else:
+            # Пары (пуля, сущность) из общих ячеек
+            keys = self.keys[mine]
+            first = np.searchsorted(self.entity_keys, keys, "left")
+            counts = np.searchsorted(self.entity_keys, keys, "right") - first
+            total = int(counts.sum())
+            if total == 0:
+                return {}
+            pair_slot = np.repeat(slots, counts)
+            offsets = np.repeat(first - (np.cumsum(counts) - counts), counts)
+            pair_entity = self.entity_index[np.arange(total) + offsets]
+            
+            # Точная проверка пересечения прямоугольников
+            rects = self.entity_rects[pair_entity]
+            left, top = bullets.left[pair_slot], bullets.top[pair_slot]
+            hits = ((left < rects[:, 2]) & (left + bullets.w[pair_slot] > rects[:, 0]) &
+                    (top < rects[:, 3]) & (top + bullets.h[pair_slot] > rects[:, 1]))
+            if not hits.any():
+                return {}
+        # Попиксельная проверка только для пар, прошедших проверку прямоугольников
+        hits = self.refine(hits, pair_slot, rects, pair_entity, self.entity_masks,
+                           self.entity_pixel, self.entity_solid)
+        if not hits.any():
+            return {}
+        pair_slot, pair_entity = pair_slot[hits], pair_entity[hits]
+        order = np.lexsort((pair_entity, pair_slot))
+        pair_slot, pair_entity = pair_slot[order], pair_entity[order]
+        unique = np.ones(len(pair_slot), dtype=bool)
+        unique[1:] = pair_slot[1:] != pair_slot[:-1]
+        pair_slot, pair_entity = pair_slot[unique], pair_entity[unique]
+        
+        damage = bullets.damage[pair_slot]
+        bullets.release(pair_slot)
+        result = {}
+        for i, value in zip(pair_entity.tolist(), damage.tolist()):
+            result.setdefault(self.entity_list[i], []).append(value)
+        return result
+    
+    def collide_hostile(self, entity):
+        """Удаляет пули врагов и босса, задевшие сущность (игрока). Возвращает (владельцы, урон)"""
+        bullets = self.bullets
+        rect = entity.rect
+        if self.brute_force:
+            # Перебор пуль на простых числах (как в collide_groups); дальше идут только задевшие rect
+            left, top = bullets.left[self.slots], bullets.top[self.slots]
+            slots = np.array([slot for slot, x0, y0, x1, y1 in zip(self.slots.tolist(), left.tolist(), top.tolist(),
+                                                                   (left + bullets.w[self.slots]).tolist(),
+                                                                   (top + bullets.h[self.slots]).tolist())
+                              if x0 < rect.right and x1 > rect.left and y0 < rect.bottom and y1 > rect.top],
+                             dtype=np.int32)
+        else:
+            c0, c1, r0, r1 = self.cell_range(rect.left - self.max_w, rect.top - self.max_h,
+                                             rect.right - 1, rect.bottom - 1)
+            start = self.cell_start
+            cols = self.cols
+            ranges = []
+            for row in range(r0, r1 + 1):
+                first, last = start[row * cols + c0], start[row * cols + c1 + 1]
+                if first < last:
+                    ranges.append(self.sorted_slots[first:last])
+            slots = np.concatenate(ranges) if len(ranges) > 1 else ranges[0] if ranges else self.slots[:0]
+        if not len(slots):
+            return bullets.owner[:0], bullets.damage[:0]
+        
+        # Точная проверка пересечения прямоугольников для кандидатов
+        left, top = bullets.left[slots], bullets.top[slots]
+        hits = (bullets.alive[slots] & (bullets.owner[slots] != OWNER_PLAYER) &
+                (left < rect.right) & (left + bullets.w[slots] > rect.left) &
+                (top < rect.bottom) & (top + bullets.h[slots] > rect.top))
+        if not hits.any():
+            return bullets.owner[:0], bullets.damage[:0]
+        count = len(slots)
+        rects = np.broadcast_to(np.array([rect.left, rect.top, rect.right, rect.bottom]), (count, 4))
+        hits = self.refine(hits, slots, rects, np.zeros(count, dtype=np.int64),
+                           [assets.get_mask(entity.image_name)], *self.mask_flags((entity,)))
+        if not hits.any():
+            return bullets.owner[:0], bullets.damage[:0]
+        
+        slots = np.sort(slots[hits])
+        owners, damage = bullets.owner[slots], bullets.damage[slots]
+        bullets.release(slots)
+        return owners, damage
+    
+    def collide_entities(self, other):
+        """Множество сущностей, которых касается other (игрок): пересечение прямоугольников,
+        а затем масок, если хотя бы одна из сторон в PIXEL_COLLISION"""
+        rect = other.rect
+        if self.brute_force:
+            candidates = {entity for entity in self.entity_list if rect.colliderect(entity.rect)}
+        else:
+            c0, c1, r0, r1 = self.cell_range(rect.left, rect.top, rect.right - 1, rect.bottom - 1)
+            candidates = set()
+            for row in range(r0, r1 + 1):
+                for col in range(c0, c1 + 1):
+                    for entity in self.entities.get(row * self.cols + col, ()):
+                        if rect.colliderect(entity.rect):
+                            candidates.add(entity)
+        if not candidates:
+            return candidates
+        
+        mask = assets.get_mask(other.image_name)
+        pixel = other.image_name in PIXEL_COLLISION
+        found = set()
+        for entity in candidates:
+            if pixel or entity.image_name in PIXEL_COLLISION:
+                offset = (entity.rect.left - rect.left, entity.rect.top - rect.top)
+                if mask.overlap(assets.get_mask(entity.image_name), offset) is None:
+                    continue
+            found.add(entity)
+        return found
+
+# Раскладки камней в комнатах: ROOM_ROWS строк по ROOM_COLUMNS клеток, "#" — камень.
+# Середина комнаты (там появляются игроки и босс) всегда свободна, проходы не уже двух клеток
+ROOM_LAYOUTS = {
+    "open": (
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+    ),
+    "pillars": (
+        "....................",
+        "....................",
+        "....................",
+        "...##..........##...",
+        "...##..........##...",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "...##..........##...",
+        "...##..........##...",
+        "....................",
+        "....................",
+        "....................",
+    ),
+    "walls": (
+        "....................",
+        "....................",
+        "....#..........#....",
+        "....#..........#....",
+        "....#..........#....",
+        "....#..........#....",
+        "....................",
+        "....................",
+        "....................",
+        "....#..........#....",
+        "....#..........#....",
+        "....#..........#....",
+        "....#..........#....",
+        "....................",
+        "....................",
+    ),
+    "alcove": (
+        "....................",
+        "....................",
+        ".....##########.....",
+        ".....#........#.....",
+        ".....#........#.....",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "..##............##..",
+        "..##............##..",
+        "..##............##..",
+        "....................",
+        "....................",
+    ),
+    "rocks": (
+        "....................",
+        "..##.......#........",
+        "..##.......#........",
+        "...............##...",
+        ".....#..............",
+        ".....#..............",
+        "....................",
+        "..............#.....",
+        ".##...........#.....",
+        ".##.................",
+        ".........#..........",
+        ".........#.....##...",
+        "...##...............",
+        "...##...............",
+        "....................",
+    ),
+    # Комната босса: крупному боссу нужны проходы шире, поэтому камни только по углам
+    "arena": (
+        "....................",
+        "....................",
+        "..##............##..",
+        "..##............##..",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "....................",
+        "..##............##..",
+        "..##............##..",
+        "....................",
+        "....................",
+    ),
+}
+ROOM_LAYOUT_NAMES = tuple(ROOM_LAYOUTS)  # В снимке раскладка хранится номером в этом списке
+BOSS_LAYOUT = "arena"
+ENEMY_LAYOUTS = tuple(name for name in ROOM_LAYOUTS if name != BOSS_LAYOUT)  # Из них выбираются обычные комнаты
+ROOM_TILE = 40
+ROOM_COLUMNS = SCREEN_WIDTH // ROOM_TILE
+ROOM_ROWS = SCREEN_HEIGHT // ROOM_TILE
+ROCK_COLOR = (120, 100, 80)
+
+# Поле направлений строится на сетке вдвое мельче сетки камней, чтобы враги плавно огибали углы
+FLOW_CELL = ROOM_TILE // 2
+FLOW_COLUMNS = SCREEN_WIDTH // FLOW_CELL
+FLOW_ROWS = SCREEN_HEIGHT // FLOW_CELL
+# Ходы между клетками: сначала по осям, потом по диагоналям (при равной дистанции выбирается ход по оси)
+FLOW_STEPS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+FLOW_CACHE_FIELDS = 32  # Сколько полей (по клеткам игроков) помнить для каждой сетки проходимости
+LINE_OF_SIGHT_STEP = 10  # Шаг (пикселей), с которым проверяется, не загораживают ли камни отрезок
+SCREEN_CORNER = np.array((SCREEN_WIDTH - 1, SCREEN_HEIGHT - 1))  # Последний пиксель экрана по осям
+
+# Столбец и начало строки клетки поля направлений по координатам пикселя
+FLOW_CELL_COLUMN = np.arange(SCREEN_WIDTH) // FLOW_CELL
+FLOW_CELL_ROW = np.arange(SCREEN_HEIGHT) // FLOW_CELL * FLOW_COLUMNS
+
+def flow_cell(x, y):
+    """Номер клетки поля направлений, в которой лежит точка (x, y) с целыми координатами;
+    работает и с массивами. Точки за экраном относятся к крайним клеткам"""
+    return FLOW_CELL_ROW.take(y, mode="clip") + FLOW_CELL_COLUMN.take(x, mode="clip")
+
+def flow_center(x, y):
+    """Центр клетки поля направлений, в которой лежит точка (x, y); работает и с массивами"""
+    return x // FLOW_CELL * FLOW_CELL + FLOW_CELL // 2, y // FLOW_CELL * FLOW_CELL + FLOW_CELL // 2
+
+# Поле направлений для агентов одного размера: расстояние (BFS) от клеток игроков до каждой клетки
+# и следующая клетка пути из нее. Клетка проходима, если агент с центром в ней не задевает камни
+# и не выходит за экран. Все преследователи берут направление из одного поля за O(1).
+# Поле строится от клеток камней (ROOM_TILE), в которых стоят игроки, и недавние поля запоминаются:
+# игрок, который ходит туда-обратно, не заставляет пересчитывать их заново
+class FlowField:
+    def __init__(self, room, size):
+        self.size = size
+        grid_x, grid_y = np.meshgrid(np.arange(FLOW_COLUMNS) * FLOW_CELL + FLOW_CELL // 2,
+                                     np.arange(FLOW_ROWS) * FLOW_CELL + FLOW_CELL // 2)
+        left, top = grid_x - size // 2, grid_y - size // 2
+        inside = (left >= 0) & (top >= 0) & (left + size <= SCREEN_WIDTH) & (top + size <= SCREEN_HEIGHT)
+        walkable = inside & ~room.blocked_many(left, top, size, size)
+        self.walkable = walkable.ravel()
+        self.center_x = grid_x.ravel().astype(np.float64)
+        self.center_y = grid_y.ravel().astype(np.float64)
+        self.centers = np.stack((self.center_x, self.center_y), axis=1)
+        
+        # Для каждой клетки и каждого хода — клетка, куда он ведет, и можно ли так пойти.
+        # По диагонали можно идти, только если свободны обе клетки по осям, иначе агент заденет угол камня
+        padded = np.pad(walkable, 1)
+        rows, cols = np.mgrid[0:FLOW_ROWS, 0:FLOW_COLUMNS]
+        self.step_target = np.empty((len(FLOW_STEPS), walkable.size), dtype=np.int64)
+        self.step_allowed = np.empty((len(FLOW_STEPS), walkable.size), dtype=bool)
+        for k, (dx, dy) in enumerate(FLOW_STEPS):
+            allowed = padded[1 + dy:1 + dy + FLOW_ROWS, 1 + dx:1 + dx + FLOW_COLUMNS].copy()
+            if dx and dy:
+                allowed &= padded[1:1 + FLOW_ROWS, 1 + dx:1 + dx + FLOW_COLUMNS]
+                allowed &= padded[1 + dy:1 + dy + FLOW_ROWS, 1:1 + FLOW_COLUMNS]
+            self.step_allowed[k] = allowed.ravel()
+            self.step_target[k] = (np.clip(rows + dy, 0, FLOW_ROWS - 1) * FLOW_COLUMNS +
+                                   np.clip(cols + dx, 0, FLOW_COLUMNS - 1)).ravel()
+        # Соседи каждой клетки списками — для обхода в ширину
+        self.neighbours = [self.step_target[self.step_allowed[:, cell], cell].tolist()
+                           for cell in range(walkable.size)]
+        
+        self.sources = None  # Клетки камней игроков, от которых посчитано поле
+        self.hop = np.full(walkable.size, -1, dtype=np.int64)  # Следующая клетка пути (-1 — идти напрямую)
+        self.fields = OrderedDict()  # Клетки игроков -> hop, от давно нужных к недавним
+    
+    def distances(self, sources):
+        """Расстояние в ходах от ближайшей из клеток sources до каждой клетки (-1 — недостижима)"""
+        distance = [-1] * len(self.neighbours)
+        frontier = deque(sources)
+        for cell in sources:
+            distance[cell] = 0
+        neighbours = self.neighbours
+        while frontier:
+            cell = frontier.popleft()
+            step = distance[cell] + 1
+            for neighbour in neighbours[cell]:
+                if distance[neighbour] < 0:
+                    distance[neighbour] = step
+                    frontier.append(neighbour)
+        return distance
+    
+    def update(self, tiles):
+        """Переключает поле на клетки камней tiles, в которых стоят игроки; считает его,
+        только если такого поля еще нет среди запомненных"""
+        if tiles == self.sources:
+            return
+        self.sources = tiles
+        hop = self.fields.get(tiles)
+        if hop is not None:
+            self.fields.move_to_end(tiles)
+            self.hop = hop
+            return
+        
+        # Источники — клетки поля внутри клеток камней игроков
+        sources = [(2 * (tile // ROOM_COLUMNS) + dy) * FLOW_COLUMNS + 2 * (tile % ROOM_COLUMNS) + dx
+                   for tile in tiles for dy in (0, 1) for dx in (0, 1)]
+        distance = np.array(self.distances(sources), dtype=np.int64)
+        distance[distance < 0] = len(distance)
+        
+        # Следующая клетка — сосед с наименьшим расстоянием, если он ближе самой клетки.
+        # Из непроходимой клетки (агент прижат к камню) можно выйти в любую достижимую соседнюю
+        candidates = np.where(self.step_allowed, distance[self.step_target], len(distance))
+        best = candidates.argmin(axis=0)
+        cells = np.arange(len(distance))
+        better = candidates[best, cells] < distance
+        self.hop = self.fields[tiles] = np.where(better, self.step_target[best, cells], -1)
+        if len(self.fields) > FLOW_CACHE_FIELDS:
+            self.fields.popitem(last=False)
+    
+    def sample(self, points):
+        """Куда идти агентам с центрами points (массив (n, 2) целых): центры следующих клеток пути
+        и маска тех, у кого путь есть. Агенты без пути (рядом с игроком или отрезанные камнями)
+        идут к игроку напрямую"""
+        hop = self.hop[flow_cell(points[:, 0], points[:, 1])]
+        return self.centers[hop], hop >= 0
+    
+    def nearest_walkable(self, x, y):
+        """Ближайшая к точке (x, y) проходимая клетка"""
+        distance = (self.center_x - x)**2 + (self.center_y - y)**2
+        return int(np.where(self.walkable, distance, np.inf).argmin())
+    
+    def path(self, start, goal):
+        """Кратчайший путь по клеткам от start до goal (без start) или None, если goal недостижима"""
+        parent = {start: start}
+        frontier = deque((start,))
+        while frontier:
+            cell = frontier.popleft()
+            if cell == goal:
+                path = []
+                while cell != start:
+                    path.append(cell)
+                    cell = parent[cell]
+                return path[::-1]
+            for neighbour in self.neighbours[cell]:
+                if neighbour not in parent:
+                    parent[neighbour] = cell
+                    frontier.append(neighbour)
+        return None
+
+# Карта комнаты: камни на сетке ROOM_TILE, проверка пересечений с ними за O(1) по префиксным суммам
+# и поля направлений для преследователей. Поля пересчитываются, только когда игроки меняют клетку
+class RoomMap:
+    def __init__(self):
+        self.layout = None
+        self.grids = {}  # (раскладка, размер агента) -> FlowField; раскладок немного, поэтому не очищается
+        self.column_masks = {}  # Ширина -> биты столбцов клеток по левому краю (см. column_mask)
+        self.rock = None  # Изображение камня (создается при первой отрисовке)
+        self.load("open")
+    
+    def load(self, layout):
+        """Расставляет камни по раскладке из ROOM_LAYOUTS"""
+        if layout == self.layout:
+            return
+        self.layout = layout
+        self.solid = np.array([[cell == "#" for cell in row] for row in ROOM_LAYOUTS[layout]], dtype=bool)
+        self.table = np.zeros((ROOM_ROWS + 1, ROOM_COLUMNS + 1), dtype=np.int32)
+        self.table[1:, 1:] = self.solid.cumsum(axis=0).cumsum(axis=1)
+        # Камни строк клеток битами: бит col установлен, если в клетке (row, col) камень
+        self.row_bits = (self.solid.astype(np.int64) << np.arange(ROOM_COLUMNS)).sum(axis=1)
+        self.row_masks = {}  # Высота -> биты камней по верхнему краю (см. row_mask)
+        self.rects = [pygame.Rect(col * ROOM_TILE, row * ROOM_TILE, ROOM_TILE, ROOM_TILE)
+                      for row, col in zip(*np.nonzero(self.solid))]
+        self.routes = {}  # Маршруты охранников этой комнаты
+        self.sources = ()
+    
+    def column_mask(self, w):
+        """Биты столбцов клеток, которые задевает прямоугольник ширины w, по индексу left + w.
+        Левее -w и правее SCREEN_WIDTH прямоугольник не задевает ни одного столбца (крайние значения)"""
+        masks = self.column_masks.get(w)
+        if masks is None:
+            left = np.arange(-w, SCREEN_WIDTH + 1)
+            x0 = np.clip(left // ROOM_TILE, 0, ROOM_COLUMNS)
+            x1 = np.clip((left + w - 1) // ROOM_TILE + 1, 0, ROOM_COLUMNS)
+            masks = self.column_masks[w] = (1 << x1) - (1 << x0)
+        return masks
+    
+    def row_mask(self, h):
+        """Биты камней во всех строках клеток, которые задевает прямоугольник высоты h, по индексу top + h"""
+        masks = self.row_masks.get(h)
+        if masks is None:
+            top = np.arange(-h, SCREEN_HEIGHT + 1)
+            y0 = np.clip(top // ROOM_TILE, 0, ROOM_ROWS)
+            y1 = np.clip((top + h - 1) // ROOM_TILE + 1, 0, ROOM_ROWS)
+            masks = np.zeros(len(top), dtype=np.int64)
+            for row, bits in enumerate(self.row_bits.tolist()):
+                if bits:
+                    masks |= np.where((y0 <= row) & (row < y1), bits, 0)
+            self.row_masks[h] = masks
+        return masks
+    
+    def blocked_many(self, left, top, w, h):
+        """Задевают ли камни прямоугольники (left, top, w, h); аргументы — числа или массивы.
+        При одном размере на всех прямоугольник задевает камень, если биты камней его строк
+        пересекаются с битами его столбцов; разные размеры проверяются по таблице префиксных сумм"""
+        if not isinstance(w, np.ndarray) and not isinstance(h, np.ndarray):
+            rows = self.row_mask(h).take(np.add(top, h), mode="clip")
+            return (rows & self.column_mask(w).take(np.add(left, w), mode="clip")) != 0
+        x0 = np.minimum(np.maximum(np.floor_divide(left, ROOM_TILE), 0), ROOM_COLUMNS)
+        x1 = np.minimum(np.maximum(np.floor_divide(np.add(left, w - 1), ROOM_TILE) + 1, 0), ROOM_COLUMNS)
+        y0 = np.minimum(np.maximum(np.floor_divide(top, ROOM_TILE), 0), ROOM_ROWS)
+        y1 = np.minimum(np.maximum(np.floor_divide(np.add(top, h - 1), ROOM_TILE) + 1, 0), ROOM_ROWS)
+        table = self.table
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0] > 0
+    
+    def blocked(self, rect):
+        """Задевает ли прямоугольник камни"""
+        w, h = rect.size
+        rows, columns = self.row_mask(h), self.column_mask(w)
+        return bool(rows[min(max(rect.top + h, 0), len(rows) - 1)] &
+                    columns[min(max(rect.left + w, 0), len(columns) - 1)])
+    
+    def visible(self, start, end):
+        """Не загораживают ли камни отрезки от точек start до точек end (массивы (n, 2)).
+        Отрезок проверяется в точках через каждые LINE_OF_SIGHT_STEP пикселей по длинной оси;
+        концы за экраном сначала переносятся на его край"""
+        start = np.minimum(np.maximum(start, 0), SCREEN_CORNER)
+        delta = np.minimum(np.maximum(end, 0), SCREEN_CORNER) - start
+        steps = int(np.abs(delta).max() // LINE_OF_SIGHT_STEP) + 2
+        t = np.arange(steps) / (steps - 1)
+        x = (start[:, 0, None] + delta[:, 0, None] * t).astype(np.int64) // ROOM_TILE
+        y = (start[:, 1, None] + delta[:, 1, None] * t).astype(np.int64) // ROOM_TILE
+        return ~self.solid[y, x].any(axis=1)
+    
+    def slide(self, rect, dx, dy):
+        """Сдвигает rect в пределах экрана по каждой оси отдельно; сдвиг по оси, на которой rect
+        уперся бы в камень, отменяется, поэтому вдоль камня можно скользить"""
+        x = rect.x
+        rect.x = max(0, min(rect.x + dx, SCREEN_WIDTH - rect.width))
+        if self.rects and self.blocked(rect):
+            rect.x = x
+        y = rect.y
+        rect.y = max(0, min(rect.y + dy, SCREEN_HEIGHT - rect.height))
+        if self.rects and self.blocked(rect):
+            rect.y = y
+    
+    def push_out(self, rect):
+        """Переносит rect, задевающий камни, в ближайшую клетку, где он их не задевает"""
+        if self.blocked(rect):
+            grid = self.grid(rect.w)
+            cell = grid.nearest_walkable(*rect.center)
+            rect.center = (int(grid.center_x[cell]), int(grid.center_y[cell]))
+    
+    def follow(self, players):
+        """Запоминает клетки камней (ROOM_TILE), в которых стоят игроки: от них строятся поля направлений"""
+        self.sources = tuple(sorted({min(max(player.rect.centery // ROOM_TILE, 0), ROOM_ROWS - 1) * ROOM_COLUMNS +
+                                     min(max(player.rect.centerx // ROOM_TILE, 0), ROOM_COLUMNS - 1)
+                                     for player in players}))
+    
+    def grid(self, size):
+        """Сетка проходимости для агентов размера size (без пересчета расстояний)"""
+        key = (self.layout, size)
+        if key not in self.grids:
+            self.grids[key] = FlowField(self, size)
+        return self.grids[key]
+    
+    def field(self, size):
+        """Поле направлений к игрокам для агентов размера size"""
+        field = self.grid(size)
+        field.update(self.sources)
+        return field
+    
+    def patrol_route(self, home, points, size):
+        """Маршрут охранника в обход камней: путь от точки появления home к первой точке patrol
+        и замкнутый обход точек, до которых можно дойти. Возвращает (точки пути, начало кольца)"""
+        key = (home, tuple(points), size)
+        if key not in self.routes:
+            grid = self.grid(size)
+            start = grid.nearest_walkable(*home)
+            reachable = grid.distances((start,))
+            stops = [cell for cell in (grid.nearest_walkable(x, y) for x, y in points) if reachable[cell] >= 0]
+            cells, loop_start = [], None
+            if stops:
+                cells += grid.path(start, stops[0])
+                loop_start = len(cells)
+                for a, b in zip(stops, stops[1:] + stops[:1]):
+                    cells += grid.path(a, b)
+            # В маршрут попадают только повороты пути и конец пути к первой точке
+            route, loop = [], None
+            for i, cell in enumerate(cells):
+                previous = cells[i - 1] if i else start
+                following = cells[i + 1] if i + 1 < len(cells) else None
+                if i == loop_start:
+                    loop = len(route)
+                if following is None or following - cell != cell - previous or i + 1 == loop_start:
+                    route.append((float(grid.center_x[cell]), float(grid.center_y[cell])))
+            if not route:
+                route = [(float(grid.center_x[start]), float(grid.center_y[start]))]
+            # Если обходить нечего (одна достижимая точка), охранник остается в последней точке пути
+            self.routes[key] = (route, len(route) - 1 if loop is None else loop)
+        return self.routes[key]
+    
+    def draw(self, surface):
+        """Рисует камни поверх фона комнаты"""
+        if self.rock is None:
+            self.rock = pygame.Surface((ROOM_TILE, ROOM_TILE)).convert()
+            self.rock.fill(DARK_GRAY)
+            pygame.draw.rect(self.rock, ROCK_COLOR, (2, 2, ROOM_TILE - 4, ROOM_TILE - 4), border_radius=6)
+        surface.blits([(self.rock, rect) for rect in self.rects], False)
 
 # Базовый класс для врагов
 class Enemy(pygame.sprite.Sprite):
-    def __init__(self, enemy_type, x, y):
+    def __init__(self, enemy_type, x, y, owner_id, rng):
         super().__init__()
         self.enemy_type = enemy_type
+        self.owner_id = owner_id  # Номер владельца пуль этого врага
         self.image_name = f"enemy_{enemy_type}"
         self.image = assets.get_image(self.image_name)
+        self.sprite = assets.get_sprite(self.image_name)  # (атлас, область) для списка отрисовки
         self.rect = self.image.get_rect()
         self.rect.center = (x, y)
-        self.bullets = pygame.sprite.Group()
+        self.home = (x, y)  # Точка появления: от нее охранник строит маршрут
+        self.prev_pos = self.rect.topleft  # Положение на прошлом шаге (для интерполяции)
+        self.rng = rng  # Генератор случайных чисел забега
         self.fire_delay = 0
         
-        # Характеристики врага в зависимости от типа
+        # Характеристики врага (начальные: движение и стрельбу всех врагов комнаты ведет EnemyAI) в зависимости от типа
         if enemy_type == 1:  # Враг-преследователь
             self.health = 3
             self.speed = 2
@@ -344,7 +2248,7 @@ class Enemy(pygame.sprite.Sprite):
     def set_patrol_points(self):
         # Создаем случайные точки патрулирования для врага типа 3
         center_x, center_y = self.rect.center
-        radius = random.randint(50, 150)
+        radius = self.rng.randint(50, 150)
         
         # Добавляем несколько точек вокруг центра
         for i in range(4):
@@ -353,89 +2257,6 @@ class Enemy(pygame.sprite.Sprite):
             y = center_y + radius * math.sin(angle)
             self.patrol_points.append((x, y))
     
-    def update(self, player):
-        # Обновление пуль
-        self.bullets.update()
-        
-        # Логика движения и стрельбы в зависимости от типа врага
-        if self.enemy_type == 1:  # Враг-преследователь
-            # Движение к игроку
-            self.move_towards_player(player)
-        elif self.enemy_type == 2:  # Враг-стрелок
-            # Сохранение дистанции от игрока и стрельба
-            dist_to_player = math.sqrt((player.rect.centerx - self.rect.centerx)**2 + 
-                                       (player.rect.centery - self.rect.centery)**2)
-            
-            if dist_to_player < 200:
-                # Отходим от игрока
-                self.move_away_from_player(player)
-            elif dist_to_player > 300:
-                # Приближаемся к игроку
-                self.move_towards_player(player)
-            
-            # Стрельба
-            if self.fire_delay > 0:
-                self.fire_delay -= 1
-            else:
-                self.shoot_at_player(player)
-                self.fire_delay = self.fire_rate
-                
-        elif self.enemy_type == 3:  # Враг-охранник
-            # Движение по маршруту
-            if self.patrol_points:
-                target = self.patrol_points[self.current_point]
-                
-                # Движение к текущей точке
-                dx = target[0] - self.rect.centerx
-                dy = target[1] - self.rect.centery
-                dist = math.sqrt(dx**2 + dy**2)
-                
-                if dist > 5:  # Если не достигли точки
-                    self.rect.x += (dx / dist) * self.speed
-                    self.rect.y += (dy / dist) * self.speed
-                else:
-                    # Переход к следующей точке
-                    self.current_point = (self.current_point + 1) % len(self.patrol_points)
-            
-            # Стрельба
-            if self.fire_delay > 0:
-                self.fire_delay -= 1
-            else:
-                self.shoot_at_player(player)
-                self.fire_delay = self.fire_rate
-    
-    def move_towards_player(self, player):
-        # Вычисление направления к игроку
-        dx = player.rect.centerx - self.rect.centerx
-        dy = player.rect.centery - self.rect.centery
-        dist = math.sqrt(dx**2 + dy**2)
-        
-        if dist > 0:
-            # Нормализация и движение
-            self.rect.x += (dx / dist) * self.speed
-            self.rect.y += (dy / dist) * self.speed
-    
-    def move_away_from_player(self, player):
-        # Вычисление направления от игрока
-        dx = self.rect.centerx - player.rect.centerx
-        dy = self.rect.centery - player.rect.centery
-        dist = math.sqrt(dx**2 + dy**2)
-        
-        if dist > 0:
-            # Нормализация и движение
-            self.rect.x += (dx / dist) * self.speed
-            self.rect.y += (dy / dist) * self.speed
-    
-    def shoot_at_player(self, player):
-        # Вычисление направления к игроку
-        dx = player.rect.centerx - self.rect.centerx
-        dy = player.rect.centery - self.rect.centery
-        
-        # Создание пули
-        bullet = Bullet(self.rect.centerx, self.rect.centery, [dx, dy], False, self.damage)
-        self.bullets.add(bullet)
-        assets.play_sound("shoot")
-    
     def take_damage(self, damage):
         self.health -= damage
         assets.play_sound("hit")
@@ -444,131 +2265,1336 @@ class Enemy(pygame.sprite.Sprite):
             return True
         return False
 
-# Класс для босса
+def round_rect_coord(values):
+    """Округляет как присваивание float в pygame.Rect: половины — от нуля"""
+    whole = np.trunc(values)
+    return (whole + np.where(np.abs(values - whole) >= 0.5, np.sign(values), 0)).astype(np.int64)
+
+# Класс для ИИ всех врагов комнаты: состояние хранится в массивах, шаг считается одним проходом NumPy.
+# Результат совпадает с поочередным обновлением каждого врага: враги не влияют друг на друга
+class EnemyAI:
+    def __init__(self, bullets, room):
+        self.bullets = bullets  # Общий пул пуль
+        self.room = room  # Карта комнаты: камни и поле направлений к игрокам
+        self.reset(())
+    
+    def reset(self, enemies):
+        """Переносит состояние новой комнаты из объектов Enemy в массивы"""
+        self.enemies = list(enemies)  # Враги в том же порядке, что и строки массивов
+        # Координаты хранятся парами (x, y), чтобы обе оси считались одной операцией
+        self.pos = np.array([enemy.rect.topleft for enemy in self.enemies], dtype=np.int64).reshape(-1, 2)
+        self.half = np.array([(enemy.rect.w // 2, enemy.rect.h // 2) for enemy in self.enemies],
+                             dtype=np.int64).reshape(-1, 2)
+        self.kind = np.array([enemy.enemy_type for enemy in self.enemies], dtype=np.int8)
+        self.speed = np.array([enemy.speed for enemy in self.enemies], dtype=np.float64)
+        self.fire_rate = np.array([enemy.fire_rate for enemy in self.enemies], dtype=np.int64)
+        self.fire_delay = np.array([enemy.fire_delay for enemy in self.enemies], dtype=np.int64)
+        self.damage = np.array([enemy.damage for enemy in self.enemies], dtype=np.int32)
+        self.owner = np.array([enemy.owner_id for enemy in self.enemies], dtype=np.int32)
+        # Маршруты охранников в обход камней (n, длина самого длинного, 2); у врагов без маршрута — нули.
+        # Дойдя до конца маршрута, охранник возвращается к началу кольца обхода route_loop
+        routes = [self.room.patrol_route(enemy.home, enemy.patrol_points, enemy.rect.w)
+                  if enemy.enemy_type == 3 else ([], 0) for enemy in self.enemies]
+        longest = max([len(route) for route, _ in routes], default=0)
+        self.route = np.zeros((len(routes), max(longest, 1), 2), dtype=np.float64)
+        for i, (route, _) in enumerate(routes):
+            if route:
+                self.route[i, :len(route)] = route
+        self.route_length = np.array([len(route) for route, _ in routes], dtype=np.int64)
+        self.route_loop = np.array([loop for _, loop in routes], dtype=np.int64)
+        self.current_point = np.array([getattr(enemy, "current_point", 0) for enemy in self.enemies],
+                                      dtype=np.int64)
+        self.classify()
+    
+    def classify(self):
+        # Маски типов не меняются до конца комнаты, поэтому считаются один раз
+        self.chase = (self.kind == 1).astype(np.int64)
+        self.kite = self.kind == 2
+        self.kiters = np.flatnonzero(self.kite)
+        self.guards = np.flatnonzero(self.kind == 3)
+        self.armed = self.fire_rate > 0
+        # Враги одного размера проверяют камни быстрее (см. RoomMap.blocked_many)
+        size = 2 * self.half
+        self.size = (int(size[0, 0]), int(size[0, 1])) if len(size) and (size == size[0]).all() else None
+    
+    def discard_dead(self):
+        """Убирает из массивов врагов, удаленных из групп спрайтов"""
+        keep = np.array([enemy.alive() for enemy in self.enemies], dtype=bool)
+        self.enemies = [enemy for enemy in self.enemies if enemy.alive()]
+        for name in ("pos", "half", "kind", "speed", "fire_rate", "fire_delay", "damage", "owner",
+                     "route", "route_length", "route_loop", "current_point"):
+            setattr(self, name, getattr(self, name)[keep])
+        self.classify()
+    
+    def update(self, players):
+        """Один шаг ИИ: преследование (тип 1), удержание дистанции 200–300 (тип 2),
+        патрулирование (тип 3) и стрельба типов 2 и 3. Каждый враг целится в ближайшего из players.
+        Идущие к игроку обходят камни по общему полю направлений, остальные скользят вдоль камней"""
+        if not self.enemies:
+            return
+        
+        # Вектор к игроку от центра каждого врага
+        center = self.pos + self.half
+        targets = np.array([player.rect.center for player in players], dtype=np.int64)
+        if len(targets) == 1:
+            player_center = targets.repeat(len(center), axis=0)
+        else:
+            nearest = ((targets[None, :, :] - center[:, None, :])**2).sum(axis=2).argmin(axis=1)
+            player_center = targets[nearest]
+        delta = player_center - center
+        dist = np.sqrt((delta**2).sum(axis=1))
+        
+        # К игроку (+1) или от него (-1): стрелок отходит ближе 200 и подходит дальше 300.
+        # Стрелок, от которого игрока загораживают камни, идет к нему, пока не увидит его
+        far = dist > 300
+        near = dist < 200
+        kiters = self.kiters
+        if len(kiters) and self.room.rects:
+            hidden = ~self.room.visible(center[kiters], player_center[kiters])
+            far[kiters] |= hidden
+            near[kiters] &= ~hidden
+        sign = self.chase + (self.kite & far) - (self.kite & near)
+        move = (delta * sign[:, None]).astype(np.float64)
+        
+        # Идущие к игроку идут к центру следующей клетки поля, пока не окажутся в клетке игрока.
+        # Поле одно на всех и пересчитывается, только когда игрок меняет клетку
+        approach = np.flatnonzero(sign > 0)
+        if len(approach) and self.room.rects:
+            field = self.room.field(2 * int(self.half.max()))
+            targets, found = field.sample(center[approach])
+            move[approach] = np.where(found[:, None], targets - center[approach], move[approach])
+        move_dist = np.sqrt((move**2).sum(axis=1))
+        moving = (sign != 0) & (move_dist > 0)
+        
+        # Охранник идет к текущей точке маршрута, а дойдя до нее, переключается на следующую
+        guards = self.guards
+        if len(guards):
+            guard_move = self.route[guards, self.current_point[guards]] - center[guards]
+            guard_dist = np.sqrt((guard_move**2).sum(axis=1))
+            move[guards] = guard_move
+            move_dist[guards] = guard_dist
+            moving[guards] = guard_dist > 5
+            reached = guards[guard_dist <= 5]
+            following = self.current_point[reached] + 1
+            self.current_point[reached] = np.where(following < self.route_length[reached], following,
+                                                   self.route_loop[reached])
+        
+        # Шаг на speed в нормированном направлении с округлением, как у Rect.
+        # Сдвиг по оси, на которой враг задел бы камень, отменяется
+        rows = np.flatnonzero(moving)
+        if len(rows):
+            old = self.pos[rows]
+            pos = round_rect_coord(old + move[rows] / move_dist[rows, None] * self.speed[rows, None])
+            if self.room.rects:
+                size = 2 * self.half[rows]
+                pos = self.slide(old, pos, size)
+                # Враг, сдвинутый от центра клетки, может упереться в угол камня на повороте пути
+                # и не сдвинуться ни по одной оси; такой враг сначала возвращается к центру своей клетки
+                stuck = np.flatnonzero((pos == old).all(axis=1))
+                if len(stuck):
+                    center = old[stuck] + self.half[rows[stuck]]
+                    recenter = np.stack(flow_center(center[:, 0], center[:, 1]), axis=1) - center
+                    length = np.sqrt((recenter**2).sum(axis=1))[:, None]
+                    step = np.minimum(self.speed[rows[stuck], None], length)
+                    shifted = old[stuck] + np.divide(recenter * step, length, out=np.zeros(recenter.shape),
+                                                     where=length > 0)
+                    pos[stuck] = self.slide(old[stuck], round_rect_coord(shifted), size[stuck])
+            self.pos[rows] = pos
+            enemies = self.enemies
+            for i, topleft in zip(rows.tolist(), pos.tolist()):
+                enemies[i].rect.topleft = topleft
+        
+        # Стрельба: у кого таймер дошел до нуля — выстрел из нового положения, у остальных таймер тикает
+        ready = self.armed & (self.fire_delay == 0)
+        self.fire_delay -= self.armed & ~ready
+        if ready.any():
+            shooters = np.flatnonzero(ready)
+            self.fire_delay[shooters] = self.fire_rate[shooters]
+            self.shoot(shooters, player_center)
+    
+    def slide(self, old, pos, size):
+        """Новые положения врагов из old в pos: сдвиг по оси, на которой враг задел бы камень, отменяется"""
+        w, h = self.size or (size[:, 0], size[:, 1])
+        pos = pos.copy()
+        stuck = self.room.blocked_many(pos[:, 0], old[:, 1], w, h)
+        pos[stuck, 0] = old[stuck, 0]
+        stuck = self.room.blocked_many(pos[:, 0], pos[:, 1], w, h)
+        pos[stuck, 1] = old[stuck, 1]
+        return pos
+    
+    def shoot(self, shooters, targets):
+        """Залп из центров врагов shooters; targets — точка прицеливания для каждого врага"""
+        # spawn_many кладет первый элемент на самый глубокий свободный слот, поэтому порядок обратный:
+        # тогда пули займут те же слоты, что и при поочередных spawn()
+        shooters = shooters[:self.bullets.free_count][::-1]
+        if len(shooters) == 0:
+            return
+        center = self.pos[shooters] + self.half[shooters]
+        delta = targets[shooters] - center
+        length = np.sqrt((delta**2).sum(axis=1))[:, None]
+        direction = np.divide(delta, length, out=np.zeros(delta.shape), where=length > 0)
+        self.bullets.spawn_many(center[:, 0], center[:, 1], direction[:, 0], direction[:, 1], 5,
+                                BULLET_ENEMY, self.owner[shooters], self.damage[shooters])
+        assets.play_sound("shoot")
+
+# Таблица единичных векторов для поворота залпов на целое число градусов
+DIRECTION_X = np.cos(np.radians(np.arange(360)))
+DIRECTION_Y = np.sin(np.radians(np.arange(360)))
+
+# Паттерны стрельбы босса: имя -> параметры залпа.
+#   kind: "ring" — count пуль равномерно по кругу начиная с угла offset;
+#         "fan" — count пуль веером шириной spread градусов с центром на игроке.
+#   spin — поворот каждого следующего залпа, в целых градусах (кольцо со spin — спираль).
+#   shots — залпов в очереди (burst) с промежутком gap кадров; после очереди пауза interval кадров.
+BOSS_PATTERNS = {
+    "aimed": {"kind": "fan", "count": 1, "speed": 5, "interval": 30},  # Одиночный выстрел в игрока
+    "ring": {"kind": "ring", "count": 8, "speed": 5, "interval": 15},  # Круговой выстрел
+}
+
+# Фазы босса: (доля здоровья, с которой начинается фаза, прибавка к скорости, расписание).
+# Расписание — шаги (движение, паттерн, длительность в кадрах), идущие по кругу.
+# Движение: "chase" — к игроку, "wander" — случайный сдвиг раз в секунду, "hold" — на месте
+BOSS_SCHEDULE = (
+    ("chase", "aimed", 180),
+    ("wander", "aimed", 180),
+    ("hold", "ring", 180),
+)
+BOSS_PHASES = (
+    (1.0, 0.0, BOSS_SCHEDULE),
+    (0.5, 0.5, BOSS_SCHEDULE),
+)
+
+# Паттерн стрельбы с заранее посчитанными направлениями залпа
+class BulletPattern:
+    def __init__(self, kind, count, speed, interval, spread=0, offset=0, spin=0, shots=1, gap=0):
+        self.aimed = kind == "fan"  # Направления веера заданы относительно направления на игрока
+        self.speed = speed
+        self.interval = interval
+        self.spin = spin
+        self.shots = shots
+        self.gap = gap
+        if kind == "ring":
+            angles = offset + np.arange(count) * 360 / count
+        elif kind == "fan":
+            angles = offset + (np.linspace(-spread / 2, spread / 2, count) if count > 1 else np.zeros(1))
+        else:
+            raise ValueError(f"Неизвестный вид паттерна: {kind}")
+        self.dx = np.cos(np.radians(angles))
+        self.dy = np.sin(np.radians(angles))
+    
+    def directions(self, aim, volley):
+        """Единичные векторы залпа: повернутые на направление aim (для веера)
+        и на spin * volley градусов"""
+        dx, dy = self.dx, self.dy
+        if self.spin:
+            angle = self.spin * volley % 360
+            cos, sin = DIRECTION_X[angle], DIRECTION_Y[angle]
+            dx, dy = dx * cos - dy * sin, dx * sin + dy * cos
+        if self.aimed:
+            cos, sin = aim
+            dx, dy = dx * cos - dy * sin, dx * sin + dy * cos
+        return dx, dy
+
+BULLET_PATTERNS = {name: BulletPattern(**spec) for name, spec in BOSS_PATTERNS.items()}
+
+# Класс для босса
 class Boss(pygame.sprite.Sprite):
-    def __init__(self, x, y):
+    def __init__(self, x, y, bullets, rng, room):
         super().__init__()
-        self.image = assets.get_image("boss")
+        self.image_name = "boss"
+        self.image = assets.get_image(self.image_name)
+        self.sprite = assets.get_sprite("boss")  # Босс не в атласе: (изображение, None)
         self.rect = self.image.get_rect()
         self.rect.center = (x, y)
+        self.prev_pos = self.rect.topleft  # Положение на прошлом шаге (для интерполяции)
         self.health = 30
         self.max_health = 30
-        self.speed = 1.5
+        self.base_speed = 1.5
+        self.speed = self.base_speed
         self.damage = 2
-        self.bullets = pygame.sprite.Group()
+        self.bullets = bullets  # Общий пул пуль
+        self.rng = rng  # Генератор случайных чисел забега
+        self.room = room  # Карта комнаты: камни и поле направлений к игрокам
         self.fire_delay = 0
-        self.fire_rate = 30  # Стреляет каждые 0.5 секунды
-        self.phase = 1  # Фаза босса
-        self.attack_pattern = 0  # Текущий паттерн атаки
-        self.attack_timer = 0  # Таймер для смены паттернов
+        self.phase = 1  # Фаза босса (номер в BOSS_PHASES, с единицы)
+        self.attack_pattern = 0  # Текущий шаг расписания фазы
+        self.attack_timer = 0  # Кадров с начала шага
+        self.burst_shot = 0  # Залпов, выпущенных в текущей очереди
+        self.volley = 0  # Залпов с начала боя (для поворота спиралей)
+    
+    def schedule(self):
+        """Расписание текущей фазы"""
+        return BOSS_PHASES[self.phase - 1][2]
     
     def update(self, player):
-        # Обновление пуль
-        self.bullets.update()
-        
-        # Смена фазы в зависимости от здоровья
-        if self.health <= self.max_health * 0.5 and self.phase == 1:
-            self.phase = 2
-            self.speed += 0.5
+        # Смена фазы в зависимости от здоровья. Шаг расписания и его таймер сохраняются
+        while (self.phase < len(BOSS_PHASES) and
+               self.health <= self.max_health * BOSS_PHASES[self.phase][0]):
+            self.phase += 1
+            self.speed = self.base_speed + BOSS_PHASES[self.phase - 1][1]
+            self.attack_pattern %= len(self.schedule())
         
-        # Обновление таймера атаки
+        # Обновление таймера шага и переход к следующему шагу расписания
+        schedule = self.schedule()
         self.attack_timer += 1
-        if self.attack_timer >= 180:  # Смена паттерна каждые 3 секунды
+        if self.attack_timer >= schedule[self.attack_pattern][2]:
             self.attack_timer = 0
-            self.attack_pattern = (self.attack_pattern + 1) % 3
+            self.attack_pattern = (self.attack_pattern + 1) % len(schedule)
+        movement, pattern_name, _ = schedule[self.attack_pattern]
         
-        # Движение и атака в зависимости от паттерна
-        if self.attack_pattern == 0:
-            # Паттерн 1: Преследование игрока
+        # Движение
+        if movement == "chase":
             self.move_towards_player(player)
-        elif self.attack_pattern == 1:
-            # Паттерн 2: Случайное движение
+        elif movement == "wander":
             if self.attack_timer % 60 == 0:
                 self.random_move()
-        elif self.attack_pattern == 2:
-            # Паттерн 3: Оставаться на месте и интенсивно стрелять
-            pass
         
         # Стрельба
         if self.fire_delay > 0:
             self.fire_delay -= 1
         else:
-            self.shoot(player)
-            self.fire_delay = self.fire_rate if self.attack_pattern != 2 else self.fire_rate // 2
+            pattern = BULLET_PATTERNS[pattern_name]
+            self.shoot(pattern, player)
+            self.burst_shot += 1
+            if self.burst_shot < pattern.shots:
+                self.fire_delay = pattern.gap
+            else:
+                self.burst_shot = 0
+                self.fire_delay = pattern.interval
     
     def move_towards_player(self, player):
-        # Вычисление направления к игроку
-        dx = player.rect.centerx - self.rect.centerx
-        dy = player.rect.centery - self.rect.centery
+        # Вычисление направления к игроку: в обход камней — к центру следующей клетки поля направлений
+        target_x, target_y = player.rect.center
+        if self.room.rects:
+            targets, found = self.room.field(self.rect.w).sample(np.array([self.rect.center]))
+            if found[0]:
+                target_x, target_y = targets[0].tolist()
+        dx = target_x - self.rect.centerx
+        dy = target_y - self.rect.centery
         dist = math.sqrt(dx**2 + dy**2)
         
         if dist > 0:
             # Нормализация и движение
-            self.rect.x += (dx / dist) * self.speed
-            self.rect.y += (dy / dist) * self.speed
+            position = self.rect.topleft
+            self.room.slide(self.rect, (dx / dist) * self.speed, (dy / dist) * self.speed)
+            if self.rect.topleft == position:
+                # Уперся в угол камня, будучи сдвинутым от центра клетки (как враги в EnemyAI):
+                # сначала возвращается к центру своей клетки
+                center_x, center_y = flow_center(*self.rect.center)
+                dx = center_x - self.rect.centerx
+                dy = center_y - self.rect.centery
+                dist = math.sqrt(dx**2 + dy**2)
+                if dist > 0:
+                    step = min(self.speed, dist)
+                    self.room.slide(self.rect, dx / dist * step, dy / dist * step)
     
     def random_move(self):
-        # Случайное движение в пределах экрана
-        self.rect.x += random.randint(-20, 20)
-        self.rect.y += random.randint(-20, 20)
-        
-        # Ограничение в пределах экрана
-        self.rect.x = max(0, min(self.rect.x, SCREEN_WIDTH - self.rect.width))
-        self.rect.y = max(0, min(self.rect.y, SCREEN_HEIGHT - self.rect.height))
+        # Случайное движение в пределах экрана в обход камней
+        self.room.slide(self.rect, self.rng.randint(-20, 20), self.rng.randint(-20, 20))
     
-    def shoot(self, player):
-        if self.attack_pattern == 0 or self.attack_pattern == 1:
-            # Одиночный выстрел в игрока
+    def shoot(self, pattern, player):
+        """Выпускает залп паттерна одним вызовом spawn_many"""
+        aim = (1.0, 0.0)
+        if pattern.aimed:
             dx = player.rect.centerx - self.rect.centerx
             dy = player.rect.centery - self.rect.centery
-            bullet = Bullet(self.rect.centerx, self.rect.centery, [dx, dy], False, self.damage)
-            self.bullets.add(bullet)
-            assets.play_sound("shoot")
-        elif self.attack_pattern == 2:
-            # Круговой выстрел
-            for angle in range(0, 360, 45):
-                dx = math.cos(math.radians(angle))
-                dy = math.sin(math.radians(angle))
-                bullet = Bullet(self.rect.centerx, self.rect.centery, [dx, dy], False, self.damage)
-                self.bullets.add(bullet)
-            assets.play_sound("shoot")
+            dist = math.sqrt(dx**2 + dy**2)
+            aim = (dx / dist, dy / dist) if dist > 0 else (0.0, 0.0)
+        dx, dy = pattern.directions(aim, self.volley)
+        self.volley += 1
+        self.bullets.spawn_many(self.rect.centerx, self.rect.centery, dx, dy, pattern.speed,
+                                BULLET_ENEMY, OWNER_BOSS, self.damage)
+        assets.play_sound("shoot")
     
     def take_damage(self, damage):
         self.health -= damage
         assets.play_sound("hit")
         return self.health <= 0
     
+    def health_bar_rect(self):
+        """Область экрана, которую занимает полоска здоровья"""
+        return pygame.Rect((SCREEN_WIDTH - 200) // 2, SCREEN_HEIGHT - 20 - 10, 200, 20)
+    
     def draw_health_bar(self, surface):
-        # Рисуем полоску здоровья босса
+        """Рисует полоску здоровья на поверхность размером health_bar_rect()"""
         health_ratio = self.health / self.max_health
         bar_width = 200
         bar_height = 20
-        bar_x = (SCREEN_WIDTH - bar_width) // 2
-        bar_y = SCREEN_HEIGHT - bar_height - 10
         
         # Фон полоски
-        pygame.draw.rect(surface, GRAY, (bar_x, bar_y, bar_width, bar_height))
+        pygame.draw.rect(surface, GRAY, (0, 0, bar_width, bar_height))
         # Полоска здоровья
-        pygame.draw.rect(surface, RED, (bar_x, bar_y, int(bar_width * health_ratio), bar_height))
+        pygame.draw.rect(surface, RED, (0, 0, int(bar_width * health_ratio), bar_height))
         # Контур
-        pygame.draw.rect(surface, WHITE, (bar_x, bar_y, bar_width, bar_height), 2)
+        pygame.draw.rect(surface, WHITE, (0, 0, bar_width, bar_height), 2)
+
+# Кэш интерфейса: сердца игрока и полоска здоровья босса перерисовываются только при изменении здоровья
+class HudCompositor:
+    def __init__(self):
+        self.heart_image = None
+        self.hearts = None  # Варианты сердца: (полное, половина, пустое)
+        self.health_key = None
+        self.health_layer = None  # (поверхность с сердцами, ее прямоугольник на экране)
+        self.boss_key = None
+        self.boss_layer = None  # (поверхность с полоской здоровья босса, ее прямоугольник на экране)
+    
+    def heart_variants(self, heart_img):
+        """Готовит полное, половинное и пустое сердце один раз для каждого изображения сердца"""
+        if heart_img is not self.heart_image:
+            heart_width = 20
+            half_heart = pygame.Surface((heart_width // 2, heart_width))
+            half_heart.blit(heart_img, (0, 0))
+            empty_heart = pygame.Surface((heart_width, heart_width), pygame.SRCALPHA)
+            empty_heart.blit(heart_img, (0, 0))
+            empty_heart.fill((100, 100, 100, 150), None, pygame.BLEND_RGBA_MULT)
+            self.heart_image = heart_img
+            self.hearts = (heart_img, half_heart, empty_heart)
+            self.health_key = None
+        return self.hearts
+    
+    def player_health(self, player):
+        """Слой с сердцами игрока"""
+        hearts = self.heart_variants(assets.get_image("heart"))
+        key = (player.health, player.max_health)
+        if key != self.health_key:
+            rect = player.health_rect()
+            if self.health_layer is None or self.health_layer[1] != rect:
+                self.health_layer = (pygame.Surface(rect.size, pygame.SRCALPHA), rect)
+            self.health_layer[0].fill((0, 0, 0, 0))
+            player.draw_health(self.health_layer[0], hearts)
+            self.health_key = key
+        return self.health_layer
+    
+    def boss_health(self, boss):
+        """Слой с полоской здоровья босса"""
+        key = (boss.health, boss.max_health)
+        if key != self.boss_key:
+            if self.boss_layer is None:
+                rect = boss.health_bar_rect()
+                self.boss_layer = (pygame.Surface(rect.size).convert(), rect)
+            boss.draw_health_bar(self.boss_layer[0])
+            self.boss_key = key
+        return self.boss_layer
+
+# Положение сущности для отрисовки между прошлым и текущим шагом симуляции
+def interpolate(entity, alpha):
+    if alpha >= 1.0:
+        return entity.rect
+    x, y = entity.prev_pos
+    rect = entity.rect
+    return (round(x + (rect.x - x) * alpha), round(y + (rect.y - y) * alpha))
+
+def sprite_entry(entity, alpha):
+    """Элемент списка отрисовки для сущности: (атлас, позиция, область)"""
+    source, area = entity.sprite
+    return (source, interpolate(entity, alpha), area)
+
+def entry_rect(entry):
+    """Прямоугольник на экране, который занимает элемент (изображение, позиция[, область])"""
+    source, dest = entry[0], entry[1]
+    area = entry[2] if len(entry) > 2 else None
+    width, height = (area[2], area[3]) if area else source.get_size()
+    return pygame.Rect(dest[0], dest[1], width, height)
+
+# Рисует слои игрового экрана (см. Game.draw_game) одним вызовом blits в порядке слоев
+def draw_layers(surface, layers):
+    surface.blits([entry for layer in layers for entry in layer], False)
+
+# Отрисовка игрового экрана с обновлением только измененных областей (dirty rects)
+class DirtyRectRenderer:
+    def __init__(self, threshold=0.5):
+        # Если измененная площадь больше этой доли экрана, дешевле перерисовать все и сделать flip
+        self.threshold = threshold
+        self.previous = None  # Прямоугольники, занятые слоями на прошлом кадре
+        self.background = None
+    
+    def reset(self):
+        """Следующий кадр будет перерисован целиком"""
+        self.previous = None
+    
+    def draw(self, surface, background, layers):
+        """Восстанавливает фон под старыми и новыми положениями слоев и рисует слои.
+        Возвращает измененные области или None, если кадр перерисован целиком"""
+        current = [entry_rect(entry) for layer in layers for entry in layer]
+        
+        full = self.previous is None or background is not self.background
+        if not full:
+            screen_rect = surface.get_rect()
+            damage = [rect for rect in (r.clip(screen_rect) for r in self.previous + current) if rect]
+            area = sum(rect.w * rect.h for rect in damage)
+            full = area > self.threshold * screen_rect.w * screen_rect.h
+        
+        self.previous = current
+        self.background = background
+        if full:
+            surface.blit(background, (0, 0))
+            draw_layers(surface, layers)
+            return None
+        
+        # Каждый слой попадает в собственный прямоугольник, поэтому фон под ним восстановлен целиком
+        surface.blits([(background, rect, rect) for rect in damage], False)
+        draw_layers(surface, layers)
+        return damage
+
+# Покадровый профайлер: время фаз главного цикла в кольцевом буфере.
+# Фаза — время от предыдущей отметки mark() до текущей; выключенный профайлер ничего не измеряет
+class FrameProfiler:
+    MAX_PHASES = 32
+    
+    def __init__(self, enabled=False, capacity=3600):
+        self.enabled = enabled
+        self.capacity = capacity  # Сколько последних кадров хранится
+        self.samples = np.zeros((capacity, self.MAX_PHASES))  # Строка — кадр, столбец — фаза, мс
+        self.phases = []  # Имена фаз в порядке первого появления
+        self.columns = {}  # Имя фазы -> столбец
+        self.frames = 0  # Всего завершенных кадров
+        self.row = 0
+        self.last = time.perf_counter()
+        
+        # Оверлей с перцентилями, пересчитывается раз в overlay_interval кадров
+        self.show_overlay = False
+        self.overlay_interval = 30
+        self.overlay_frame = -1
+        self.overlay = None
+        self.font = None
+    
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.row = self.frames % self.capacity
+        self.samples[self.row] = 0
+        self.last = time.perf_counter()
+    
+    def mark(self, phase):
+        """Засчитывает время с прошлой отметки фазе phase"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        column = self.columns.get(phase)
+        if column is None:
+            if len(self.phases) == self.MAX_PHASES:
+                self.last = now
+                return
+            column = self.columns[phase] = len(self.phases)
+            self.phases.append(phase)
+        self.samples[self.row, column] += (now - self.last) * 1000
+        self.last = now
+    
+    def end_frame(self):
+        if self.enabled:
+            self.frames += 1
+    
+    def toggle_overlay(self):
+        """Показывает или прячет оверлей; при первом показе включает сбор данных"""
+        self.show_overlay = not self.show_overlay
+        if self.show_overlay and not self.enabled:
+            self.enabled = True
+            self.begin_frame()
+    
+    def history(self):
+        """Завершенные кадры из буфера в хронологическом порядке"""
+        count = min(self.frames, self.capacity)
+        rows = np.arange(self.frames - count, self.frames) % self.capacity
+        return self.samples[rows, :len(self.phases)]
+    
+    def percentiles(self):
+        """Словарь фаза -> (p50, p95, p99) в мс; frame — время кадра целиком"""
+        data = self.history()
+        if not len(data):
+            return {}
+        result = {phase: tuple(np.percentile(data[:, column], (50, 95, 99)))
+                  for phase, column in self.columns.items()}
+        result["frame"] = tuple(np.percentile(data.sum(axis=1), (50, 95, 99)))
+        return result
+    
+    def overlay_layer(self):
+        """Слой с оверлеем для Game.draw_game (пустой, если оверлей скрыт)"""
+        if not self.show_overlay:
+            return []
+        if self.overlay is None or self.frames - self.overlay_frame >= self.overlay_interval:
+            self.overlay_frame = self.frames
+            if self.font is None:
+                self.font = pygame.font.Font(None, 18)
+            # Таблица: имя фазы и три столбца чисел, выровненных по правому краю
+            rows = [("phase", "p50", "p95", "p99")]
+            rows += [(phase, f"{p50:.2f}", f"{p95:.2f}", f"{p99:.2f}")
+                     for phase, (p50, p95, p99) in self.percentiles().items()]
+            name_width, column_width = 110, 45
+            line_height = self.font.get_linesize()
+            panel = pygame.Surface((name_width + 3 * column_width + 10, len(rows) * line_height + 10),
+                                   pygame.SRCALPHA)
+            panel.fill((0, 0, 0, 180))
+            for i, row in enumerate(rows):
+                y = 5 + i * line_height
+                panel.blit(self.font.render(row[0], True, WHITE), (5, y))
+                for j, value in enumerate(row[1:]):
+                    text = self.font.render(value, True, WHITE)
+                    panel.blit(text, (5 + name_width + (j + 1) * column_width - text.get_width(), y))
+            self.overlay = (panel, (10, SCREEN_HEIGHT - panel.get_height() - 40))
+        return [self.overlay]
+    
+    def dump(self, path):
+        """Сохраняет буфер кадров в CSV или JSON (по расширению файла)"""
+        data = self.history()
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump({
+                    "phases": self.phases,
+                    "percentiles": {phase: list(values) for phase, values in self.percentiles().items()},
+                    "frames": [dict(zip(self.phases, row)) for row in data.tolist()],
+                }, f)
+        else:
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["frame"] + self.phases + ["total"])
+                first = self.frames - len(data)
+                for i, row in enumerate(data.tolist()):
+                    writer.writerow([first + i] + [f"{value:.4f}" for value in row] + [f"{sum(row):.4f}"])
+
+# Телеметрия забегов: события фиксированного размера в кольцевом буфере. Игровой поток только
+# записывает событие в заранее выделенную строку; фоновый поток раз в TELEMETRY_FLUSH_INTERVAL
+# забирает накопившееся и дописывает пачкой в файл. Переполненный буфер не ждет запись,
+# а отбрасывает новые события и считает их
+class Telemetry:
+    def __init__(self, path=None, capacity=TELEMETRY_CAPACITY):
+        self.enabled = path is not None
+        self.path = path  # .npz — столбцы, по файлу на пачку; иначе JSON-строки в gzip
+        self.capacity = capacity
+        self.records = np.zeros(capacity, TELEMETRY_RECORD)
+        # Записывает только игровой поток (head), читает и освобождает только поток записи (tail):
+        # строки [tail, head) заполнены и ждут записи
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0  # Событий, отброшенных из-за переполнения
+        self.written = 0
+        self.batches = 0
+        self.sources = {"": 0}  # Источник урона -> номер (столбец source)
+        self.source_names = [""]
+        self.started = time.perf_counter()
+        self.wake = threading.Event()  # Будит поток записи раньше срока, когда буфер заполнен наполовину
+        self.closing = False
+        self.thread = None
+        self.held = None  # Если не None — список, в котором копятся события вместо буфера (см. hold)
+        if self.enabled:
+            if not path.endswith(".npz"):
+                open(path, "wb").close()
+            self.thread = threading.Thread(target=self.writer, name="telemetry", daemon=True)
+            self.thread.start()
+    
+    def emit(self, kind, run=0, room=0, subject=0, value=0, source="", x=0, y=0):
+        """Добавляет событие kind (из TELEMETRY_EVENTS); не блокируется и ничего не выделяет,
+        кроме номера для нового источника"""
+        if not self.enabled:
+            return
+        if self.held is not None:
+            self.held.append((time.perf_counter() - self.started, kind, run, room, subject, value, source, x, y))
+            return
+        self.write(time.perf_counter() - self.started, kind, run, room, subject, value, source, x, y)
+    
+    def hold(self):
+        """Дальше события копятся отдельно, пока их не заберет take()"""
+        self.held = []
+    
+    def take(self):
+        """Возвращает события, накопленные после hold(), и снова пишет их сразу в буфер"""
+        events, self.held = self.held, None
+        return events
+    
+    def commit(self, events):
+        """Записывает события, полученные от take(), с их исходным временем"""
+        for event in events:
+            self.write(*event)
+    
+    def write(self, t, kind, run, room, subject, value, source, x, y):
+        head = self.head
+        pending = head - self.tail
+        if pending >= self.capacity:
+            self.dropped += 1
+            return
+        source_id = self.sources.get(source)
+        if source_id is None:
+            source_id = self.sources[source] = len(self.source_names)
+            self.source_names.append(source)
+        self.records[head % self.capacity] = (t, run, TELEMETRY_KINDS[kind], room, subject, source_id, value, x, y)
+        self.head = head + 1
+        if pending == self.capacity // 2:
+            self.wake.set()
+    
+    def writer(self):
+        while not self.closing:
+            self.wake.wait(TELEMETRY_FLUSH_INTERVAL)
+            self.wake.clear()
+            self.flush()
+        self.flush()
+    
+    def flush(self):
+        """Дописывает в файл накопившиеся события (вызывается из потока записи)"""
+        head, tail = self.head, self.tail
+        if head == tail:
+            return
+        batch = self.records[np.arange(tail, head) % self.capacity]
+        self.tail = head
+        dropped = self.dropped
+        if self.path.endswith(".npz"):
+            np.savez_compressed(f"{self.path[:-4]}-{self.batches:05d}.npz",
+                                events=np.array(TELEMETRY_EVENTS), sources=np.array(self.source_names),
+                                dropped=dropped, **{name: batch[name] for name in TELEMETRY_RECORD.names})
+        else:
+            names = self.source_names
+            lines = [json.dumps({"t": round(t, 4), "run": run, "event": TELEMETRY_EVENTS[kind], "room": room,
+                                 "subject": subject, "source": names[source], "value": value, "x": x, "y": y})
+                     for t, run, kind, room, subject, source, value, x, y in batch.tolist()]
+            lines.append(json.dumps({"event": "dropped", "count": dropped}))
+            # Каждая пачка — отдельный член gzip: файл читается целиком, даже если игра не закрыла его
+            with gzip.open(self.path, "ab") as f:
+                f.write(("\n".join(lines) + "\n").encode())
+        self.written += len(batch)
+        self.batches += 1
+    
+    def close(self):
+        """Дописывает оставшиеся события и останавливает поток записи"""
+        if self.thread:
+            self.closing = True
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+
+# Контрольная сумма состояния для сверки повторов и сетевых пиров
+def state_checksum(game):
+    """CRC32 состояния забега: игрок, враги, босс и живые пули"""
+    player = game.player
+    values = [game.state.value, game.room_count, ROOM_LAYOUT_NAMES.index(game.room.layout), player.rect.x, player.rect.y, player.health,
+              player.fire_delay, player.invincible_timer]
+    for partner in game.players[1:]:
+        values += [partner.rect.x, partner.rect.y, partner.health, partner.fire_delay, partner.invincible_timer]
+    ai = game.enemy_ai
+    for enemy, fire_delay, point in zip(ai.enemies, ai.fire_delay.tolist(), ai.current_point.tolist()):
+        values += [enemy.enemy_type, enemy.rect.x, enemy.rect.y, enemy.health, fire_delay, point]
+    if game.boss:
+        boss = game.boss
+        values += [boss.rect.x, boss.rect.y, boss.health, boss.phase, boss.attack_pattern,
+                   boss.attack_timer, boss.fire_delay]
+    checksum = zlib.crc32(struct.pack(f"<{len(values)}i", *values))
+    
+    bullets = game.bullets
+    alive = np.flatnonzero(bullets.alive)
+    for array in (bullets.x, bullets.y, bullets.vx, bullets.vy, bullets.owner):
+        checksum = zlib.crc32(array[alive].tobytes(), checksum)
+    return checksum
+
+# Форматы частей снимка состояния (см. snapshot_game)
+# Игра: версия, хэш масок коллизий (см. Assets.get_collision_hash), состояние, зерно забега (-1 — нет), комната, комнат до босса, раскладка камней
+# (номер в ROOM_LAYOUT_NAMES), персонажи игроков, число игроков, число врагов, есть ли босс,
+# длина статистики урона (JSON)
+SNAPSHOT_GAME = struct.Struct("<HIBqiiBBBBBBI")
+# Игрок: персонаж, номер, положение, прошлое положение, здоровье, макс. здоровье,
+# задержка выстрела, неуязвимость, таймер неуязвимости
+SNAPSHOT_PLAYER = struct.Struct("<BBiiiiiiiBi")
+# Враг: тип, владелец пуль, точка появления, положение, прошлое положение, здоровье, задержка выстрела,
+# текущая точка маршрута, точки патрулирования (маршрут в обход камней строится по ним заново)
+SNAPSHOT_ENEMY = struct.Struct("<Biiiiiiiiii8d")
+# Босс: положение, прошлое положение, здоровье, скорость, фаза, шаг расписания, таймер шага,
+# задержка выстрела, залпов в очереди, залпов всего
+SNAPSHOT_BOSS = struct.Struct("<iiiiidiiiiii")
+# Генератор случайных чисел: 625 слов состояния Mersenne Twister, есть ли запасное значение gauss, оно само
+SNAPSHOT_RNG = struct.Struct("<625I?d")
+
+def pack_rng(rng):
+    """Состояние random.Random в байтах"""
+    version, words, gauss = rng.getstate()
+    return SNAPSHOT_RNG.pack(*words, gauss is not None, gauss or 0.0)
+
+def unpack_rng(rng, data, offset):
+    """Восстанавливает random.Random из pack_rng(); возвращает смещение за концом его данных"""
+    *words, has_gauss, gauss = SNAPSHOT_RNG.unpack_from(data, offset)
+    rng.setstate((3, tuple(words), gauss if has_gauss else None))
+    return offset + SNAPSHOT_RNG.size
+
+def snapshot_game(game):
+    """Снимок всего состояния забега в байтах, включая генераторы случайных чисел.
+    Источники ввода в снимок не входят"""
+    damage = json.dumps([[room, source, value] for (room, source), value in game.damage_taken.items()]).encode()
+    ai = game.enemy_ai
+    parts = [SNAPSHOT_MAGIC, SNAPSHOT_GAME.pack(
+        SNAPSHOT_VERSION, assets.get_collision_hash(), game.state.value, -1 if game.run_seed is None else game.run_seed,
+        game.room_count, game.max_rooms, ROOM_LAYOUT_NAMES.index(game.room.layout),
+        game.selected_character, game.partner_character, len(game.players), len(ai.enemies), game.boss is not None, len(damage))]
+    parts += [pack_rng(game.rng), pack_rng(game.seeds), damage]
+    for player in game.players:
+        parts.append(SNAPSHOT_PLAYER.pack(
+            player.player_type, player.slot, player.rect.x, player.rect.y, *player.prev_pos,
+            player.health, player.max_health, player.fire_delay, player.invincible, player.invincible_timer))
+    for i, enemy in enumerate(ai.enemies):
+        parts.append(SNAPSHOT_ENEMY.pack(
+            enemy.enemy_type, enemy.owner_id, *enemy.home, enemy.rect.x, enemy.rect.y, *enemy.prev_pos,
+            enemy.health, int(ai.fire_delay[i]), int(ai.current_point[i]),
+            *np.ravel(getattr(enemy, "patrol_points", None) or [(0, 0)] * 4).tolist()))
+    if game.boss:
+        boss = game.boss
+        parts.append(SNAPSHOT_BOSS.pack(
+            boss.rect.x, boss.rect.y, *boss.prev_pos, boss.health, boss.speed, boss.phase,
+            boss.attack_pattern, boss.attack_timer, boss.fire_delay, boss.burst_shot, boss.volley))
+    parts.append(game.bullets.pack_state())
+    return b"".join(parts)
+
+def restore_game(game, data):
+    """Восстанавливает забег из snapshot_game(). Игроки, враги и босс создаются заново,
+    генераторы случайных чисел восстанавливаются последними"""
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("это не снимок состояния игры")
+    offset = len(SNAPSHOT_MAGIC)
+    (version, collision_hash, state, run_seed, room_count, max_rooms, layout, character, partner_character,
+     player_count, enemy_count, has_boss, damage_size) = SNAPSHOT_GAME.unpack_from(data, offset)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"неподдерживаемая версия снимка {version}")
+    if collision_hash != assets.get_collision_hash():
+        raise ValueError("снимок сделан с другими масками коллизий")
+    offset += SNAPSHOT_GAME.size
+    rng_offset = offset
+    offset += 2 * SNAPSHOT_RNG.size
+    damage = json.loads(data[offset:offset + damage_size])
+    offset += damage_size
+    
+    game.state = GameState(state)
+    game.run_seed = None if run_seed < 0 else run_seed
+    game.room_count, game.max_rooms = room_count, max_rooms
+    game.room.load(ROOM_LAYOUT_NAMES[layout])
+    game.selected_character, game.partner_character = character, partner_character
+    game.damage_taken = {(room, source): value for room, source, value in damage}
+    
+    players = []
+    for _ in range(player_count):
+        (player_type, slot, x, y, prev_x, prev_y, health, max_health, fire_delay, invincible,
+         invincible_timer) = SNAPSHOT_PLAYER.unpack_from(data, offset)
+        offset += SNAPSHOT_PLAYER.size
+        player = Player(player_type, game.bullets, slot)
+        player.rect.topleft = (x, y)
+        player.prev_pos = (prev_x, prev_y)
+        player.health, player.max_health, player.fire_delay = health, max_health, fire_delay
+        player.invincible, player.invincible_timer = bool(invincible), invincible_timer
+        players.append(player)
+    game.players = players
+    
+    enemies = []
+    for _ in range(enemy_count):
+        (enemy_type, owner_id, home_x, home_y, x, y, prev_x, prev_y, health, fire_delay, current_point,
+         *patrol) = SNAPSHOT_ENEMY.unpack_from(data, offset)
+        offset += SNAPSHOT_ENEMY.size
+        enemy = Enemy(enemy_type, home_x, home_y, owner_id, game.rng)
+        enemy.rect.topleft = (x, y)
+        enemy.prev_pos = (prev_x, prev_y)
+        enemy.health, enemy.fire_delay = health, fire_delay
+        if enemy_type == 3:
+            enemy.patrol_points = list(zip(patrol[0::2], patrol[1::2]))
+            enemy.current_point = current_point
+        enemies.append(enemy)
+    game.enemies = pygame.sprite.Group(enemies)
+    game.enemy_ai.reset(enemies)
+    
+    game.boss = None
+    if has_boss:
+        (x, y, prev_x, prev_y, health, speed, phase, attack_pattern, attack_timer, fire_delay,
+         burst_shot, volley) = SNAPSHOT_BOSS.unpack_from(data, offset)
+        offset += SNAPSHOT_BOSS.size
+        boss = Boss(0, 0, game.bullets, game.rng, game.room)
+        boss.rect.topleft = (x, y)
+        boss.prev_pos = (prev_x, prev_y)
+        boss.health, boss.speed, boss.phase = health, speed, phase
+        boss.attack_pattern, boss.attack_timer, boss.fire_delay = attack_pattern, attack_timer, fire_delay
+        boss.burst_shot, boss.volley = burst_shot, volley
+        game.boss = boss
+    
+    game.bullets.unpack_state(data, offset)
+    unpack_rng(game.seeds, data, unpack_rng(game.rng, data, rng_offset))
+
+# Продолжение забега между запусками (--resume)
+def load_resume(game, path):
+    """Восстанавливает забег, сохраненный save_resume(), если файл есть. Снимок старого формата
+    или от других изображений пропускается: игра начинается с меню"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        restore_game(game, data)
+        assets.play_music("boss" if game.boss else "game")
+    except ValueError as e:
+        print(f"Не удалось продолжить забег из {path}: {e}")
+
+def save_resume(game, path):
+    """Незаконченный забег сохраняется, законченный — больше не продолжится"""
+    if game.state == GameState.GAME:
+        with open(path, "wb") as f:
+            f.write(snapshot_game(game))
+    elif os.path.exists(path):
+        os.remove(path)
+
+# Пакеты совместной игры: первый байт — тип пакета
+NET_HELLO = b"H"  # Гость -> хозяин: байт персонажа гостя
+NET_START = b"S"  # Хозяин -> гость: NET_START_BODY
+NET_INPUT = b"I"  # Ввод: NET_INPUT_HEADER, затем маски клавиш
+NET_LEAVE = b"L"  # Игрок вышел в меню после конца забега
+# Зерно забега, персонажи хозяина и гостя
+NET_START_BODY = struct.Struct("<IBB")
+# Сколько масок напарника уже получено, шаг первой маски в пакете, число масок,
+# шаг и значение последней окончательной контрольной суммы
+NET_INPUT_HEADER = struct.Struct("<iiiiI")
+
+# Класс для имитации плохой сети поверх UDP-сокета: задержка, ее разброс и потеря пакетов.
+# Отправленные пакеты ждут в очереди и уходят в сокет, когда подойдет их время
+class LossyLink:
+    def __init__(self, sock, latency=0.0, jitter=0.0, loss=0.0, seed=None, clock=time.perf_counter):
+        self.sock = sock
+        self.latency = latency  # Задержка в одну сторону, с
+        self.jitter = jitter  # Случайная добавка к задержке, с (пакеты могут прийти не по порядку)
+        self.loss = loss  # Доля теряемых пакетов
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self.queue = []  # Куча (время отправки, номер пакета, данные, адрес)
+        self.sent = 0
+        self.dropped = 0
+    
+    def sendto(self, data, address):
+        self.sent += 1
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        due = self.clock() + self.latency + self.rng.random() * self.jitter
+        heapq.heappush(self.queue, (due, self.sent, data, address))
+    
+    def flush(self):
+        """Отправляет пакеты, время которых подошло"""
+        now = self.clock()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, data, address = heapq.heappop(self.queue)
+            self.sock.sendto(data, address)
+    
+    def recvfrom(self, size):
+        self.flush()
+        return self.sock.recvfrom(size)
+    
+    def close(self):
+        """Отправляет все задержанные пакеты без ожидания и закрывает сокет"""
+        while self.queue:
+            _, _, data, address = heapq.heappop(self.queue)
+            self.sock.sendto(data, address)
+        self.sock.close()
+
+# Класс для совместной игры вдвоем по UDP с откатом (rollback). Игрок 0 — хозяин, игрок 1 — гость.
+# Каждая сторона сразу делает шаг со своим вводом, а ввод напарника предсказывает повтором его
+# последней маски. Когда приходит настоящий ввод и он расходится с предсказанием, игра
+# восстанавливается из снимка того шага и пересчитывает шаги до текущего.
+# Ввод игроков игры — ScriptedInput, в них перед каждым шагом кладутся маски этого шага
+class NetSession:
+    def __init__(self, game, sock, local, peer=None, character=1, clock=time.perf_counter):
+        self.game = game
+        self.sock = sock  # Неблокирующий UDP-сокет или LossyLink
+        self.local = local  # Номер своего игрока
+        self.remote = 1 - local
+        self.peer = peer  # Адрес напарника; хозяин узнает его из приветствия
+        self.character = character
+        self.clock = clock
+        self.started = False
+        self.seed = None  # Зерно, с которого обе стороны начинают забег
+        self.hello_time = None  # Когда гость последний раз отправил приветствие
+        # Маски ввода игроков начиная с шага 0. Свой ввод опережает симуляцию на NET_INPUT_DELAY
+        # шагов, ввод напарника известен до шага self.confirmed
+        self.inputs = [bytearray(), bytearray()]
+        self.inputs[local].extend(bytes(NET_INPUT_DELAY))
+        self.remote_ack = 0  # Сколько наших масок напарник уже получил
+        self.frame = 0  # Номер следующего шага симуляции
+        self.predicted = {}  # Шаг -> предсказанная маска напарника, с которой он просчитан
+        self.snapshots = {}  # Шаг -> снимок состояния перед ним (только для предсказанных шагов)
+        self.rollback_from = None  # Самый ранний шаг с неверным предсказанием
+        # Шаг -> события телеметрии шага. В телеметрию они попадают, только когда ввод напарника
+        # на шаге подтвержден, чтобы откаты не оставляли в ней событий неверного предсказания
+        self.events = {}
+        # Контрольные суммы снимков, которые уже не изменятся, для поиска рассинхронизации:
+        # свои и присланные напарником (шаг -> сумма), последняя своя и последний сверенный шаг
+        self.checksums = {}
+        self.remote_checksums = {}
+        self.last_check = (-1, 0)
+        self.checked = -1
+        # Статистика
+        self.rollbacks = 0
+        self.resimulated = 0  # Шагов, пересчитанных после откатов
+        self.stalls = 0  # Раз, когда пришлось ждать ввод напарника
+        self.checks = 0
+        self.desyncs = 0
+        game.networked = True
+    
+    @property
+    def confirmed(self):
+        """Первый шаг, ввод напарника на котором еще не получен"""
+        return len(self.inputs[self.remote])
+    
+    def advance(self, keys):
+        """Принимает пакеты и, если можно, делает один шаг симуляции со своим вводом keys.
+        Возвращает False, если шаг не сделан: забег еще не начался или напарник слишком отстал"""
+        self.receive()
+        if not self.game.networked:
+            # Напарник вышел из сессии
+            return False
+        if not self.started:
+            if self.local == 1 and (self.hello_time is None or self.clock() - self.hello_time >= NET_HELLO_INTERVAL):
+                self.hello_time = self.clock()
+                self.send(NET_HELLO + bytes((self.character,)))
+            return False
+        if self.frame - self.confirmed >= NET_MAX_ROLLBACK:
+            self.stalls += 1
+            self.send_inputs()
+            return False
+        
+        self.inputs[self.local].append(keys_to_mask(keys))
+        self.send_inputs()
+        if self.rollback_from is not None:
+            self.rollback()
+        self.step()
+        self.prune()
+        return True
+    
+    def begin(self, seed, host_character, guest_character):
+        """Начинает забег; у обеих сторон он начинается из одного и того же состояния"""
+        self.seed = seed
+        game = self.game
+        game.seeds.seed(seed)
+        game.selected_character, game.partner_character = host_character, guest_character
+        game.start_game()
+        self.started = True
+    
+    def send(self, data):
+        if self.peer:
+            self.sock.sendto(data, self.peer)
+    
+    def send_inputs(self):
+        """Отправляет свои маски, которые напарник еще не подтвердил (пакеты теряются, поэтому
+        каждая маска повторяется, пока не придет подтверждение)"""
+        first = self.remote_ack
+        masks = self.inputs[self.local][first:first + NET_PACKET_INPUTS]
+        self.send(NET_INPUT + NET_INPUT_HEADER.pack(self.confirmed, first, len(masks), *self.last_check) + masks)
+    
+    def receive(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                # Так Windows сообщает, что порт напарника еще не открыт
+                continue
+            kind = data[:1]
+            
+            if kind == NET_HELLO and self.local == 0:
+                if not self.started:
+                    self.peer = address
+                    self.begin(self.game.seeds.getrandbits(32), self.character, data[1])
+                # Ответ мог потеряться: гость повторяет приветствие, пока не получит его
+                if address == self.peer:
+                    game = self.game
+                    self.send(NET_START + NET_START_BODY.pack(self.seed, game.selected_character,
+                                                              game.partner_character))
+            
+            elif kind == NET_START and self.local == 1 and not self.started and address == self.peer:
+                self.begin(*NET_START_BODY.unpack_from(data, 1))
+            
+            elif kind == NET_INPUT and self.started and address == self.peer:
+                ack, first, count, check_frame, checksum = NET_INPUT_HEADER.unpack_from(data, 1)
+                self.remote_ack = max(self.remote_ack, ack)
+                remote = self.inputs[self.remote]
+                known = len(remote)
+                # Маски берутся, только если продолжают уже известные: пропуски закроют повторы
+                if first <= known < first + count:
+                    offset = 1 + NET_INPUT_HEADER.size + known - first
+                    remote.extend(data[offset:offset + first + count - known])
+                    # Шаги, которые уже просчитаны с предсказанием, сверяются с настоящим вводом
+                    for frame in range(known, min(len(remote), self.frame)):
+                        if self.predicted.pop(frame) != remote[frame] and self.rollback_from is None:
+                            self.rollback_from = frame
+                if check_frame > self.checked:
+                    self.remote_checksums[check_frame] = checksum
+                    self.compare(check_frame)
+            
+            elif kind == NET_LEAVE and address == self.peer:
+                # Напарник вышел в меню: забег вдвоем продолжить нельзя, выходим и мы
+                self.game.leave_network()
+    
+    def step(self):
+        """Шаг симуляции self.frame. Если ввод напарника на нем предсказан, перед шагом
+        сохраняется снимок для отката"""
+        frame = self.frame
+        remote = self.inputs[self.remote]
+        if frame < len(remote):
+            mask = remote[frame]
+            if frame % NET_CHECK_INTERVAL == 0:
+                self.add_checksum(frame, zlib.crc32(snapshot_game(self.game)))
+        else:
+            mask = remote[-1] if remote else 0
+            self.predicted[frame] = mask
+            self.snapshots[frame] = snapshot_game(self.game)
+        self.game.inputs[self.remote].keys = MASK_KEYS[mask]
+        self.game.inputs[self.local].keys = MASK_KEYS[self.inputs[self.local][frame]]
+        telemetry = self.game.telemetry
+        if telemetry.enabled:
+            telemetry.hold()
+            self.game.update()
+            events = telemetry.take()
+            if events:
+                self.events[frame] = events
+        else:
+            self.game.update()
+        self.frame += 1
+    
+    def rollback(self):
+        """Восстанавливает снимок первого неверно предсказанного шага и пересчитывает шаги
+        до текущего, уже с полученным вводом. Пересчитанные шаги уже звучали, поэтому звук выключен;
+        события телеметрии отмененных шагов отбрасываются"""
+        target = self.frame
+        self.frame = self.rollback_from
+        self.rollback_from = None
+        restore_game(self.game, self.snapshots[self.frame])
+        # Более поздние снимки сделаны по неверному предсказанию
+        self.snapshots = {frame: data for frame, data in self.snapshots.items() if frame < self.frame}
+        self.events = {frame: events for frame, events in self.events.items() if frame < self.frame}
+        self.rollbacks += 1
+        self.resimulated += target - self.frame
+        assets.muted = True
+        while self.frame < target:
+            self.step()
+        assets.muted = False
+    
+    def leave(self):
+        """Сообщает напарнику о выходе из сессии и закрывает сокет"""
+        for _ in range(NET_LEAVE_REPEATS):
+            self.send(NET_LEAVE)
+        self.sock.close()
+    
+    def prune(self):
+        """Снимки до подтвержденного шага для отката больше не нужны: из них остаются только
+        контрольные суммы для сверки с напарником. События телеметрии этих шагов записываются"""
+        confirmed = self.confirmed
+        for frame in [frame for frame in self.events if frame < confirmed]:
+            self.game.telemetry.commit(self.events.pop(frame))
+        for frame in [frame for frame in self.snapshots if frame < confirmed]:
+            data = self.snapshots.pop(frame)
+            if frame % NET_CHECK_INTERVAL == 0:
+                self.add_checksum(frame, zlib.crc32(data))
+    
+    def add_checksum(self, frame, checksum):
+        self.checksums[frame] = checksum
+        if frame > self.last_check[0]:
+            self.last_check = (frame, checksum)
+        self.compare(frame)
+    
+    def compare(self, frame):
+        """Сверяет контрольные суммы шага frame, если они уже есть у обеих сторон"""
+        if frame not in self.checksums or frame not in self.remote_checksums:
+            return
+        self.checks += 1
+        if self.checksums[frame] != self.remote_checksums[frame]:
+            self.desyncs += 1
+        self.checked = frame
+        # Более ранние суммы сверить уже не получится: напарник присылает только последнюю
+        self.checksums = {f: value for f, value in self.checksums.items() if f > frame}
+        self.remote_checksums = {f: value for f, value in self.remote_checksums.items() if f > frame}
+
+# Запись забегов: персонаж, зерно, маска клавиш на каждый шаг и контрольные суммы
+class ReplayRecorder:
+    # Формат файла: REPLAY_MAGIC, заголовок "<HII" (версия, число забегов, хэш масок коллизий —
+    # см. Assets.get_collision_hash), затем для каждого забега
+    # заголовок "<BIII" (персонаж, зерно, число шагов, число контрольных сумм), байты масок
+    # и контрольные суммы uint32
+    def __init__(self):
+        self.runs = []  # Список (персонаж, зерно, маски, контрольные суммы)
+    
+    def start_run(self, character, seed):
+        self.runs.append((character, seed, bytearray(), []))
+    
+    def record(self, keys, game):
+        """Запоминает ввод шага, уже примененный к game, и время от времени — контрольную сумму"""
+        _, _, inputs, checksums = self.runs[-1]
+        inputs.append(keys_to_mask(keys))
+        if len(inputs) % CHECKPOINT_INTERVAL == 0:
+            checksums.append(state_checksum(game))
+    
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(REPLAY_MAGIC)
+            f.write(struct.pack("<HII", REPLAY_VERSION, len(self.runs), assets.get_collision_hash()))
+            for character, seed, inputs, checksums in self.runs:
+                f.write(struct.pack("<BIII", character, seed, len(inputs), len(checksums)))
+                f.write(inputs)
+                f.write(np.array(checksums, dtype="<u4").tobytes())
+
+def load_replay(path):
+    """Читает запись и возвращает список забегов (персонаж, зерно, маски, контрольные суммы)"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(REPLAY_MAGIC)] != REPLAY_MAGIC:
+        raise ValueError(f"{path}: это не запись забега")
+    offset = len(REPLAY_MAGIC)
+    version, run_count, collision_hash = struct.unpack_from("<HII", data, offset)
+    if version != REPLAY_VERSION:
+        raise ValueError(f"{path}: неподдерживаемая версия записи {version}")
+    if collision_hash != assets.get_collision_hash():
+        raise ValueError(f"{path}: запись сделана с другими масками коллизий")
+    offset += struct.calcsize("<HII")
+    
+    runs = []
+    for _ in range(run_count):
+        character, seed, frames, checkpoints = struct.unpack_from("<BIII", data, offset)
+        offset += struct.calcsize("<BIII")
+        inputs = data[offset:offset + frames]
+        offset += frames
+        checksums = np.frombuffer(data, dtype="<u4", count=checkpoints, offset=offset).tolist()
+        offset += checkpoints * 4
+        runs.append((character, seed, inputs, checksums))
+    return runs
+
+# Выводит кадр: только измененные области или весь экран
+def present(dirty):
+    presenter.present(dirty)
+
+# Класс для вывода кадра в окно: напрямую или с масштабированием (см. SCALE_MODES)
+class Presenter:
+    def __init__(self, mode="off", window_size=None, fullscreen=False, smooth=False):
+        self.mode = mode
+        self.smooth = smooth  # Сглаживающий фильтр вместо ближайшего соседа
+        flags = pygame.FULLSCREEN if fullscreen else 0
+        if mode in ("off", "scaled"):
+            if mode == "scaled":
+                # Фильтр масштабирования SDL; подсказка читается при создании окна
+                os.environ["SDL_RENDER_SCALE_QUALITY"] = "linear" if smooth else "nearest"
+                flags |= pygame.SCALED
+            self.window = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), flags)
+            self.surface = self.window
+            self.target = None
+        else:
+            if not fullscreen:
+                flags |= pygame.RESIZABLE
+            size = window_size or ((0, 0) if fullscreen else (SCREEN_WIDTH, SCREEN_HEIGHT))
+            self.window = pygame.display.set_mode(size, flags)
+            self.surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+            self.layout()
+    
+    def layout(self):
+        """Пересчитывает область окна, в которую выводится кадр; вызывается при изменении размера окна"""
+        if self.mode in ("off", "scaled"):
+            return
+        self.window = pygame.display.get_surface()
+        width, height = self.window.get_size()
+        factor = min(width / SCREEN_WIDTH, height / SCREEN_HEIGHT)
+        # Целый коэффициент, если окно вмещает кадр хотя бы один раз, иначе — уменьшение с пропорциями
+        self.factor = int(factor) if self.mode == "integer" and factor >= 1 else None
+        if self.factor:
+            size = (SCREEN_WIDTH * self.factor, SCREEN_HEIGHT * self.factor)
+        else:
+            size = (max(1, round(SCREEN_WIDTH * factor)), max(1, round(SCREEN_HEIGHT * factor)))
+        self.viewport = pygame.Rect((0, 0), size)
+        self.viewport.center = (width // 2, height // 2)
+        self.window.fill(BLACK)  # Поля вокруг кадра
+        self.target = self.window.subsurface(self.viewport)
+        self.full = True  # Следующий кадр выводится в окно целиком
+    
+    def present(self, dirty):
+        """Выводит кадр из self.surface; dirty — измененные области или None для всего кадра"""
+        if self.target is None:
+            if dirty is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty)
+            return
+        
+        # Без сглаживания и с целым коэффициентом пиксели областей не зависят от соседей,
+        # поэтому достаточно масштабировать только измененные области
+        if dirty is not None and self.factor and not self.smooth and not self.full:
+            factor, bounds = self.factor, self.surface.get_rect()
+            updated = []
+            for rect in dirty:
+                rect = rect.clip(bounds)
+                if not rect:
+                    continue
+                area = pygame.Rect(rect.x * factor, rect.y * factor, rect.w * factor, rect.h * factor)
+                pygame.transform.scale(self.surface.subsurface(rect), area.size, self.target.subsurface(area))
+                updated.append(area.move(self.viewport.topleft))
+            pygame.display.update(updated)
+            return
+        
+        scale = pygame.transform.smoothscale if self.smooth else pygame.transform.scale
+        scale(self.surface, self.viewport.size, self.target)
+        self.full = False
+        pygame.display.flip()
 
 # Класс для игры
 class Game:
-    def __init__(self):
+    def __init__(self, input_source=None, dirty_rects=False, profiler=None, seed=None, recorder=None,
+                 partner_input=None, telemetry=None):
         self.state = GameState.TITLE
+        self.input = input_source or KeyboardInput()  # Источник ввода игрока
+        # Источники ввода всех игроков; второй игрок есть только в совместной игре
+        self.inputs = [self.input] + ([partner_input] if partner_input else [])
+        self.profiler = profiler or FrameProfiler()  # Время фаз кадра (выключен по умолчанию)
+        self.telemetry = telemetry or Telemetry()  # События забега (выключена по умолчанию)
+        self.renderer = DirtyRectRenderer() if dirty_rects else None  # Отрисовка только изменений
+        self.hud = HudCompositor()  # Кэш сердец и полоски здоровья босса
+        self.partner_hud = HudCompositor()  # Кэш сердец второго игрока
+        self.static_screen = None  # Собранный статичный экран (меню, Game Over, победа)
+        self.static_key = None  # Что было показано на собранном экране
+        self.bullets = BulletPool()  # Все пули игрока, врагов и босса
+        self.particles = ParticlePool(seed=seed)  # Вспышки при попаданиях, смертях и смене фазы босса
+        self.collisions = SpatialHash()  # Широкая фаза для проверок коллизий
+        self.room = RoomMap()  # Камни текущей комнаты и поля направлений для преследователей
+        self.enemy_ai = EnemyAI(self.bullets, self.room)  # Движение и стрельба врагов комнаты
+        self.seeds = random.Random(seed)  # Источник зерен для забегов
+        self.rng = random.Random()  # Вся случайность забега берется отсюда
+        self.run_seed = None  # Зерно текущего забега
+        self.recorder = recorder  # Запись ввода для воспроизведения
+        self.damage_taken = {}  # Урон игроку за забег: (комната, источник) -> урон
+        self.networked = False  # В сетевой игре забег начинается и заканчивается только по сети
         self.reset_game()
     
+    @property
+    def player(self):
+        """Первый игрок (в одиночной игре — единственный)"""
+        return self.players[0] if self.players else None
+    
+    def active_players(self):
+        """Игроки, которые еще живы"""
+        return [player for player in self.players if player.health > 0]
+    
+    def nearest_player(self, entity):
+        """Ближайший к сущности живой игрок"""
+        x, y = entity.rect.center
+        return min(self.active_players(),
+                   key=lambda player: (player.rect.centerx - x)**2 + (player.rect.centery - y)**2)
+    
+    def event(self, kind, entity=None, subject=0, value=0, source=""):
+        """Событие забега в текущей комнате: пишется в телеметрию и, если для него есть вспышка
+        в PARTICLE_EMITTERS, вызывает ее в центре entity"""
+        if kind in PARTICLE_BURSTS:
+            self.effect(kind, *entity.rect.center)
+        if self.telemetry.enabled:
+            x, y = entity.rect.center if entity else (0, 0)
+            self.telemetry.emit(kind, self.run_seed, self.room_count, subject, value, source, x, y)
+    
+    def effect(self, name, x, y):
+        """Вспышка частиц name в точке (x, y). Шаги, пересчитанные после отката, вспышки не повторяют;
+        процесс симуляции (--pipeline) передает их процессу отрисовки"""
+        if not assets.muted and not assets.forward("effect", name, x, y):
+            self.particles.emit(name, x, y)
+    
     def reset_game(self):
-        self.player = None
+        self.players = []
         self.enemies = pygame.sprite.Group()
         self.boss = None
         self.room_count = 0
         self.max_rooms = 5  # Количество комнат до появления босса
         self.selected_character = 1
+        self.partner_character = 2  # Персонаж второго игрока в совместной игре
+        assets.prefetch_background(1)  # Фон первой комнаты грузится, пока открыто меню
         
-        # Установка начальной музыки
+        # Установка начальной музыки; музыка игры загружается, пока открыто меню
         assets.play_music("menu")
+        assets.queue_music("game")
     
     def spawn_enemies(self):
         # Очистка существующих врагов
@@ -577,124 +3603,244 @@ class Game:
         # Увеличение счетчика комнат
         self.room_count += 1
         
+        # Пока идет эта комната, в фоне загружаем фон следующей (и босса перед его комнатой)
+        assets.prefetch_background(self.room_count + 1)
+        if self.room_count + 1 >= self.max_rooms:
+            assets.prefetch("boss")
+            assets.queue_music("boss")
+        
         # Если достигли максимального количества комнат, создаем босса
         if self.room_count >= self.max_rooms:
-            self.boss = Boss(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
+            self.room.load(BOSS_LAYOUT)
+            self.clear_rocks()
+            self.boss = Boss(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2, self.bullets, self.rng, self.room)
+            self.enemy_ai.reset(self.enemies)
             assets.play_music("boss")  # Включаем музыку для боя с боссом
             return
         
-        # Иначе создаем обычных врагов
-        enemy_count = random.randint(3, 5)
-        for _ in range(enemy_count):
-            enemy_type = random.randint(1, 3)
+        # Иначе расставляем камни и создаем обычных врагов
+        self.room.load(self.rng.choice(ENEMY_LAYOUTS))
+        self.clear_rocks()
+        enemy_count = self.rng.randint(3, 5)
+        for i in range(enemy_count):
+            enemy_type = self.rng.randint(1, 3)
             
             # Случайное расположение врага
-            x = random.randint(50, SCREEN_WIDTH - 50)
-            y = random.randint(50, SCREEN_HEIGHT - 50)
+            x = self.rng.randint(50, SCREEN_WIDTH - 50)
+            y = self.rng.randint(50, SCREEN_HEIGHT - 50)
             
-            # Проверка, чтобы враг не появился слишком близко к игроку
-            if self.player:
-                while (abs(x - self.player.rect.centerx) < 150 and 
-                       abs(y - self.player.rect.centery) < 150):
-                    x = random.randint(50, SCREEN_WIDTH - 50)
-                    y = random.randint(50, SCREEN_HEIGHT - 50)
+            # Проверка, чтобы враг не появился слишком близко к игрокам или в камнях
+            w, h = IMAGE_SPECS[f"enemy_{enemy_type}"][1]
+            while (any(abs(x - player.rect.centerx) < 150 and abs(y - player.rect.centery) < 150
+                       for player in self.players) or self.room.blocked(pygame.Rect(x - w // 2, y - h // 2, w, h))):
+                x = self.rng.randint(50, SCREEN_WIDTH - 50)
+                y = self.rng.randint(50, SCREEN_HEIGHT - 50)
             
-            enemy = Enemy(enemy_type, x, y)
+            enemy = Enemy(enemy_type, x, y, i + 1, self.rng)
             self.enemies.add(enemy)
+        self.enemy_ai.reset(self.enemies)
     
-    def start_game(self):
+    def clear_rocks(self):
+        """Игроки, на месте которых в новой комнате оказались камни, переходят на ближайшее свободное место"""
+        for player in self.players:
+            self.room.push_out(player.rect)
+            player.prev_pos = player.rect.topleft
+    
+    def start_game(self, seed=None):
+        """Начинает забег; зерно по умолчанию берется из self.seeds, при воспроизведении — из записи"""
+        self.run_seed = self.seeds.getrandbits(32) if seed is None else seed
+        self.rng.seed(self.run_seed)
+        if self.recorder:
+            self.recorder.start_run(self.selected_character, self.run_seed)
+        
         self.state = GameState.GAME
-        self.player = Player(self.selected_character)
+        self.bullets.clear()
+        self.particles.clear(self.run_seed)
+        self.players = [Player(self.selected_character, self.bullets)]
+        if len(self.inputs) > 1:
+            # Вдвоем игроки начинают по обе стороны от центра
+            partner = Player(self.partner_character, self.bullets, slot=1)
+            self.players.append(partner)
+            for player, shift in zip(self.players, (-60, 60)):
+                player.rect.x += shift
+                player.prev_pos = player.rect.topleft
+        self.boss = None
         self.room_count = 0
+        self.damage_taken = {}
+        for player in self.players:
+            self.event("run_start", player, player.player_type, player.health)
         self.spawn_enemies()
         assets.play_music("game")  # Включаем музыку для игры
     
     def update(self):
+        """Один шаг симуляции фиксированной длины (1 / FPS секунды)"""
+        # Частицы - чисто визуальный слой: в симуляцию не входят и при откате не пересчитываются
+        if not assets.muted:
+            self.particles.update()
+        
         if self.state == GameState.GAME:
-            # Обновление игрока
-            self.player.update()
+            # Запоминаем положения для интерполяции при отрисовке
+            for player in self.players:
+                player.prev_pos = player.rect.topleft
+            if self.boss:
+                self.boss.prev_pos = self.boss.rect.topleft
+            for enemy in self.enemies:
+                enemy.prev_pos = enemy.rect.topleft
+            
+            # Обновление игроков
+            keys = [source.get_pressed() for source in self.inputs]
+            for player, player_keys in zip(self.players, keys):
+                if player.health > 0:
+                    player.update(player_keys, self.room)
+            players = self.active_players()
+            self.room.follow(players)
+            self.profiler.mark("update.player")
+            
+            # Движение всех пуль одним шагом
+            self.bullets.update(self.room)
+            self.profiler.mark("update.bullets")
             
             # Обновление врагов или босса
             if self.boss:
-                self.boss.update(self.player)
+                phase = self.boss.phase
+                self.boss.update(self.nearest_player(self.boss))
+                if self.boss.phase != phase:
+                    self.event("boss_phase", self.boss, self.boss.phase, self.boss.health)
+                self.profiler.mark("update.enemies")
+                self.collisions.rebuild(self.bullets, (self.boss,))
                 
                 # Проверка коллизий пуль игрока с боссом
-                hits = pygame.sprite.spritecollide(self.boss, self.player.bullets, True)
-                for hit in hits:
-                    if self.boss.take_damage(hit.damage):
+                hits = self.collisions.collide_groups(OWNER_PLAYER)
+                for damage in hits.get(self.boss, ()):
+                    self.event("boss_hit", self.boss, self.boss.phase, damage)
+                    if self.boss.take_damage(damage) and self.state == GameState.GAME:
                         self.state = GameState.VICTORY
+                        self.event("boss_death", self.boss, self.boss.phase)
+                        self.event("run_end", value=self.state.value)
                         assets.play_sound("victory")
                         assets.play_music("menu")
                 
-                # Проверка коллизий пуль босса с игроком
-                hits = pygame.sprite.spritecollide(self.player, self.boss.bullets, True)
-                for hit in hits:
-                    if self.player.take_damage(hit.damage):
-                        if self.player.health <= 0:
-                            self.state = GameState.GAME_OVER
-                            assets.stop_music()
-                
-                # Проверка коллизий игрока с боссом (получение урона при касании)
-                if pygame.sprite.collide_rect(self.player, self.boss):
-                    if self.player.take_damage(1):
-                        if self.player.health <= 0:
-                            self.state = GameState.GAME_OVER
-                            assets.stop_music()
+                for player in players:
+                    # Проверка коллизий пуль босса с игроком
+                    _, damages = self.collisions.collide_hostile(player)
+                    for damage in damages.tolist():
+                        self.hurt_player(damage, "boss", player)
+                    
+                    # Проверка коллизий игрока с боссом (получение урона при касании)
+                    if self.boss in self.collisions.collide_entities(player):
+                        self.hurt_player(1, "boss:contact", player)
             else:
-                # Обновление обычных врагов
+                # Обновление обычных врагов. Враги не влияют друг на друга, поэтому коллизии
+                # можно проверять после движения всех врагов — результат тот же
+                self.enemy_ai.update(players)
+                self.profiler.mark("update.enemies")
+                self.collisions.rebuild(self.bullets, self.enemies)
+                
+                # Пули игроков, попавшие во врагов, вражеские пули, попавшие в каждого игрока,
+                # и враги, касающиеся каждого игрока, — по одному запросу к сетке
+                hits = self.collisions.collide_groups(OWNER_PLAYER)
+                hostile = [(player, *self.collisions.collide_hostile(player)) for player in players]
+                touching = [(player, self.collisions.collide_entities(player)) for player in players]
+                
                 for enemy in self.enemies:
-                    enemy.update(self.player)
-                    
                     # Проверка коллизий пуль игрока с врагами
-                    hits = pygame.sprite.spritecollide(enemy, self.player.bullets, True)
-                    for hit in hits:
-                        if enemy.take_damage(hit.damage):
+                    for damage in hits.get(enemy, ()):
+                        self.event("enemy_hit", enemy, enemy.enemy_type, damage)
+                        if enemy.take_damage(damage):
+                            self.event("enemy_death", enemy, enemy.enemy_type)
                             enemy.kill()
                     
-                    # Проверка коллизий пуль врагов с игроком
-                    hits = pygame.sprite.spritecollide(self.player, enemy.bullets, True)
-                    for hit in hits:
-                        if self.player.take_damage(hit.damage):
-                            if self.player.health <= 0:
-                                self.state = GameState.GAME_OVER
-                                assets.stop_music()
+                    # Проверка коллизий пуль врагов с игроками
+                    for player, hit_owners, hit_damages in hostile:
+                        if len(hit_owners):
+                            for damage in hit_damages[hit_owners == enemy.owner_id].tolist():
+                                self.hurt_player(damage, enemy.image_name, player)
+                    
+                    # Проверка коллизий игроков с врагами (получение урона при касании)
+                    for player, touched in touching:
+                        if enemy in touched:
+                            self.hurt_player(1, f"{enemy.image_name}:contact", player)
                     
-                    # Проверка коллизий игрока с врагами (получение урона при касании)
-                    if pygame.sprite.collide_rect(self.player, enemy):
-                        if self.player.take_damage(1):
-                            if self.player.health <= 0:
-                                self.state = GameState.GAME_OVER
-                                assets.stop_music()
+                    # Пули убитого врага исчезают вместе с ним
+                    if not enemy.alive():
+                        self.bullets.kill_owner(enemy.owner_id)
+                if len(self.enemies) != len(self.enemy_ai.enemies):
+                    self.enemy_ai.discard_dead()
                 
                 # Проверка, все ли враги побеждены
                 if len(self.enemies) == 0:
+                    self.event("room_clear")
                     self.spawn_enemies()
+            self.profiler.mark("collision")
+            
+            if self.recorder:
+                self.recorder.record(keys[0], self)
+    
+    def hurt_player(self, damage, source, player=None):
+        """Наносит урон игроку (по умолчанию первому) и учитывает его в статистике забега
+        по комнате и источнику. Забег заканчивается, когда погибли все игроки"""
+        player = player or self.player
+        if player.take_damage(damage):
+            key = (self.room_count, source)
+            self.damage_taken[key] = self.damage_taken.get(key, 0) + damage
+            self.event("player_hurt", player, player.slot, damage, source)
+            if player.health <= 0:
+                self.event("player_death", player, player.slot, source=source)
+            if not self.active_players():
+                self.state = GameState.GAME_OVER
+                self.event("run_end", value=self.state.value)
+                assets.stop_music()
     
-    def draw(self):
-        # Отрисовка в зависимости от состояния игры
+    def draw(self, alpha=1.0):
+        """Рисует текущий экран; alpha — доля пути от прошлого шага симуляции к текущему.
+        Возвращает список измененных областей или None, если нужно обновить весь экран"""
+        # Вне игры грязные области не отслеживаются
+        if self.renderer and self.state != GameState.GAME:
+            self.renderer.reset()
+        
+        # Отрисовка игрового экрана
+        if self.state == GameState.GAME:
+            return self.draw_game(screen, alpha)
+        
+        # Статичные экраны собираются один раз и пересобираются, только когда меняется то, что на них показано
+        shown = {GameState.CHARACTER_SELECT: self.selected_character,
+                 GameState.GAME_OVER: self.room_count}.get(self.state)
+        key = (self.state, shown)
+        if key != self.static_key:
+            if self.static_screen is None:
+                self.static_screen = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+            self.draw_static_screen(self.static_screen)
+            self.static_key = key
+        screen.blit(self.static_screen, (0, 0))
+        screen.blits(self.profiler.overlay_layer(), False)
+        self.profiler.mark("draw.static")
+        return None
+    
+    def draw_static_screen(self, surface):
+        """Рисует титульный экран, выбор персонажа, Game Over или экран победы"""
         if self.state == GameState.TITLE:
             # Отрисовка титульного экрана
-            screen.fill(BLACK)
-            title_text = assets.fonts["title"].render("The Binding of Bin Laden", True, WHITE)
+            surface.fill(BLACK)
+            title_text = assets.render_text("title", "The Binding of Bin Laden", WHITE)
             title_rect = title_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 3))
-            screen.blit(title_text, title_rect)
+            surface.blit(title_text, title_rect)
             
             # Отрисовка инструкции
-            start_text = assets.fonts["medium"].render("Press ENTER to start", True, WHITE)
+            start_text = assets.render_text("medium", "Press ENTER to start", WHITE)
             start_rect = start_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-            screen.blit(start_text, start_rect)
+            surface.blit(start_text, start_rect)
             
             # Отрисовка кредитов
-            credits_text = assets.fonts["small"].render("Created by: Agatu_LLL", True, GRAY)
+            credits_text = assets.render_text("small", "Created by: Agatu_LLL", GRAY)
             credits_rect = credits_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT - 50))
-            screen.blit(credits_text, credits_rect)
+            surface.blit(credits_text, credits_rect)
             
         elif self.state == GameState.CHARACTER_SELECT:
             # Отрисовка экрана выбора персонажа
-            screen.fill(BLACK)
-            title_text = assets.fonts["medium"].render("Select Your Muslim", True, WHITE)
+            surface.fill(BLACK)
+            title_text = assets.render_text("medium", "Select Your Muslim", WHITE)
             title_rect = title_text.get_rect(center=(SCREEN_WIDTH // 2, 100))
-            screen.blit(title_text, title_rect)
+            surface.blit(title_text, title_rect)
             
             # Отрисовка персонажей
             char_spacing = 200
@@ -704,11 +3850,11 @@ class Game:
                 char_x = SCREEN_WIDTH // 2 + (i - 2) * char_spacing
                 char_img = assets.get_image(f"player_{i}")
                 char_rect = char_img.get_rect(center=(char_x, char_y))
-                screen.blit(char_img, char_rect)
+                surface.blit(char_img, char_rect)
                 
                 # Выделение выбранного персонажа
                 if i == self.selected_character:
-                    pygame.draw.rect(screen, YELLOW, char_rect.inflate(20, 20), 3)
+                    pygame.draw.rect(surface, YELLOW, char_rect.inflate(20, 20), 3)
                 
                 # Отрисовка имени персонажа
                 if i == 1:
@@ -718,136 +3864,765 @@ class Game:
                 else:
                     name = "Aiman AL-Zawahiri"
                 
-                name_text = assets.fonts["small"].render(name, True, WHITE)
+                name_text = assets.render_text("small", name, WHITE)
                 name_rect = name_text.get_rect(center=(char_x, char_y + 50))
-                screen.blit(name_text, name_rect)
+                surface.blit(name_text, name_rect)
             
             # Отрисовка инструкции
-            select_text = assets.fonts["small"].render("Use LEFT/RIGHT arrows to select, ENTER to confirm", True, WHITE)
+            select_text = assets.render_text("small", "Use LEFT/RIGHT arrows to select, ENTER to confirm", WHITE)
             select_rect = select_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT - 50))
-            screen.blit(select_text, select_rect)
-            
-        elif self.state == GameState.GAME:
-            # Отрисовка игрового экрана
-            # Фон уровня
-            screen.blit(assets.get_background(self.room_count), (0, 0))
-            
-            # Отрисовка игрока
-            screen.blit(self.player.image, self.player.rect)
-            
-            # Отрисовка здоровья игрока
-            self.player.draw_health(screen)
-            
-            # Отрисовка пуль игрока
-            for bullet in self.player.bullets:
-                screen.blit(bullet.image, bullet.rect)
-            
-            # Отрисовка врагов или босса
-            if self.boss:
-                screen.blit(self.boss.image, self.boss.rect)
-                self.boss.draw_health_bar(screen)
-                
-                # Отрисовка пуль босса
-                for bullet in self.boss.bullets:
-                    screen.blit(bullet.image, bullet.rect)
-            else:
-                for enemy in self.enemies:
-                    screen.blit(enemy.image, enemy.rect)
-                    
-                    # Отрисовка пуль врагов
-                    for bullet in enemy.bullets:
-                        screen.blit(bullet.image, bullet.rect)
-            
-            # Отрисовка информации о текущем уровне
-            level_text = assets.fonts["small"].render(f"Room: {self.room_count} / {self.max_rooms}", True, WHITE)
-            screen.blit(level_text, (SCREEN_WIDTH - 150, 10))
+            surface.blit(select_text, select_rect)
             
         elif self.state == GameState.GAME_OVER:
             # Отрисовка экрана Game Over
-            screen.fill(BLACK)
+            surface.fill(BLACK)
             
-            game_over_text = assets.fonts["title"].render("HAHAHAHHA SUCKER", True, RED)
+            game_over_text = assets.render_text("title", "HAHAHAHHA SUCKER", RED)
             game_over_rect = game_over_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 3))
-            screen.blit(game_over_text, game_over_rect)
+            surface.blit(game_over_text, game_over_rect)
             
-            score_text = assets.fonts["medium"].render(f"Rooms completed: {self.room_count}", True, WHITE)
+            score_text = assets.render_text("medium", f"Rooms completed: {self.room_count}", WHITE)
             score_rect = score_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-            screen.blit(score_text, score_rect)
+            surface.blit(score_text, score_rect)
             
-            retry_text = assets.fonts["small"].render("Press R to retry or ESC to return to menu", True, WHITE)
+            retry_text = assets.render_text("small", "Press R to retry or ESC to return to menu", WHITE)
             retry_rect = retry_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT * 2 // 3))
-            screen.blit(retry_text, retry_rect)
+            surface.blit(retry_text, retry_rect)
             
         elif self.state == GameState.VICTORY:
             # Отрисовка экрана победы
-            screen.fill(BLACK)
+            surface.fill(BLACK)
             
-            victory_text = assets.fonts["title"].render("Perfect", True, GREEN)
+            victory_text = assets.render_text("title", "Perfect", GREEN)
             victory_rect = victory_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 3))
-            screen.blit(victory_text, victory_rect)
+            surface.blit(victory_text, victory_rect)
             
-            congrats_text = assets.fonts["medium"].render("You have become a true leader of taliban!", True, WHITE)
+            congrats_text = assets.render_text("medium", "You have become a true leader of taliban!", WHITE)
             congrats_rect = congrats_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-            screen.blit(congrats_text, congrats_rect)
+            surface.blit(congrats_text, congrats_rect)
             
-            retry_text = assets.fonts["small"].render("Press R to kick georges ass again or ESC to return to menu", True, WHITE)
+            retry_text = assets.render_text("small", "Press R to kick georges ass again or ESC to return to menu", WHITE)
             retry_rect = retry_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT * 2 // 3))
-            screen.blit(retry_text, retry_rect)
+            surface.blit(retry_text, retry_rect)
     
-    def handle_events(self):
+    def draw_game(self, surface, alpha=1.0):
+        """Рисует игровой экран слоями; слой — список (изображение, позиция[, область в изображении])"""
+        # Фон уровня с камнями комнаты (из кэша поверхностей)
+        if self.room.rects:
+            background = assets.get_room_background(self.room_count, self.room)
+        else:
+            background = assets.get_background(self.room_count)
+        
+        # Игроки, их здоровье и пули игроков
+        layers = [
+            [sprite_entry(player, alpha) for player in self.active_players()],
+            [self.hud.player_health(self.player)],
+            self.bullets.blit_list(hostile=False, alpha=alpha),
+        ]
+        if len(self.players) > 1:
+            layers[1].append(self.partner_hud.player_health(self.players[1]))
+        
+        # Враги или босс
+        if self.boss:
+            layers.append([sprite_entry(self.boss, alpha)])
+            layers.append([self.hud.boss_health(self.boss)])
+        else:
+            layers.append([sprite_entry(enemy, alpha) for enemy in self.enemies])
+        
+        # Частицы под пулями врагов и босса, чтобы вспышки не прятали пули
+        layers.append(self.particles.blit_list())
+        layers.append(self.bullets.blit_list(hostile=True, alpha=alpha))
+        
+        # Информация о текущем уровне
+        level_text = assets.render_text("small", f"Room: {self.room_count} / {self.max_rooms}", WHITE)
+        layers.append([(level_text, level_text.get_rect(topleft=(SCREEN_WIDTH - 150, 10)))])
+        
+        # Оверлей профайлера
+        layers.append(self.profiler.overlay_layer())
+        self.profiler.mark("draw.layers")
+        
+        if self.renderer:
+            dirty = self.renderer.draw(surface, background, layers)
+            self.profiler.mark("draw.blit")
+            return dirty
+        surface.blit(background, (0, 0))
+        draw_layers(surface, layers)
+        self.profiler.mark("draw.blit")
+        return None
+    
+    def handle_events(self, key_sink=None):
+        """Обрабатывает события окна; False — окно закрыто. Нажатия клавиш отдаются key_sink,
+        если он задан (при --pipeline экраны переключает процесс симуляции), иначе handle_key"""
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 return False
             
+            if event.type == pygame.VIDEORESIZE:
+                presenter.layout()
+            
             if event.type == pygame.KEYDOWN:
-                if self.state == GameState.TITLE:
-                    if event.key == pygame.K_RETURN:
-                        self.state = GameState.CHARACTER_SELECT
-                
-                elif self.state == GameState.CHARACTER_SELECT:
-                    if event.key == pygame.K_LEFT:
-                        self.selected_character = max(1, self.selected_character - 1)
-                    elif event.key == pygame.K_RIGHT:
-                        self.selected_character = min(3, self.selected_character + 1)
-                    elif event.key == pygame.K_RETURN:
-                        self.start_game()
-                
-                elif self.state == GameState.GAME_OVER or self.state == GameState.VICTORY:
-                    if event.key == pygame.K_r:
-                        self.start_game()
-                    elif event.key == pygame.K_ESCAPE:
-                        self.state = GameState.TITLE
-                        self.reset_game()
+                # Оверлей профайлера в любом состоянии
+                if event.key == pygame.K_F3:
+                    self.profiler.toggle_overlay()
+                elif key_sink:
+                    key_sink(event.key)
+                else:
+                    self.handle_key(event.key)
         
         return True
+    
+    def leave_network(self):
+        """Выход из сетевой игры в меню; сессию закрывает главный цикл"""
+        self.state = GameState.TITLE
+        self.reset_game()
+        self.networked = False
+    
+    def handle_key(self, key):
+        """Переходы между экранами по нажатию клавиши"""
+        # Сетевой забег нельзя перезапустить с одной стороны, но после его конца можно выйти в меню
+        if self.networked:
+            if key == pygame.K_ESCAPE and self.state in (GameState.GAME_OVER, GameState.VICTORY):
+                self.leave_network()
+            return
+        
+        if self.state == GameState.TITLE:
+            if key == pygame.K_RETURN:
+                self.state = GameState.CHARACTER_SELECT
+        
+        elif self.state == GameState.CHARACTER_SELECT:
+            if key == pygame.K_LEFT:
+                self.selected_character = max(1, self.selected_character - 1)
+            elif key == pygame.K_RIGHT:
+                self.selected_character = min(3, self.selected_character + 1)
+            elif key == pygame.K_RETURN:
+                self.start_game()
+        
+        elif self.state == GameState.GAME_OVER or self.state == GameState.VICTORY:
+            if key == pygame.K_r:
+                self.start_game()
+            elif key == pygame.K_ESCAPE:
+                self.state = GameState.TITLE
+                self.reset_game()
+
+# Прогон игры без окна и без ограничения FPS
+def run_headless(frames, character=1, draw=True, input_source=None, dirty_rects=False, profiler=None,
+                 seed=None, recorder=None, telemetry=None):
+    """Симулирует указанное число кадров и возвращает (кадры, затраченное время в секундах)"""
+    game = Game(input_source or RandomInput(seed), dirty_rects, profiler, seed, recorder, telemetry=telemetry)
+    game.selected_character = character
+    game.start_game()
+    profiler = game.profiler
+    
+    start = time.perf_counter()
+    for _ in range(frames):
+        profiler.begin_frame()
+        game.update()
+        if draw:
+            present(game.draw())
+            profiler.mark("flip")
+        profiler.end_frame()
+        
+        # После конца забега сразу начинаем новый
+        if game.state in (GameState.GAME_OVER, GameState.VICTORY):
+            game.start_game()
+    elapsed = time.perf_counter() - start
+    
+    return frames, elapsed
+
+# Воспроизведение записи с максимальной скоростью
+def run_replay(path, draw=False, dirty_rects=False, profiler=None):
+    """Прогоняет записанные забеги через Game.update, сверяя контрольные суммы.
+    Возвращает (кадры, затраченное время в секундах, список расхождений (забег, шаг))"""
+    runs = load_replay(path)
+    frames = 0
+    mismatches = []
+    
+    start = time.perf_counter()
+    for run, (character, seed, inputs, checksums) in enumerate(runs):
+        game = Game(ReplayInput(inputs), dirty_rects, profiler)
+        game.selected_character = character
+        game.start_game(seed)
+        profiler = game.profiler
+        
+        for step in range(1, len(inputs) + 1):
+            profiler.begin_frame()
+            game.update()
+            if draw:
+                present(game.draw())
+                profiler.mark("flip")
+            profiler.end_frame()
+            frames += 1
+            
+            if step % CHECKPOINT_INTERVAL == 0 and state_checksum(game) != checksums[step // CHECKPOINT_INTERVAL - 1]:
+                # После расхождения дальше сравнивать бессмысленно
+                mismatches.append((run, step))
+                break
+    elapsed = time.perf_counter() - start
+    
+    return frames, elapsed, mismatches
+
+# Проверка совместной игры на одной машине: две игры с ботами обмениваются пакетами через
+# петлевой интерфейс, а LossyLink добавляет задержку и потери. Время виртуальное: шаг за итерацию
+def run_coop_test(frames, characters=(1, 2), seed=None, latency=0.0, loss=0.0):
+    """Возвращает (сессии, медиана снимка состояния в мкс, медиана восстановления в мкс)"""
+    clock = [0.0]
+    now = lambda: clock[0]
+    sessions = []
+    bots = []
+    host_address = None
+    for local in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.setblocking(False)
+        host_address = host_address or sock.getsockname()
+        link = LossyLink(sock, latency, latency / 2, loss, None if seed is None else seed + local, now)
+        game = Game(ScriptedInput(), seed=seed, partner_input=ScriptedInput())
+        sessions.append(NetSession(game, link, local, host_address if local else None, characters[local], now))
+        bot = BotInput(None if seed is None else seed + local, player=local)
+        bot.game = game
+        bots.append(bot)
+    
+    snapshot_times = []
+    restore_times = []
+    for tick in range(frames):
+        clock[0] = tick / FPS
+        for session, bot in zip(sessions, bots):
+            playing = session.started and session.game.state == GameState.GAME
+            session.advance(bot.get_pressed() if playing else MASK_KEYS[0])
+        if all(session.started and session.game.state != GameState.GAME for session in sessions):
+            break
+        
+        # Время снимка и восстановления — на состоянии настоящего забега
+        game = sessions[0].game
+        if tick % 30 == 0 and game.state == GameState.GAME:
+            started = time.perf_counter()
+            data = snapshot_game(game)
+            snapshot_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            restore_game(game, data)
+            restore_times.append(time.perf_counter() - started)
+    
+    return sessions, np.median(snapshot_times) * 1e6, np.median(restore_times) * 1e6
+
+# Класс для передачи состояния из процесса симуляции в процесс отрисовки (--pipeline).
+# Блок общей памяти: номер последнего опубликованного шага и два буфера под снимки (snapshot_game).
+# Симуляция пишет новый снимок в буфер, который сейчас не последний, и только потом меняет номер,
+# поэтому отрисовка всегда читает законченный шаг, а симуляция никогда ее не ждет
+class SharedState:
+    HEADER = struct.Struct("<q")  # Номер последнего опубликованного шага (-1 — еще ни одного)
+    SLOT = struct.Struct("<Id")  # В начале буфера: длина снимка, время публикации (perf_counter)
+    
+    def __init__(self, name=None, slot_size=PIPELINE_SLOT_SIZE):
+        """Без name создает новый блок, с name — подключается к созданному"""
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(name, name is None,
+                                                 self.HEADER.size + 2 * (self.SLOT.size + slot_size))
+        self.name = self.memory.name
+        self.buffer = self.memory.buf
+        self.sequence = -1
+        if name is None:
+            self.HEADER.pack_into(self.buffer, 0, -1)
+    
+    def slot_offset(self, sequence):
+        return self.HEADER.size + sequence % 2 * (self.SLOT.size + self.slot_size)
+    
+    def publish(self, data):
+        """Публикует снимок следующего шага"""
+        if len(data) > self.slot_size:
+            raise ValueError(f"снимок ({len(data)} байт) не помещается в буфер общей памяти")
+        self.sequence += 1
+        offset = self.slot_offset(self.sequence)
+        self.SLOT.pack_into(self.buffer, offset, len(data), time.perf_counter())
+        start = offset + self.SLOT.size
+        self.buffer[start:start + len(data)] = data
+        self.HEADER.pack_into(self.buffer, 0, self.sequence)
+    
+    def latest(self, known=-1):
+        """(номер шага, снимок, время публикации) последнего шага или None, если он не новее known"""
+        while True:
+            sequence, = self.HEADER.unpack_from(self.buffer, 0)
+            if sequence <= known:
+                return None
+            offset = self.slot_offset(sequence)
+            size, published = self.SLOT.unpack_from(self.buffer, offset)
+            start = offset + self.SLOT.size
+            data = bytes(self.buffer[start:start + size])
+            # Номер не изменился — значит, симуляция не начала писать в этот буфер, пока его копировали
+            if self.HEADER.unpack_from(self.buffer, 0)[0] == sequence:
+                return sequence, data, published
+    
+    def close(self, unlink=False):
+        self.buffer = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+# Процесс симуляции для --pipeline: шаги Game.update с частотой FPS. Зажатые клавиши и нажатия
+# приходят из очереди inputs, состояние после каждого шага публикуется в общую память name,
+# отложенные вызовы звука и предзагрузки (Assets.forward) уходят в очередь outputs
+def simulation_worker(name, inputs, outputs, seed=None, record=None, telemetry=None, resume=None):
+    """Процесс симуляции (--pipeline). record, telemetry и resume — пути файлов из одноименных
+    аргументов командной строки: запись, телеметрия и продолжение забега ведутся здесь"""
+    init(True)
+    assets.remote_calls = []
+    source = ScriptedInput()
+    recorder = ReplayRecorder() if record else None
+    telemetry = Telemetry(telemetry) if telemetry else None
+    game = Game(source, seed=seed, recorder=recorder, telemetry=telemetry)
+    if resume and not recorder:
+        load_resume(game, resume)
+    state = SharedState(name)
+    parent = multiprocessing.parent_process()
+    
+    step = 1.0 / FPS
+    next_step = time.perf_counter()
+    running = True
+    # Если процесс отрисовки упал, не остановив симуляцию, она завершается сама
+    while running and parent.is_alive():
+        while not inputs.empty():
+            message, value = inputs.get()
+            if message == "keys":
+                source.keys = MASK_KEYS[value]
+            elif message == "key":
+                game.handle_key(value)
+            elif message == "quit":
+                running = False
+        
+        now = time.perf_counter()
+        if now < next_step:
+            time.sleep(next_step - now)
+            continue
+        game.update()
+        # Отстав больше чем на MAX_CATCH_UP_STEPS шагов, симуляция замедляется, а не догоняет
+        next_step = max(next_step + step, now - MAX_CATCH_UP_STEPS * step)
+        state.publish(snapshot_game(game))
+        if assets.remote_calls:
+            outputs.put(assets.remote_calls)
+            assets.remote_calls = []
+    
+    if recorder:
+        recorder.save(record)
+    if telemetry:
+        telemetry.close()
+    if resume and not recorder:
+        save_resume(game, resume)
+    state.close()
+    pygame.quit()
+
+# Процесс симуляции со стороны отрисовки: запуск, передача ввода и получение состояния
+class SimulationProcess:
+    def __init__(self, seed=None, record=None, telemetry=None, resume=None):
+        # spawn, а не fork: дочерний процесс не должен наследовать уже открытые SDL-дисплей и микшер
+        context = multiprocessing.get_context("spawn")
+        self.state = SharedState()
+        self.inputs = context.SimpleQueue()
+        self.outputs = context.SimpleQueue()
+        self.process = context.Process(target=simulation_worker, name="simulation",
+                                       args=(self.state.name, self.inputs, self.outputs, seed, record, telemetry,
+                                             resume))
+        self.process.start()
+        self.mask = None  # Последняя отправленная маска клавиш
+        self.sequence = -1  # Последний шаг, перенесенный в игру отрисовки
+        self.published = time.perf_counter()  # Когда он был опубликован
+    
+    def send_keys(self, keys):
+        """Отправляет зажатые клавиши, если они изменились"""
+        mask = keys_to_mask(keys)
+        if mask != self.mask:
+            self.mask = mask
+            self.inputs.put(("keys", mask))
+    
+    def send_key(self, key):
+        """Отправляет нажатие клавиши (переходы между экранами)"""
+        self.inputs.put(("key", key))
+    
+    def sync(self, game):
+        """Переносит в game последний опубликованный шаг и выполняет отложенные вызовы Assets.
+        Возвращает долю пути от этого шага к следующему для интерполяции или None, если процесс
+        симуляции завершился (упал)"""
+        if not self.process.is_alive():
+            return None
+        latest = self.state.latest(self.sequence)
+        if latest:
+            # Частицы — только у игры отрисовки: они догорают столько шагов, сколько сделала симуляция
+            game.particles.update(latest[0] - self.sequence)
+            self.sequence, data, self.published = latest
+            restore_game(game, data)
+        while not self.outputs.empty():
+            for method, args in self.outputs.get():
+                # Вспышки частиц — вызовы игры, остальное — звук и предзагрузка ассетов
+                getattr(game if method == "effect" else assets, method)(*args)
+        return min((time.perf_counter() - self.published) * FPS, 1.0)
+    
+    def close(self):
+        if self.process.is_alive():
+            self.inputs.put(("quit", None))
+        self.process.join()
+        self.state.close(unlink=True)
+
+# Главный цикл с симуляцией в отдельном процессе (--pipeline): здесь только события, отрисовка
+# и вывод кадра. Игра этого процесса не симулируется — в нее переносится состояние симуляции
+def run_pipelined(profiler=None, dirty_rects=False, seed=None, render_fps=FPS, report=None, record=None,
+                  telemetry=None, resume=None):
+    simulation = SimulationProcess(seed, record, telemetry, resume)
+    game = Game(ScriptedInput(), dirty_rects, profiler)
+    profiler = game.profiler
+    keyboard = KeyboardInput()
+    
+    running = True
+    while running:
+        profiler.begin_frame()
+        running = game.handle_events(simulation.send_key)
+        simulation.send_keys(keyboard.get_pressed())
+        profiler.mark("handle_events")
+        
+        alpha = simulation.sync(game)
+        if alpha is None:
+            print(f"Процесс симуляции завершился с кодом {simulation.process.exitcode}")
+            break
+        profiler.mark("sync")
+        
+        present(game.draw(alpha))
+        profiler.mark("flip")
+        
+        if report:
+            report.finish("first frame")
+        
+        clock.tick(render_fps)
+        profiler.mark("idle")
+        profiler.end_frame()
+    
+    simulation.close()
+
+# Один балансный забег; выполняется в процессе пула (см. run_balance)
+def balance_run(task):
+    """Проводит забег ботом за персонажа с зерном из task = (персонаж, зерно) и возвращает его итоги"""
+    character, seed = task
+    bot = BotInput(seed)
+    game = Game(bot, seed=seed)
+    bot.game = game
+    game.selected_character = character
+    game.start_game()
+    
+    steps = 0
+    boss_step = None  # Шаг, на котором появился босс
+    while game.state == GameState.GAME and steps < BALANCE_MAX_STEPS:
+        game.update()
+        steps += 1
+        if boss_step is None and game.boss:
+            boss_step = steps
+    
+    victory = game.state == GameState.VICTORY
+    return {
+        "character": character,
+        "seed": seed,
+        "outcome": {GameState.VICTORY: "victory", GameState.GAME_OVER: "death"}.get(game.state, "timeout"),
+        "room": game.room_count,  # Комната, в которой закончился забег
+        "rooms_cleared": game.room_count if victory else game.room_count - 1,
+        "steps": steps,
+        "boss_ttk": steps - boss_step if victory else None,  # Шагов от появления босса до победы
+        "damage": game.damage_taken,
+    }
+
+# Пакетные забеги ботом в нескольких процессах
+def run_balance(runs, characters=(1, 2, 3), workers=None, seed=0):
+    """Проводит runs забегов за каждого персонажа (зерна seed, seed + 1, ...) в пуле процессов.
+    Возвращает (итоги забегов, затраченное время в секундах)"""
+    workers = workers or os.cpu_count()
+    tasks = [(character, seed + i) for character in characters for i in range(runs)]
+    
+    start = time.perf_counter()
+    # spawn, а не fork: дочерний процесс не должен наследовать уже открытые SDL-дисплей и микшер
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=init, initargs=(True,)) as pool:
+        # Задачи раздаются пачками, чтобы пересылка между процессами не съедала выигрыш
+        chunksize = max(1, len(tasks) // (workers * 8))
+        results = list(pool.imap_unordered(balance_run, tasks, chunksize))
+        # SDL перехватывает SIGTERM, поэтому terminate() при выходе из with не завершит процессы —
+        # закрываем пул штатно
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+    
+    return results, elapsed
+
+def balance_report(results, max_rooms=5):
+    """Сводка балансных забегов по персонажам и комнатам (список строк)"""
+    lines = []
+    for character in sorted({result["character"] for result in results}):
+        runs = [result for result in results if result["character"] == character]
+        count = len(runs)
+        outcomes = {outcome: sum(result["outcome"] == outcome for result in runs) / count * 100
+                    for outcome in ("victory", "death", "timeout")}
+        cleared = sum(result["rooms_cleared"] for result in runs) / count
+        ttk = sorted(result["boss_ttk"] / FPS for result in runs if result["boss_ttk"] is not None)
+        lines.append(f"Персонаж {character}: забегов {count}, победы {outcomes['victory']:.1f}%, "
+                     f"смерти {outcomes['death']:.1f}%, зависания {outcomes['timeout']:.1f}%, "
+                     f"пройдено комнат в среднем {cleared:.2f}")
+        if ttk:
+            lines.append(f"  убийство босса: в среднем {sum(ttk) / len(ttk):.1f} с, "
+                         f"медиана {ttk[len(ttk) // 2]:.1f} с")
+        
+        # По комнатам: сколько забегов дошли и прошли комнату, средний урон по источникам за забег
+        lines.append(f"  {'комната':<8}{'дошли':>7}{'прошли':>8}{'выживаемость':>14}  урон за забег")
+        for room in range(1, max_rooms + 1):
+            entered = [result for result in runs if result["room"] >= room]
+            if not entered:
+                break
+            passed = sum(result["rooms_cleared"] >= room for result in entered)
+            damage = {}
+            for result in entered:
+                for (damage_room, source), amount in result["damage"].items():
+                    if damage_room == room:
+                        damage[source] = damage.get(source, 0) + amount
+            sources = ", ".join(f"{source} {amount / len(entered):.2f}"
+                                for source, amount in sorted(damage.items(), key=lambda item: -item[1]))
+            label = "босс" if room == max_rooms else str(room)
+            lines.append(f"  {label:<8}{len(entered):>7}{passed:>8}{passed / len(entered) * 100:>13.1f}%  "
+                         f"{sources or '-'}")
+    return lines
+
+def window_size(value):
+    """Разбирает размер окна вида 1920x1080"""
+    try:
+        width, height = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается размер вида 1920x1080: {value}")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"размер окна должен быть положительным: {value}")
+    return width, height
+
+def host_port(value):
+    """Разбирает адрес вида host:port"""
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"ожидается адрес вида host:port: {value}")
+    return host, int(port)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="The Binding of Bin Laden")
+    parser.add_argument("--headless", action="store_true",
+                        help="запуск без окна и звука (dummy-драйверы SDL), FPS не ограничен")
+    parser.add_argument("--frames", type=int, default=10000,
+                        help="число кадров для симуляции в headless-режиме")
+    parser.add_argument("--no-draw", action="store_true",
+                        help="не выполнять отрисовку в headless-режиме")
+    parser.add_argument("--character", type=int, choices=(1, 2, 3), default=1,
+                        help="персонаж для headless-режима")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="зерно забегов (и случайного ввода в headless-режиме)")
+    parser.add_argument("--bake", action="store_true",
+                        help=f"собрать пакет уменьшенных изображений {PACK_FILE} и выйти")
+    parser.add_argument("--render-fps", type=int, default=FPS,
+                        help=f"ограничение частоты отрисовки (0 — без ограничения); симуляция всегда идет с частотой {FPS} шагов/с")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="обновлять на экране только измененные области игрового экрана")
+    parser.add_argument("--scale", choices=SCALE_MODES, default="off",
+                        help="вывод кадра в окно: off — без масштабирования, scaled — средствами SDL (pygame.SCALED), "
+                             "integer — с целым коэффициентом, fit — на все окно с сохранением пропорций")
+    parser.add_argument("--filter", choices=("nearest", "smooth"), default="nearest",
+                        help="фильтр масштабирования кадра")
+    parser.add_argument("--window", type=window_size, default=None, metavar="WxH",
+                        help="размер окна для --scale integer/fit (по умолчанию — размер кадра или экрана)")
+    parser.add_argument("--fullscreen", action="store_true",
+                        help="полноэкранный режим")
+    parser.add_argument("--profile", action="store_true",
+                        help="замерять время фаз кадра (оверлей — клавиша F3)")
+    parser.add_argument("--profile-out", default=None,
+                        help="при выходе сохранить замеры кадров в CSV или JSON (включает --profile)")
+    parser.add_argument("--record", default=None,
+                        help="записать ввод и контрольные суммы забегов в файл для воспроизведения")
+    parser.add_argument("--replay", default=None,
+                        help="воспроизвести запись с максимальной скоростью и сверить контрольные суммы")
+    parser.add_argument("--cache-budget", type=int, default=SURFACE_CACHE_BUDGET // (1024 * 1024), metavar="MB",
+                        help="бюджет памяти кэша фонов и больших изображений, МБ")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="вывести время фаз запуска до первого кадра и фоновой загрузки ассетов")
+    parser.add_argument("--balance", type=int, default=None, metavar="N",
+                        help="провести N забегов ботом за каждого персонажа и вывести сводку баланса")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="число процессов для --balance (по умолчанию — число ядер)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="симулировать игру в отдельном процессе, а в этом только рисовать")
+    parser.add_argument("--telemetry", default=None, metavar="FILE",
+                        help="записывать события забегов: в FILE.npz — столбцами (по файлу на пачку), "
+                             "иначе — строками JSON в gzip")
+    parser.add_argument("--resume", default=None, metavar="FILE",
+                        help="продолжить забег из снимка FILE, если он есть, и сохранить в него незаконченный "
+                             "забег при выходе (не вместе с --record)")
+    parser.add_argument("--coop-host", type=int, default=None, metavar="PORT",
+                        help="совместная игра по сети: ждать напарника на UDP-порту PORT")
+    parser.add_argument("--coop-join", type=host_port, default=None, metavar="HOST:PORT",
+                        help="совместная игра по сети: подключиться к хозяину HOST:PORT")
+    parser.add_argument("--coop-test", action="store_true",
+                        help="проверить совместную игру двумя ботами через петлевой интерфейс (--frames шагов)")
+    parser.add_argument("--net-latency", type=float, default=0.0, metavar="MS",
+                        help="имитировать задержку исходящих пакетов совместной игры, мс")
+    parser.add_argument("--net-loss", type=float, default=0.0, metavar="P",
+                        help="имитировать потерю доли P исходящих пакетов совместной игры")
+    return parser.parse_args(argv)
 
 # Главный игровой цикл
-def main():
-    assets = Assets()  # Загрузка ассетов
-    game = Game()  # Создание игры
+def main(argv=None):
+    args = parse_args(argv)
+    
+    # Балансные забеги идут в дочерних процессах, самой игре окно не нужно
+    if args.balance:
+        results, elapsed = run_balance(args.balance, workers=args.workers, seed=args.seed or 0)
+        print("\n".join(balance_report(results)))
+        print(f"Забегов: {len(results)} за {elapsed:.1f} с ({len(results) / elapsed:.1f} забегов/с)")
+        return
+    
+    report = StartupReport(enabled=args.startup_report)
+    init(args.headless or args.bake or args.coop_test, args.cache_budget * 1024 * 1024, report,
+         args.scale, args.window, args.fullscreen, args.filter == "smooth")
+    
+    if args.bake:
+        count, size = bake_assets()
+        print(f"Упаковано изображений: {count} в {PACK_FILE} ({size // 1024} КБ)")
+        pygame.quit()
+        return
+    
+    profiler = FrameProfiler(enabled=args.profile or args.profile_out is not None)
+    
+    # В headless-режиме кадры не показываются: отчет о запуске — сразу после фоновой загрузки
+    if args.headless:
+        report.finish()
+    
+    if args.replay:
+        frames, elapsed, mismatches = run_replay(args.replay, not args.no_draw, args.dirty_rects, profiler)
+        print(f"Воспроизведено кадров: {frames} за {elapsed:.2f} с ({frames / max(elapsed, 1e-9):.0f} кадров/с)")
+        for run, step in mismatches:
+            print(f"Расхождение состояния: забег {run + 1}, шаг {step}")
+        if args.profile_out:
+            profiler.dump(args.profile_out)
+        pygame.quit()
+        sys.exit(1 if mismatches else 0)
+    
+    if args.coop_test:
+        sessions, snapshot_us, restore_us = run_coop_test(args.frames, (args.character, args.character % 3 + 1),
+                                                          args.seed, args.net_latency / 1000, args.net_loss)
+        for session in sessions:
+            print(f"Игрок {session.local + 1}: шагов {session.frame}, откатов {session.rollbacks}, "
+                  f"пересчитано шагов {session.resimulated}, ожиданий напарника {session.stalls}, "
+                  f"сверок состояния {session.checks}, расхождений {session.desyncs}")
+        print(f"Снимок состояния: {snapshot_us:.0f} мкс, восстановление: {restore_us:.0f} мкс (медианы)")
+        pygame.quit()
+        sys.exit(1 if any(session.desyncs for session in sessions) else 0)
+    
+    if args.pipeline and not args.headless:
+        # Запись, телеметрию и продолжение забега ведет процесс симуляции
+        run_pipelined(profiler, args.dirty_rects, args.seed, args.render_fps, report, args.record,
+                      args.telemetry, args.resume)
+        if args.profile_out:
+            profiler.dump(args.profile_out)
+        pygame.quit()
+        sys.exit()
+    
+    recorder = ReplayRecorder() if args.record else None
+    telemetry = Telemetry(args.telemetry) if args.telemetry else None
+    
+    if args.headless:
+        frames, elapsed = run_headless(args.frames, args.character, not args.no_draw,
+                                       RandomInput(args.seed), args.dirty_rects, profiler, args.seed, recorder,
+                                       telemetry)
+        print(f"Симулировано кадров: {frames} за {elapsed:.2f} с ({frames / elapsed:.0f} кадров/с)")
+        if recorder:
+            recorder.save(args.record)
+        if telemetry:
+            telemetry.close()
+            print(f"Телеметрия: записано событий {telemetry.written}, отброшено {telemetry.dropped}")
+        if args.profile_out:
+            profiler.dump(args.profile_out)
+        pygame.quit()
+        return
+    
+    session = None
+    if args.coop_host is not None or args.coop_join:
+        # Совместная игра: ввод обоих игроков задает NetSession, запись не ведется
+        game = Game(ScriptedInput(), args.dirty_rects, profiler, args.seed, partner_input=ScriptedInput(),
+                    telemetry=telemetry)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        if args.coop_join:
+            host, port = args.coop_join
+            sock.bind(("", 0))
+            local, peer = 1, (socket.gethostbyname(host), port)
+        else:
+            sock.bind(("", args.coop_host))
+            local, peer = 0, None
+        if args.net_latency or args.net_loss:
+            sock = LossyLink(sock, args.net_latency / 1000, args.net_latency / 2000, args.net_loss)
+        session = NetSession(game, sock, local, peer, args.character)
+        keyboard = KeyboardInput()
+    else:
+        game = Game(dirty_rects=args.dirty_rects, profiler=profiler, seed=args.seed, recorder=recorder,
+                    telemetry=telemetry)  # Создание игры
+        # Продолжение забега, прерванного при прошлом выходе
+        if args.resume and not recorder:
+            load_resume(game, args.resume)
+    report.mark("game")
     running = True
     
+    # Симуляция идет фиксированными шагами, а отрисовка — с собственной частотой
+    step = 1.0 / FPS
+    accumulator = 0.0
+    previous_time = time.perf_counter()
+    
     while running:
+        profiler.begin_frame()
+        now = time.perf_counter()
+        accumulator += now - previous_time
+        previous_time = now
+        
         # Обработка событий
         running = game.handle_events()
+        if session and not game.networked:
+            # Сетевая игра закончена: дальше обычная игра с клавиатуры
+            session.leave()
+            session = None
+            game = Game(dirty_rects=args.dirty_rects, profiler=profiler, seed=args.seed, telemetry=telemetry)
+        profiler.mark("handle_events")
         
-        # Обновление игры
-        game.update()
+        # Обновление игры: столько шагов, сколько накопилось, но не больше MAX_CATCH_UP_STEPS
+        steps = 0
+        while accumulator >= step and steps < MAX_CATCH_UP_STEPS:
+            if session:
+                # Напарник отстал или забег еще не начался: ждем, не копя отставание
+                if not session.advance(keyboard.get_pressed()):
+                    break
+            else:
+                game.update()
+            accumulator -= step
+            steps += 1
+        # Если не успеваем, отбрасываем отставание, а не копим его (игра замедляется, но не зависает)
+        if accumulator >= step:
+            accumulator = step
         
-        # Отрисовка
-        game.draw()
+        # Отрисовка с интерполяцией между последними шагами
+        dirty = game.draw(min(accumulator / step, 1.0))
         
         # Обновление экрана
-        pygame.display.flip()
+        present(dirty)
+        profiler.mark("flip")
         
-        # Фреймрейт
-        clock.tick(FPS)
+        report.finish("first frame")
+        
+        # Ограничение частоты отрисовки
+        clock.tick(args.render_fps)
+        profiler.mark("idle")
+        profiler.end_frame()
     
+    if recorder:
+        recorder.save(args.record)
+    if telemetry:
+        telemetry.close()
+    if args.resume and not session and not recorder:
+        save_resume(game, args.resume)
+    if args.profile_out:
+        profiler.dump(args.profile_out)
     pygame.quit()
     sys.exit()
 
-# Глобальный экземпляр Assets для доступа из всех классов
-assets = Assets()
-
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()